@@ -0,0 +1,4 @@
+# Shared BERT scoring code for the camilliere and papineau pipelines.
+#
+# The pipeline scripts are run from their own directories, so they add the
+# repository root to sys.path before importing from this package.
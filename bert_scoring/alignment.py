@@ -0,0 +1,102 @@
+# Per-participant alignment between ratings and BERT scores, related to
+# continuous participant measures (e.g., the Camilliere et al. ideology scales).
+#
+# Each participant rates only some items, so their ratings are a ragged
+# participants x items matrix (NaN where a participant didn't rate an item; see
+# bootstrap.get_rating_matrices). A participant's alignment is the Pearson
+# correlation between their ratings and the BERT scores of the items they rated,
+# and the alignments of all participants are one masked Pearson computation
+# (bootstrap.masked_pearson) over the matrix, rather than a loop of per-participant
+# correlations.
+#
+# The alignments are then related to each scale (a participants x scales matrix,
+# NaN where a participant didn't complete a survey), again for all scales at once:
+#   * correlate_with_scales - the Pearson and Spearman correlation with each scale,
+#     over the participants with both values
+#   * regress_on_scales - a multiple regression of alignment on all scales (over the
+#     participants with every scale), with standardized coefficients
+# so adding a scale is adding a column.
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from bert_scoring import bootstrap
+
+
+def get_participant_alignments(sums, counts, scores):
+    """Returns a DataFrame with each participant's alignment (r) and number of rated items (n_items).
+
+    sums and counts are from bootstrap.get_rating_matrices, and scores is a
+    Series of BERT scores indexed by item.
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratings = np.asarray(sums, dtype=np.float64) / counts
+    item_scores = scores.reindex(sums.columns).to_numpy(dtype=np.float64)
+    return pd.DataFrame({
+        "r": bootstrap.masked_pearson(ratings, item_scores),
+        "n_items": ((counts > 0) & np.isfinite(item_scores)).sum(axis=1),
+    }, index=sums.index)
+
+
+def get_participant_scales(data, scales, participant_column="ID"):
+    """Returns a DataFrame of each participant's (mean) score on each of scales."""
+    return data.groupby(participant_column)[list(scales)].mean()
+
+
+def get_p_values(r, n):
+    """Returns the two-sided p values of Pearson correlations r over n observations."""
+    r = np.asarray(r, dtype=np.float64)
+    n = np.asarray(n, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = r * np.sqrt((n - 2) / (1 - r ** 2))
+        return np.where(n > 2, 2 * stats.t.sf(np.abs(t), n - 2), np.nan)
+
+
+def correlate_with_scales(alignments, scales):
+    """Returns a DataFrame (a row per scale) of the correlations of alignments (a Series) with each scale.
+
+    Each correlation is over the participants with both an alignment and a score
+    on that scale.
+    """
+    values = scales.reindex(alignments.index).to_numpy(dtype=np.float64).T
+    alignment_values = np.broadcast_to(alignments.to_numpy(dtype=np.float64), values.shape)
+    mask = np.isfinite(values) & np.isfinite(alignment_values)
+    values = np.where(mask, values, np.nan)
+    alignment_values = np.where(mask, alignment_values, np.nan)
+    n = mask.sum(axis=1)
+
+    # Spearman correlations are Pearson correlations of the ranks (among each scale's participants)
+    ranks = pd.DataFrame(values.T).rank().to_numpy().T
+    alignment_ranks = pd.DataFrame(alignment_values.T).rank().to_numpy().T
+
+    pearson_r = bootstrap.masked_pearson(alignment_values, values)
+    spearman_r = bootstrap.masked_pearson(alignment_ranks, ranks)
+    return pd.DataFrame({
+        "scale": list(scales.columns), "n_participants": n,
+        "pearson_r": pearson_r, "pearson_p": get_p_values(pearson_r, n),
+        "spearman_r": spearman_r, "spearman_p": get_p_values(spearman_r, n),
+    })
+
+
+def regress_on_scales(alignments, scales):
+    """Regresses alignments on all scales at once, over the participants with every value.
+
+    Returns a DataFrame (a row per scale) of standardized coefficients (beta),
+    their standard errors, t statistics and p values.
+    """
+    data = pd.concat([alignments.rename("alignment"), scales.reindex(alignments.index)], axis=1).dropna()
+    data = (data - data.mean()) / data.std()
+    x = np.column_stack([np.ones(len(data)), data[scales.columns].to_numpy()])
+    y = data["alignment"].to_numpy()
+    coefficients, _, rank, _ = np.linalg.lstsq(x, y, rcond=None)
+    degrees_of_freedom = len(data) - rank
+    residual_variance = np.sum((y - x @ coefficients) ** 2) / degrees_of_freedom
+    standard_errors = np.sqrt(np.diag(np.linalg.pinv(x.T @ x)) * residual_variance)
+    t = coefficients / standard_errors
+    return pd.DataFrame({
+        "scale": list(scales.columns), "n_participants": len(data),
+        "beta": coefficients[1:], "se": standard_errors[1:], "t": t[1:],
+        "p": 2 * stats.t.sf(np.abs(t[1:]), degrees_of_freedom),
+    })
@@ -0,0 +1,210 @@
+# Inference backends for the BERT encoder.
+#
+# The scoring engines run the model's encoder through a backend (the MLM
+# prediction head is always run with PyTorch, since it is only applied at the
+# masked positions). The backends are:
+#   * eager - PyTorch, as is
+#   * torchscript - a TorchScript graph traced (and frozen) from the encoder
+#   * onnxruntime - an ONNX Runtime CPU session, exported from the same encoder
+#     (requires the onnx and onnxruntime packages)
+#
+# Compiled graphs are specialized to the shape of their inputs, so batches are
+# padded to a small set of static shapes (batch sizes rounded up to a power of 2,
+# lengths rounded up to one of LENGTH_BUCKETS), and one graph is compiled per
+# shape and then reused. The stimuli are short and of similar lengths, so only a
+# few shapes are needed. The first time each graph is used, its output is checked
+# against the eager encoder, and a ValueError is raised if they differ by more
+# than TOLERANCE. get_backend also checks a compiled backend on a probe batch
+# before returning it, so a backend that doesn't match eager fails as the model
+# is loaded, rather than partway through a scoring run.
+#
+# Compiled backends only support fp32 models. Graphs are compiled in the process
+# that uses them, so with --workers each worker compiles its own.
+
+import abc
+import io
+
+import torch
+
+from bert_scoring import models
+
+
+BACKENDS = ["eager", "torchscript", "onnxruntime"]
+
+# Padded sequence lengths (up to BERT's maximum of 512 positions)
+LENGTH_BUCKETS = [16, 32, 48, 64, 96, 128, 192, 256, 384, 512]
+
+# Maximum absolute difference from the eager encoder's hidden states
+TOLERANCE = 1e-3
+
+INPUT_NAMES = ["input_ids", "token_type_ids", "attention_mask"]
+
+# Shape of the probe batch compiled backends are checked on (a typical stimulus length)
+PROBE_SHAPE = (2, 12)
+
+
+def get_batch_size_bucket(batch_size):
+    """Rounds batch_size up to a power of 2."""
+    return 1 << (batch_size - 1).bit_length()
+
+
+def get_length_bucket(length):
+    return next((bucket for bucket in LENGTH_BUCKETS if bucket >= length), length)
+
+
+def pad_to_shape(batch, shape):
+    """Pads the tensors of a batch (as returned by masked_lm.pad_batch) to shape.
+
+    Padded positions are masked out of attention, so the hidden states of the
+    original positions are unchanged. Padded rows attend to all of their
+    (padding) positions, and are discarded.
+    """
+    batch_size, length = batch["input_ids"].shape
+    padded_batch = {}
+    for name in INPUT_NAMES:
+        padded = torch.zeros(shape, dtype=batch[name].dtype, device=batch[name].device)
+        padded[:batch_size, :length] = batch[name]
+        padded_batch[name] = padded
+    padded_batch["attention_mask"][batch_size:] = 1
+    return padded_batch
+
+
+class EncoderWrapper(torch.nn.Module):
+    """The model's encoder, with positional inputs and the last hidden states as its only output."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.bert = model.bert
+
+    def forward(self, input_ids, token_type_ids, attention_mask):
+        return self.bert(
+            input_ids=input_ids, token_type_ids=token_type_ids, attention_mask=attention_mask)[0]
+
+
+class EagerBackend:
+    """Runs the model's encoder with PyTorch."""
+
+    name = "eager"
+
+    def __init__(self, model):
+        self.model = model
+
+    def encode(self, batch):
+        """Returns the encoder's last hidden states for a batch, [batch_size, length, hidden_size]."""
+        return self.model.bert(**batch)[0]
+
+
+class CompiledBackend(EagerBackend, abc.ABC):
+    """Runs graphs compiled from the model's encoder, one per bucketed input shape."""
+
+    def __init__(self, model):
+        super().__init__(model)
+        self.graphs = {}
+
+    @abc.abstractmethod
+    def compile(self, padded_batch):
+        """Returns a graph for inputs of the shape of padded_batch."""
+
+    @abc.abstractmethod
+    def run(self, graph, padded_batch):
+        """Returns the graph's last hidden states for padded_batch."""
+
+    def encode(self, batch):
+        if set(batch) != set(INPUT_NAMES):
+            raise ValueError(f"The {self.name} backend doesn't support packed batches")
+        batch_size, length = batch["input_ids"].shape
+        shape = (get_batch_size_bucket(batch_size), get_length_bucket(length))
+        padded_batch = pad_to_shape(batch, shape)
+        if shape not in self.graphs:
+            graph = self.compile(padded_batch)
+            hidden_states = self.run(graph, padded_batch)[:batch_size, :length]
+            error = (hidden_states - super().encode(batch)).abs().max().item()
+            if error > TOLERANCE:
+                raise ValueError(
+                    f"The {self.name} backend differs from eager by {error} on inputs of shape {shape}")
+            self.graphs[shape] = graph
+            return hidden_states
+        return self.run(self.graphs[shape], padded_batch)[:batch_size, :length]
+
+
+def get_probe_batch(model):
+    """Returns a batch of PROBE_SHAPE with random token ids, the second row shorter (padded)."""
+    generator = torch.Generator().manual_seed(0)
+    batch_size, length = PROBE_SHAPE
+    device = models.get_model_device(model)
+    attention_mask = torch.ones(PROBE_SHAPE, dtype=torch.long)
+    attention_mask[1:, length // 2:] = 0
+    return {
+        "input_ids": (torch.randint(
+            model.config.vocab_size, PROBE_SHAPE, generator=generator) * attention_mask).to(device),
+        "token_type_ids": torch.zeros(PROBE_SHAPE, dtype=torch.long, device=device),
+        "attention_mask": attention_mask.to(device),
+    }
+
+
+class TorchScriptBackend(CompiledBackend):
+    name = "torchscript"
+
+    def compile(self, padded_batch):
+        traced = torch.jit.trace(
+            EncoderWrapper(self.model).eval(), tuple(padded_batch[name] for name in INPUT_NAMES),
+            check_trace=False)
+        return torch.jit.freeze(traced)
+
+    def run(self, graph, padded_batch):
+        return graph(*(padded_batch[name] for name in INPUT_NAMES))
+
+
+class OnnxRuntimeBackend(CompiledBackend):
+    name = "onnxruntime"
+
+    def __init__(self, model):
+        import onnxruntime
+
+        super().__init__(model)
+        self.onnxruntime = onnxruntime
+
+    def compile(self, padded_batch):
+        model_bytes = io.BytesIO()
+        torch.onnx.export(
+            EncoderWrapper(self.model).eval(), tuple(padded_batch[name].cpu() for name in INPUT_NAMES),
+            model_bytes, input_names=INPUT_NAMES, output_names=["hidden_states"], dynamo=False)
+        return self.onnxruntime.InferenceSession(
+            model_bytes.getvalue(), providers=["CPUExecutionProvider"])
+
+    def run(self, graph, padded_batch):
+        hidden_states = graph.run(
+            None, {name: padded_batch[name].cpu().numpy() for name in INPUT_NAMES})[0]
+        return torch.from_numpy(hidden_states).to(padded_batch["input_ids"].device)
+
+
+def get_backend(name, model):
+    """Returns a backend (one of BACKENDS) for the model's encoder.
+
+    A compiled backend is first checked against the eager encoder on a probe
+    batch, and a ValueError is raised if they differ by more than TOLERANCE.
+    """
+    # With int8 dynamic quantization, activations are quantized with ranges computed
+    # over the whole batch, so padding a batch to a bucketed shape would change the
+    # scores of the stimuli in it
+    if name != "eager" and models.get_precision(model) != "fp32":
+        raise ValueError(f"The {name} backend only supports fp32; use the eager backend")
+    backend = {
+        "eager": EagerBackend,
+        "torchscript": TorchScriptBackend,
+        "onnxruntime": OnnxRuntimeBackend,
+    }[name](model)
+    if isinstance(backend, CompiledBackend):
+        with torch.no_grad():
+            backend.encode(get_probe_batch(model))
+        # Graphs are compiled in the processes that use them (e.g., forked workers)
+        backend.graphs.clear()
+    return backend
+
+
+def encode(model, batch):
+    """Returns the encoder's last hidden states for a batch, using the model's backend."""
+    backend = getattr(model, "scoring_backend", None)
+    if backend is None:
+        return model.bert(**batch)[0]
+    return backend.encode(batch)
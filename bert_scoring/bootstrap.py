@@ -0,0 +1,233 @@
+# Participant-level bootstrap confidence intervals for correlations between the
+# mean rating of each item (over a group of participants) and BERT scores.
+#
+# Each bootstrap replicate resamples a group's participants with replacement, so
+# a replicate is a vector of weights (the number of times each participant was
+# drawn). With the group's ratings as participants x items matrices of rating sums
+# and counts, the item means of all replicates are two matrix products,
+#   item_means = (weights @ sums) / (weights @ counts)
+# and their correlations with the BERT scores are computed for all replicates at
+# once (skipping items no resampled participant rated). With all weights 1, the
+# item means are the group's item means.
+#
+# A replicate's item means deviate from the group's by the resampling noise, on
+# top of the sampling noise the group's item means already have. Left in, that
+# extra variance across items attenuates every replicate's correlation (the more
+# so the smaller the group), so the replicates would sit below r in magnitude. So
+# the replicates' correlations are computed with the resampling noise (the mean
+# variance, across items, of the replicates' deviations from the group's item
+# means) taken out of the variance of their item means; the correlations then
+# vary around r roughly as r varies across samples of participants of the
+# group's size.
+#
+# Each group's interval is a BCa (bias-corrected and accelerated) percentile
+# interval of these replicates, with the acceleration from a delete-one-participant
+# jackknife, and is checked to contain r (a ValueError is raised otherwise). The
+# difference between two groups' correlations gets a percentile interval of the
+# differences of their (independent) replicates, and a p value from a permutation
+# test: the participants of both groups are pooled, and their group labels
+# shuffled (keeping the groups' sizes), n_permutations times, so the null
+# distribution has the same attenuation of each group's correlation as the
+# observed difference.
+
+import numpy as np
+from scipy import stats
+
+
+DEFAULT_N_REPLICATES = 10000
+
+DEFAULT_N_PERMUTATIONS = 10000
+
+DEFAULT_SEED = 0
+
+DEFAULT_CONFIDENCE = 0.95
+
+
+def get_rating_matrices(data, participant_column="ID", item_columns=("cond", "itm"), rating_column="rating"):
+    """Returns (sums, counts) DataFrames of the ratings, with a row per participant and a column per item."""
+    columns = list(item_columns)
+    sums = data.pivot_table(
+        index=participant_column, columns=columns, values=rating_column, aggfunc="sum", fill_value=0)
+    counts = data.pivot_table(
+        index=participant_column, columns=columns, values=rating_column, aggfunc="count", fill_value=0)
+    return sums, counts.reindex(index=sums.index, columns=sums.columns)
+
+
+def masked_pearson(x, y):
+    """Returns the Pearson correlation along the last axis of x and y (which broadcast), skipping NaNs.
+
+    Only the positions where both x and y are finite are used. Correlations of
+    fewer than 2 positions, or with no variance, are NaN.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    mask = np.isfinite(x) & np.isfinite(y)
+    x = np.where(mask, x, 0)
+    y = np.where(mask, y, 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        n = mask.sum(axis=-1, keepdims=True)
+        dx = np.where(mask, x - x.sum(axis=-1, keepdims=True) / n, 0)
+        dy = np.where(mask, y - y.sum(axis=-1, keepdims=True) / n, 0)
+        r = (dx * dy).sum(axis=-1) / np.sqrt((dx ** 2).sum(axis=-1) * (dy ** 2).sum(axis=-1))
+    return np.where(n[..., 0] >= 2, np.clip(r, -1, 1), np.nan)
+
+
+def get_resampling_weights(n_participants, n_replicates=DEFAULT_N_REPLICATES, rng=None):
+    """Returns a [n_replicates, n_participants] matrix of how often each participant is drawn in each replicate."""
+    rng = np.random.default_rng(DEFAULT_SEED) if rng is None else rng
+    return rng.multinomial(n_participants, np.full(n_participants, 1 / n_participants), size=n_replicates)
+
+
+def get_item_means(sums, counts, weights):
+    """Returns the [n_replicates, n_items] item means for weights ([n_replicates, n_participants]).
+
+    Items that no participant with a nonzero weight rated are NaN.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (weights @ np.asarray(sums, dtype=np.float64)) / (weights @ np.asarray(counts, dtype=np.float64))
+
+
+def center(x, mask):
+    """Returns x less its mean along the last axis over the positions in mask, and 0 elsewhere."""
+    x = np.where(mask, x, 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(mask, x - x.sum(axis=-1, keepdims=True) / mask.sum(axis=-1, keepdims=True), 0)
+
+
+def get_replicate_correlations(item_means, group_item_means, scores):
+    """Returns the correlations of the replicates' item means with scores, without the resampling noise.
+
+    item_means is [n_replicates, n_items], and group_item_means and scores are
+    [n_items]. The mean variance (across items) of the replicates' deviations
+    from group_item_means is subtracted from the variance of each replicate's
+    item means. Replicates with fewer than 2 items, or no variance left, are NaN.
+    """
+    scores = np.broadcast_to(scores, item_means.shape)
+    mask = np.isfinite(item_means) & np.isfinite(scores)
+    n = mask.sum(axis=-1)
+    item_deviations = center(item_means, mask)
+    score_deviations = center(scores, mask)
+    noise_deviations = center(item_means - group_item_means, mask)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        noise = np.nanmean((noise_deviations ** 2).sum(axis=-1) / n)
+        variance = (item_deviations ** 2).sum(axis=-1) / n - noise
+        covariance = (item_deviations * score_deviations).sum(axis=-1) / n
+        r = covariance / np.sqrt(variance * (score_deviations ** 2).sum(axis=-1) / n)
+    return np.where((n >= 2) & (variance > 0), np.clip(r, -1, 1), np.nan)
+
+
+def bootstrap_correlations(sums, counts, scores, n_replicates=DEFAULT_N_REPLICATES, rng=None):
+    """Returns the [n_replicates] correlations (see get_replicate_correlations) of resampled item means with scores."""
+    weights = get_resampling_weights(len(sums), n_replicates, rng)
+    group_item_means = get_item_means(sums, counts, np.ones((1, len(sums))))[0]
+    return get_replicate_correlations(
+        get_item_means(sums, counts, weights), group_item_means, np.asarray(scores, dtype=np.float64))
+
+
+def jackknife_correlations(sums, counts, scores):
+    """Returns the [n_participants] correlations of the item means with scores, leaving out each participant."""
+    weights = 1 - np.eye(len(sums))
+    return masked_pearson(get_item_means(sums, counts, weights), np.asarray(scores, dtype=np.float64))
+
+
+def get_confidence_interval(replicates, confidence=DEFAULT_CONFIDENCE):
+    """Returns the (low, high) percentile interval of the replicates."""
+    alpha = (1 - confidence) / 2
+    low, high = np.nanquantile(replicates, [alpha, 1 - alpha])
+    return float(low), float(high)
+
+
+def get_bca_interval(replicates, estimate, jackknife, confidence=DEFAULT_CONFIDENCE):
+    """Returns the (low, high) BCa interval of the replicates of estimate, with the acceleration from jackknife."""
+    replicates = replicates[np.isfinite(replicates)]
+    jackknife = jackknife[np.isfinite(jackknife)]
+    # The bias correction is the normal quantile of the fraction of replicates below
+    # the estimate (kept finite, so an estimate outside every replicate fails the
+    # check in bootstrap_groups, rather than giving a NaN interval)
+    below = np.mean(replicates < estimate) + np.mean(replicates == estimate) / 2
+    below = np.clip(below, 0.5 / len(replicates), 1 - 0.5 / len(replicates))
+    bias_correction = stats.norm.ppf(below)
+    deviations = jackknife.mean() - jackknife
+    with np.errstate(divide="ignore", invalid="ignore"):
+        acceleration = np.nan_to_num((deviations ** 3).sum() / (6 * ((deviations ** 2).sum()) ** 1.5))
+    alpha = (1 - confidence) / 2
+    z = bias_correction + stats.norm.ppf([alpha, 1 - alpha])
+    low, high = np.quantile(replicates, stats.norm.cdf(bias_correction + z / (1 - acceleration * z)))
+    return float(low), float(high)
+
+
+def check_interval(name, estimate, low, high):
+    if not low <= estimate <= high:
+        raise ValueError(
+            f"The bootstrap interval [{low:.4f}, {high:.4f}] of {name} doesn't contain its estimate {estimate:.4f}")
+
+
+def permutation_test(ratings_a, ratings_b, scores, n_permutations=DEFAULT_N_PERMUTATIONS, rng=None):
+    """Returns the two-sided permutation test p value of the difference between two groups' correlations.
+
+    ratings_a and ratings_b are each group's (sums, counts) from
+    get_rating_matrices, and scores is a Series of BERT scores indexed by item.
+    The participants' group labels are shuffled n_permutations times.
+    """
+    rng = np.random.default_rng(DEFAULT_SEED) if rng is None else rng
+    items = ratings_a[0].columns.union(ratings_b[0].columns)
+    sums, counts = [
+        np.vstack([ratings_a[i].reindex(columns=items, fill_value=0),
+                   ratings_b[i].reindex(columns=items, fill_value=0)]) for i in range(2)]
+    item_scores = scores.reindex(items).to_numpy(dtype=np.float64)
+
+    # The first row is the observed grouping
+    labels = np.arange(len(sums)) < len(ratings_a[0])
+    assignments = np.vstack([labels, rng.permuted(np.tile(labels, (n_permutations, 1)), axis=1)])
+    differences = (
+        masked_pearson(get_item_means(sums, counts, assignments.astype(np.float64)), item_scores)
+        - masked_pearson(get_item_means(sums, counts, (~assignments).astype(np.float64)), item_scores))
+    observed, permuted = differences[0], differences[1:]
+    permuted = permuted[np.isfinite(permuted)]
+    # Groups of different sizes are attenuated differently, so the null distribution
+    # needn't be centered on 0; the p value is of the observed difference's tails
+    tails = [(1 + np.sum(permuted >= observed)) / (1 + len(permuted)),
+             (1 + np.sum(permuted <= observed)) / (1 + len(permuted))]
+    return float(min(1.0, 2 * min(tails)))
+
+
+def bootstrap_groups(group_ratings, scores, n_replicates=DEFAULT_N_REPLICATES, seed=DEFAULT_SEED,
+                     confidence=DEFAULT_CONFIDENCE, n_permutations=DEFAULT_N_PERMUTATIONS):
+    """Bootstraps the correlation of each group's item means with the BERT scores.
+
+    group_ratings maps each group's label to its (sums, counts) from
+    get_rating_matrices, and scores is a Series of BERT scores indexed by item.
+    Returns (intervals, comparisons): intervals maps each label to a dict with
+    r, bias (mean replicate less r), and the BCa interval ci_low and ci_high,
+    and comparisons is a list of dicts (group_a, group_b, difference,
+    difference_ci_low, difference_ci_high and the permutation p value p) for
+    each pair of groups. Raises a ValueError if an interval doesn't contain its
+    estimate.
+    """
+    rng = np.random.default_rng(seed)
+    intervals = {}
+    replicates = {}
+    for label, (sums, counts) in group_ratings.items():
+        group_scores = scores.reindex(sums.columns).to_numpy()
+        r = float(masked_pearson(get_item_means(sums, counts, np.ones((1, len(sums))))[0], group_scores))
+        group_replicates = bootstrap_correlations(sums, counts, group_scores, n_replicates, rng)
+        replicates[label] = group_replicates
+        bias = float(np.nanmean(group_replicates)) - r
+        ci_low, ci_high = get_bca_interval(
+            group_replicates, r, jackknife_correlations(sums, counts, group_scores), confidence)
+        check_interval(label, r, ci_low, ci_high)
+        intervals[label] = {"r": r, "bias": bias, "ci_low": ci_low, "ci_high": ci_high}
+
+    comparisons = []
+    labels = list(group_ratings)
+    for i, label_a in enumerate(labels):
+        for label_b in labels[i + 1:]:
+            difference = intervals[label_a]["r"] - intervals[label_b]["r"]
+            ci_low, ci_high = get_confidence_interval(replicates[label_a] - replicates[label_b], confidence)
+            check_interval(f"{label_a} - {label_b}", difference, ci_low, ci_high)
+            comparisons.append({
+                "group_a": label_a, "group_b": label_b, "difference": difference,
+                "difference_ci_low": ci_low, "difference_ci_high": ci_high,
+                "p": permutation_test(
+                    group_ratings[label_a], group_ratings[label_b], scores, n_permutations, rng)})
+    return intervals, comparisons
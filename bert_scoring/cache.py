@@ -0,0 +1,123 @@
+# Persistent on-disk cache of BERT scores, shared by all pipelines.
+#
+# Scores are keyed by a hash of (model id and revision, tokenizer, input ids,
+# masked positions, and the scored candidate ids), so identical inputs are only
+# scored once, no matter which pipeline (or rerun) asks for them. The cache is a
+# single SQLite file. Once it grows past max_size_bytes, the least recently used
+# entries are evicted.
+#
+# By default, the cache is stored at ~/.cache/bert_scoring/scores.sqlite (or at
+# the path in the BERT_SCORING_CACHE environment variable).
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+from bert_scoring import models
+
+
+DEFAULT_CACHE_PATH = os.environ.get(
+    "BERT_SCORING_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "bert_scoring", "scores.sqlite"))
+
+DEFAULT_MAX_SIZE_BYTES = 2 * 1024 ** 3  # 2GB
+
+# Maximum number of keys per SQL query (SQLite limits the number of parameters)
+QUERY_CHUNK_SIZE = 500
+
+
+def get_model_key(model, tokenizer):
+    """Returns a string identifying the model weights and tokenizer that produce a score."""
+    vocab_hash = hashlib.sha256(
+        json.dumps(sorted(tokenizer.vocab.items())).encode("utf-8")).hexdigest()
+    return json.dumps([
+        model.config._name_or_path,
+        getattr(model.config, "_commit_hash", None),
+        str(next(model.parameters()).dtype),
+        models.get_precision(model),
+        tokenizer.name_or_path,
+        vocab_hash])
+
+
+def make_key(model_key, kind, input_ids, positions, candidate_ids=()):
+    """Returns the cache key for the scores of candidate_ids at positions of input_ids.
+
+    kind distinguishes different ways of scoring the same input (e.g., full-vocabulary
+    vs. within-set probabilities).
+    """
+    payload = json.dumps([
+        model_key, kind, [int(i) for i in input_ids], [int(p) for p in positions],
+        [int(c) for c in candidate_ids]])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ScoreCache:
+    """An SQLite-backed map from cache keys to arrays of float64 scores."""
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_size_bytes=DEFAULT_MAX_SIZE_BYTES):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS scores ("
+            "key TEXT PRIMARY KEY, value BLOB, size INTEGER, last_used REAL)")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS scores_last_used ON scores (last_used)")
+        self.connection.commit()
+
+    def get_many(self, keys):
+        """Returns a dict mapping each of keys that is in the cache to its scores."""
+        result = {}
+        keys = list(set(keys))
+        for start in range(0, len(keys), QUERY_CHUNK_SIZE):
+            chunk = keys[start:start + QUERY_CHUNK_SIZE]
+            rows = self.connection.execute(
+                f"SELECT key, value FROM scores WHERE key IN ({','.join('?' * len(chunk))})",
+                chunk).fetchall()
+            for key, value in rows:
+                result[key] = np.frombuffer(value, dtype=np.float64).tolist()
+
+        # Mark hits as recently used, so they are evicted last
+        now = time.time()
+        self.connection.executemany(
+            "UPDATE scores SET last_used = ? WHERE key = ?", [(now, key) for key in result])
+        self.connection.commit()
+        return result
+
+    def put_many(self, items):
+        """Adds (key, scores) pairs to the cache, then evicts entries if it is over max_size_bytes."""
+        now = time.time()
+        rows = []
+        for key, scores in items:
+            value = np.asarray(scores, dtype=np.float64).tobytes()
+            rows.append((key, value, len(value), now))
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO scores (key, value, size, last_used) VALUES (?, ?, ?, ?)", rows)
+        self.connection.commit()
+        self.evict()
+
+    def get_size_bytes(self):
+        return self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM scores").fetchone()[0]
+
+    def evict(self):
+        """Removes the least recently used entries until the cache is under max_size_bytes."""
+        excess = self.get_size_bytes() - self.max_size_bytes
+        if excess <= 0:
+            return
+        evicted_keys = []
+        for key, size in self.connection.execute(
+                "SELECT key, size FROM scores ORDER BY last_used"):
+            evicted_keys.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self.connection.executemany("DELETE FROM scores WHERE key = ?", evicted_keys)
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
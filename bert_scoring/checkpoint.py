@@ -0,0 +1,121 @@
+# Checkpointing and atomic outputs for long scoring runs.
+#
+# While a scoring run is in progress, the scores of completed stimuli are
+# periodically written to a checkpoint directory, as Parquet result shards of
+# (stimulus_index, scores) rows. If the run is interrupted (e.g., the node is
+# preempted), rerunning it with --resume loads the shards and only scores the
+# remaining stimuli. A checkpoint records a fingerprint of the model and the
+# tokenized stimuli, so it is never resumed with different inputs.
+#
+# Final outputs are written to a temporary path and then renamed into place, so
+# a crashed run never leaves a truncated output for the next step to read.
+
+import contextlib
+import glob
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import pandas as pd
+
+
+# Minimum time between checkpoint writes
+DEFAULT_INTERVAL_SECONDS = 300
+
+MANIFEST_FILE = "manifest.json"
+
+
+def get_fingerprint(*parts):
+    """Returns a hash of the given (JSON-serializable) parts, identifying the inputs of a run."""
+    return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+
+class Checkpoint:
+    """Result shards of a scoring run, stored in the directory at path."""
+
+    def __init__(self, path, resume=False, interval_seconds=DEFAULT_INTERVAL_SECONDS):
+        self.path = path
+        self.resume = resume
+        self.interval_seconds = interval_seconds
+        self.pending = []
+        self.last_write_time = time.time()
+
+    def load(self, fingerprint):
+        """Returns a dict mapping the index of each checkpointed stimulus to its scores.
+
+        Unless resuming, any existing checkpoint is discarded and this returns {}.
+        """
+        manifest_path = os.path.join(self.path, MANIFEST_FILE)
+        if self.resume and os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                if json.load(f)["fingerprint"] != fingerprint:
+                    raise ValueError(
+                        f"The checkpoint in {self.path} is for a different model or stimuli; "
+                        "rerun without --resume to start over")
+        else:
+            shutil.rmtree(self.path, ignore_errors=True)
+            os.makedirs(self.path)
+            with open(manifest_path, "w") as f:
+                json.dump({"fingerprint": fingerprint}, f)
+
+        result = {}
+        for shard_path in sorted(glob.glob(os.path.join(self.path, "shard_*.parquet"))):
+            shard = pd.read_parquet(shard_path)
+            for i, scores in zip(shard["stimulus_index"], shard["scores"]):
+                result[int(i)] = scores.tolist()
+        return result
+
+    def add_many(self, items):
+        """Adds (stimulus_index, scores) pairs, and writes a shard if interval_seconds have passed."""
+        self.pending.extend(items)
+        if time.time() - self.last_write_time >= self.interval_seconds:
+            self.write()
+
+    def write(self):
+        """Writes the scores added since the last write as a new shard."""
+        if self.pending:
+            shard_path = os.path.join(
+                self.path, f"shard_{len(glob.glob(os.path.join(self.path, 'shard_*.parquet'))):05d}.parquet")
+            with atomic_path(shard_path) as tmp_path:
+                pd.DataFrame(self.pending, columns=["stimulus_index", "scores"]).to_parquet(
+                    tmp_path, index=False)
+            self.pending = []
+        self.last_write_time = time.time()
+
+    def remove(self):
+        """Deletes the checkpoint (once the run's outputs have been written)."""
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+@contextlib.contextmanager
+def atomic_path(path):
+    """Yields a temporary path to write a file or directory to, which is renamed to path on success.
+
+    If the block raises, the temporary path is deleted and path is left unchanged.
+    """
+    tmp_path = path + ".tmp"
+    remove_path(tmp_path)
+    try:
+        yield tmp_path
+    except BaseException:
+        remove_path(tmp_path)
+        raise
+
+    if os.path.isdir(tmp_path) and os.path.isdir(path):
+        # Directories can't be renamed over non-empty directories, so swap them
+        old_path = path + ".old"
+        remove_path(old_path)
+        os.replace(path, old_path)
+        os.replace(tmp_path, path)
+        shutil.rmtree(old_path)
+    else:
+        os.replace(tmp_path, path)
@@ -0,0 +1,180 @@
+# Counting terms in locally stored text corpora.
+#
+# A corpus is a directory of files (or a single file), in any of these formats:
+#   * .arrow - Arrow IPC files with a text column, e.g. written by a Hugging Face
+#     dataset's save_to_disk(path, num_shards=...), or from its cache
+#   * .parquet - Parquet files with a text column
+#   * .jsonl - one JSON object per line, with a text field
+#   * .txt - one document per line
+# so counting works fully offline once the corpus is on disk.
+#
+# Each file is a shard. Shards are counted independently, by a pool of worker
+# processes (see bert_scoring/workers.py), and their counts are summed. Each
+# shard's counts are checkpointed (as JSON) as soon as it is counted, so an
+# interrupted run can be resumed with only the remaining shards to count. For a
+# corpus to be counted in parallel, it needs at least as many files as workers.
+
+import collections
+import glob
+import json
+import os
+import shutil
+
+from bert_scoring import checkpoint
+from bert_scoring import workers
+
+
+CORPUS_EXTENSIONS = [".arrow", ".parquet", ".jsonl", ".txt"]
+
+TEXT_COLUMN = "text"
+
+# Number of documents read at a time
+DEFAULT_BATCH_SIZE = 8192
+
+
+def get_corpus_files(corpus_path):
+    """Returns the paths of the shards of a corpus (a file, or a directory of files), in order."""
+    if os.path.isfile(corpus_path):
+        return [corpus_path]
+    paths = sorted(
+        path for path in glob.glob(os.path.join(corpus_path, "**", "*"), recursive=True)
+        if os.path.splitext(path)[1] in CORPUS_EXTENSIONS)
+    if not paths:
+        raise ValueError(f"{corpus_path} has no {', '.join(CORPUS_EXTENSIONS)} files")
+    return paths
+
+
+def iter_arrow_batches(path, text_column=TEXT_COLUMN, batch_size=DEFAULT_BATCH_SIZE):
+    """Yields the text column of an Arrow or Parquet file, as Arrow arrays of up to batch_size documents."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if path.endswith(".parquet"):
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size, columns=[text_column]):
+            yield batch.column(text_column)
+        return
+
+    # Hugging Face datasets write the IPC stream format; other tools write the file format
+    with pa.memory_map(path) as source:
+        try:
+            reader = pa.ipc.open_stream(source)
+            batches = iter(reader)
+        except pa.ArrowInvalid:
+            source.seek(0)
+            reader = pa.ipc.open_file(source)
+            batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+        for batch in batches:
+            column = batch.column(batch.schema.get_field_index(text_column))
+            for start in range(0, len(column), batch_size):
+                yield column.slice(start, batch_size)
+
+
+def iter_texts(path, text_column=TEXT_COLUMN):
+    """Yields the documents of a corpus file, as strings."""
+    if path.endswith(".jsonl"):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)[text_column]
+    elif path.endswith(".txt"):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                yield line.rstrip("\n")
+    else:
+        for column in iter_arrow_batches(path, text_column):
+            for text in column.to_pylist():
+                if text is not None:
+                    yield text
+
+
+def iter_text_batches(path, text_column=TEXT_COLUMN, batch_size=DEFAULT_BATCH_SIZE):
+    """Yields the documents of a corpus file, as Arrow string arrays of up to batch_size documents.
+
+    Arrow and Parquet files are read without converting their documents to Python strings.
+    """
+    import pyarrow as pa
+
+    if os.path.splitext(path)[1] in [".arrow", ".parquet"]:
+        yield from iter_arrow_batches(path, text_column, batch_size)
+        return
+    batch = []
+    for text in iter_texts(path, text_column):
+        batch.append(text)
+        if len(batch) == batch_size:
+            yield pa.array(batch, type=pa.string())
+            batch = []
+    if batch:
+        yield pa.array(batch, type=pa.string())
+
+
+def get_corpus_fingerprint(paths, *parts):
+    """Returns a fingerprint of the corpus files (their paths, sizes and modification times) and parts."""
+    files = [(os.path.abspath(path), os.path.getsize(path), os.path.getmtime(path)) for path in paths]
+    return checkpoint.get_fingerprint(files, *parts)
+
+
+def open_checkpoint(checkpoint_path, fingerprint, resume=False):
+    """Creates the checkpoint directory of a run over a corpus, with the run's fingerprint.
+
+    When resuming, an existing checkpoint (for the same fingerprint) is kept;
+    otherwise, any existing checkpoint is discarded.
+    """
+    manifest_path = os.path.join(checkpoint_path, checkpoint.MANIFEST_FILE)
+    if resume and os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            if json.load(f)["fingerprint"] != fingerprint:
+                raise ValueError(
+                    f"The checkpoint in {checkpoint_path} is for a different corpus or terms; "
+                    "rerun without --resume to start over")
+    else:
+        shutil.rmtree(checkpoint_path, ignore_errors=True)
+        os.makedirs(checkpoint_path)
+        with open(manifest_path, "w") as f:
+            json.dump({"fingerprint": fingerprint}, f)
+
+
+def load_counted_files(checkpoint_path, fingerprint, resume=False):
+    """Returns {file index: Counter} for the files checkpointed in checkpoint_path.
+
+    Unless resuming, any existing checkpoint is discarded and this returns {}.
+    """
+    open_checkpoint(checkpoint_path, fingerprint, resume=resume)
+    counted_files = {}
+    for path in glob.glob(os.path.join(checkpoint_path, "file_*.json")):
+        with open(path) as f:
+            counted_files[int(os.path.basename(path)[len("file_"):-len(".json")])] = \
+                collections.Counter(json.load(f))
+    return counted_files
+
+
+def count_corpus(corpus_path, count_file, n_workers=1, checkpoint_path=None, resume=False,
+                 options=None):
+    """Returns a Counter of terms in a corpus, counting its files with n_workers processes.
+
+    count_file(path) returns a Counter for one corpus file; it may be a closure. If
+    checkpoint_path is given, each file's counts are checkpointed there as soon as
+    it is counted, and with resume, files counted by a previous run (of the same
+    corpus, with the same options, e.g. the terms) are not recounted.
+    """
+    paths = get_corpus_files(corpus_path)
+    counted_files = {}
+    if checkpoint_path is not None:
+        counted_files = load_counted_files(
+            checkpoint_path, get_corpus_fingerprint(paths, options), resume=resume)
+
+    tasks = [(i, path) for i, path in enumerate(paths) if i not in counted_files]
+    results = workers.imap(
+        lambda task: count_file(task[1]), tasks, n_workers=n_workers, threads_per_worker=1,
+        get_size=lambda task: os.path.getsize(task[1]) / 1e6, unit="MB")
+    for (i, path), file_counts in results:
+        if checkpoint_path is not None:
+            with checkpoint.atomic_path(os.path.join(checkpoint_path, f"file_{i:05d}.json")) as tmp_path:
+                with open(tmp_path, "w") as f:
+                    json.dump(file_counts, f)
+        counted_files[i] = file_counts
+        print(f"Counted {path} ({len(paths) - len(counted_files)} files left)")
+
+    counts = collections.Counter()
+    for file_counts in counted_files.values():
+        counts.update(file_counts)
+    return counts
@@ -0,0 +1,154 @@
+# Checking how much reduced-precision inference changes the scores.
+#
+# Before a scoring run at a reduced precision (see models.PRECISIONS), the
+# scoring scripts score a reference subset of their stimuli (evenly spaced
+# through the stimuli file, so every name, role noun and condition is included)
+# with both the fp32 model and the reduced-precision model, and report:
+#   * the maximum (and mean) absolute error of the log probabilities
+#   * the Spearman rank correlation between the two sets of log probabilities
+# The report is printed and saved as JSON next to the result store.
+#
+# How much this moves the published results (the part_3b log-likelihood tables,
+# and the part_4 cluster correlations for Camilliere et al.) can only be seen by
+# rerunning the downstream steps, which need the experimental data. To compare
+# the results of an fp32 run and a reduced-precision run, run (from the repository root):
+#   python -m bert_scoring.fidelity <fp32 results> <reduced-precision results>
+# where the results are CSV files or directories of CSV files (e.g., results/).
+
+import argparse
+import glob
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.stats import spearmanr
+
+from bert_scoring import masked_lm
+from bert_scoring import models
+from bert_scoring import pll
+
+
+# Number of stimuli in the reference subset
+DEFAULT_REFERENCE_SIZE = 256
+
+
+def get_reference_indices(n_stimuli, size=DEFAULT_REFERENCE_SIZE):
+    """Returns the indices of size evenly spaced stimuli (or of all stimuli, if there are fewer)."""
+    if n_stimuli == 0:
+        return []
+    return sorted(set(np.linspace(0, n_stimuli - 1, min(size, n_stimuli)).round().astype(int).tolist()))
+
+
+def get_reference_rows(rows, n_rows, size=DEFAULT_REFERENCE_SIZE):
+    """Returns the rows at get_reference_indices(n_rows, size) of an iterable of n_rows rows."""
+    indices = set(get_reference_indices(n_rows, size))
+    return [row for i, row in enumerate(rows) if i in indices]
+
+
+def to_log_probabilities(probabilities):
+    # Probabilities that underflowed to 0 are clipped, so errors stay finite
+    return np.log(np.maximum(np.asarray(probabilities, dtype=np.float64), np.finfo(np.float64).tiny))
+
+
+def compare_log_probabilities(reference, candidate):
+    """Compares two parallel arrays of log probabilities (of the same scores)."""
+    reference = np.asarray(reference, dtype=np.float64)
+    candidate = np.asarray(candidate, dtype=np.float64)
+    errors = np.abs(candidate - reference)
+    return {
+        "n_scores": len(reference),
+        "max_abs_log_probability_error": float(errors.max()),
+        "mean_abs_log_probability_error": float(errors.mean()),
+        "spearman_rank_correlation": float(spearmanr(reference, candidate).correlation),
+    }
+
+
+def write_report(comparison, model, n_stimuli, report_path):
+    report = dict(
+        {"precision": models.get_precision(model), "reference_precision": "fp32",
+         "n_stimuli": n_stimuli},
+        **comparison)
+    print(f"Fidelity of {report['precision']} vs. fp32 on {n_stimuli} reference stimuli "
+          f"({report['n_scores']} scores): "
+          f"max |log p error|={report['max_abs_log_probability_error']:.4g}, "
+          f"mean |log p error|={report['mean_abs_log_probability_error']:.4g}, "
+          f"Spearman rho={report['spearman_rank_correlation']:.6f}")
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def check_variant_probabilities(
+        stimuli, variants, tokenizer, model, reference_model, report_path,
+        within_set=False, size=DEFAULT_REFERENCE_SIZE):
+    """Compares masked_lm.get_masked_variant_probabilities for model and reference_model.
+
+    Only a reference subset of the stimuli is scored (without the score cache).
+    Returns the report, which is also written as JSON to report_path.
+    """
+    indices = get_reference_indices(len(stimuli), size)
+    log_probabilities = []
+    for curr_model in [reference_model, model]:
+        probabilities = masked_lm.get_masked_variant_probabilities(
+            [stimuli[i] for i in indices], [variants[i] for i in indices], tokenizer, curr_model,
+            device=models.get_model_device(curr_model), within_set=within_set)
+        log_probabilities.append(to_log_probabilities(
+            [p for curr_probabilities in probabilities for p in curr_probabilities.values()]))
+    return write_report(compare_log_probabilities(*log_probabilities), model, len(indices), report_path)
+
+
+def check_masked_token_log_probabilities(
+        stimuli, tokenizer, model, reference_model, report_path, size=DEFAULT_REFERENCE_SIZE):
+    """Compares pll.get_masked_token_log_probabilities for model and reference_model.
+
+    Only a reference subset of the stimuli is scored (without the score cache).
+    Returns the report, which is also written as JSON to report_path.
+    """
+    indices = get_reference_indices(len(stimuli), size)
+    log_probabilities = []
+    for curr_model in [reference_model, model]:
+        sentence_results = pll.get_masked_token_log_probabilities(
+            [stimuli[i] for i in indices], tokenizer, curr_model,
+            device=models.get_model_device(curr_model))
+        log_probabilities.append(
+            [p for sentence_result in sentence_results for p in sentence_result["log_probabilities"]])
+    return write_report(compare_log_probabilities(*log_probabilities), model, len(indices), report_path)
+
+
+def compare_tables(reference_path, candidate_path):
+    """Returns the largest absolute change in each numeric column between two results.
+
+    The results are CSV files, or directories of CSV files (compared by file name).
+    Returns a data frame with columns table, column, max_abs_change.
+    """
+    if os.path.isdir(reference_path):
+        table_paths = [
+            (os.path.basename(path), path, os.path.join(candidate_path, os.path.basename(path)))
+            for path in sorted(glob.glob(os.path.join(reference_path, "*.csv")))]
+    else:
+        table_paths = [(os.path.basename(reference_path), reference_path, candidate_path)]
+
+    rows = []
+    for table, curr_reference_path, curr_candidate_path in table_paths:
+        reference = pd.read_csv(curr_reference_path)
+        candidate = pd.read_csv(curr_candidate_path)
+        if reference.shape != candidate.shape or list(reference.columns) != list(candidate.columns):
+            raise ValueError(f"{curr_reference_path} and {curr_candidate_path} have different shapes")
+        for column in reference.select_dtypes("number").columns:
+            rows.append({
+                "table": table,
+                "column": column,
+                "max_abs_change": (candidate[column] - reference[column]).abs().max(),
+            })
+    return pd.DataFrame(rows, columns=["table", "column", "max_abs_change"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="compare the results of an fp32 run with those of a reduced-precision run")
+    parser.add_argument("reference", help="a CSV file or directory of CSV files from the fp32 run")
+    parser.add_argument("candidate", help="the corresponding CSV file or directory from the other run")
+    args = parser.parse_args()
+    with pd.option_context("display.max_rows", None, "display.width", None):
+        print(compare_tables(args.reference, args.candidate).to_string(index=False))
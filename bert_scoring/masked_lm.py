@@ -0,0 +1,241 @@
+# Batched masked language model scoring.
+#
+# Rather than running one forward pass per stimulus, stimuli are tokenized up
+# front and grouped by tokenized length. Each group is split into batches of
+# batch_size sentences, so a batch needs little or no padding, and the [MASK]
+# positions for the whole batch are found with a single tensor op.
+#
+# Only the rows at [MASK] positions are ever used, so the MLM prediction head
+# (including the projection onto the ~30k word piece vocabulary) is only applied
+# to the encoder's hidden states at those positions.
+#
+# In "within-set" mode, only the logits of the candidate word pieces are computed
+# (a dot product with a few rows of the decoder matrix), and probabilities are
+# normalized over the candidates rather than over the full vocabulary.
+#
+# If a ScoreCache (see bert_scoring/cache.py) is given, stimuli that were already
+# scored (by any pipeline) are looked up, and only the misses are run through BERT.
+# If a Checkpoint (see bert_scoring/checkpoint.py) is given, scores are periodically
+# checkpointed, and stimuli scored by an interrupted run are not scored again.
+# With n_workers > 1, batches are scored by a pool of forked worker processes
+# (see bert_scoring/workers.py). With packed_row_length, the stimuli of each batch
+# are packed into rows of that many tokens (see bert_scoring/packing.py).
+
+import collections
+
+import torch
+import tqdm
+
+from bert_scoring import backends
+from bert_scoring import cache
+from bert_scoring import checkpoint
+from bert_scoring import models
+from bert_scoring import packing
+from bert_scoring import tokenization
+from bert_scoring import workers
+
+
+DEFAULT_BATCH_SIZE = 64
+
+
+def tokenize_stimuli(stimuli, tokenizer):
+    """Returns a list of input id lists (including [CLS] and [SEP]), one per stimulus.
+
+    Tokenizations are cached on disk (see bert_scoring/tokenization.py).
+    """
+    return tokenization.encode(stimuli, tokenizer)
+
+
+def get_length_batches(tokenized_stimuli, batch_size=DEFAULT_BATCH_SIZE, indices=None):
+    """Yields lists of stimulus indices, where all stimuli in a list have the same length.
+
+    Each list has at most batch_size indices. If indices is given, only those
+    stimuli are batched.
+    """
+    if indices is None:
+        indices = range(len(tokenized_stimuli))
+    length_to_indices = collections.defaultdict(list)
+    for i in indices:
+        length_to_indices[len(tokenized_stimuli[i])].append(i)
+
+    for length in sorted(length_to_indices):
+        indices = length_to_indices[length]
+        for start in range(0, len(indices), batch_size):
+            yield indices[start:start + batch_size]
+
+
+def pad_batch(input_ids_list, pad_token_id):
+    """Pads a list of input id lists into the tensors expected by BertForMaskedLM."""
+    max_length = max(len(input_ids) for input_ids in input_ids_list)
+    input_ids = torch.full((len(input_ids_list), max_length), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(input_ids_list), max_length), dtype=torch.long)
+    for i, curr_input_ids in enumerate(input_ids_list):
+        input_ids[i, :len(curr_input_ids)] = torch.tensor(curr_input_ids, dtype=torch.long)
+        attention_mask[i, :len(curr_input_ids)] = 1
+
+    return {
+        "input_ids": input_ids,
+        "token_type_ids": torch.zeros_like(input_ids),
+        "attention_mask": attention_mask,
+    }
+
+
+def get_mask_positions(input_ids, mask_token_id):
+    """Returns (row_indices, column_indices) of every [MASK] token in input_ids."""
+    return torch.nonzero(input_ids == mask_token_id, as_tuple=True)
+
+
+def get_masked_log_probabilities(model, batch, mask_rows, mask_columns):
+    """Returns log-softmax over the vocabulary at each of the given [MASK] positions.
+
+    model is a BertForMaskedLM, run at its precision (see bert_scoring/models.py).
+    The encoder is run on the whole batch (with the model's backend; see
+    bert_scoring/backends.py), but the prediction head is only
+    applied to the hidden states at (mask_rows, mask_columns),
+    so the result has shape [n_masks, vocab_size] rather than
+    [batch_size, sentence_length, vocab_size].
+    """
+    with models.autocast(model):
+        hidden_states = backends.encode(model, batch)  # [batch_size, sentence_length, hidden_size]
+        masked_hidden_states = hidden_states[mask_rows, mask_columns]
+        logits = model.cls(masked_hidden_states)  # [n_masks, vocab_size]
+    return torch.nn.functional.log_softmax(logits.float(), dim=-1)
+
+
+def get_candidate_logits(model, batch, mask_rows, mask_columns, candidate_ids):
+    """Returns the logits of the candidate word pieces at each of the given [MASK] positions.
+
+    candidate_ids has shape [n_masks, n_candidates]. Entries of -1 are padding, and
+    get a logit of -inf. The full-vocabulary projection is never computed.
+    """
+    with models.autocast(model):
+        hidden_states = backends.encode(model, batch)  # [batch_size, sentence_length, hidden_size]
+        predictions = model.cls.predictions
+        masked_hidden_states = predictions.transform(hidden_states[mask_rows, mask_columns])
+
+    is_padding = candidate_ids < 0
+    candidate_ids = candidate_ids.masked_fill(is_padding, 0)
+    candidate_weights = predictions.decoder.weight[candidate_ids]  # [n_masks, n_candidates, hidden_size]
+    logits = torch.einsum("mh,mch->mc", masked_hidden_states.float(), candidate_weights)
+    logits = logits + predictions.decoder.bias[candidate_ids]
+    return logits.masked_fill(is_padding, float("-inf"))
+
+
+def pad_candidate_ids(candidate_id_lists):
+    """Pads lists of candidate ids (of varying lengths) with -1 into a single tensor."""
+    n_candidates = max(len(candidate_ids) for candidate_ids in candidate_id_lists)
+    result = torch.full((len(candidate_id_lists), n_candidates), -1, dtype=torch.long)
+    for i, candidate_ids in enumerate(candidate_id_lists):
+        result[i, :len(candidate_ids)] = torch.tensor(candidate_ids, dtype=torch.long)
+    return result
+
+
+@torch.no_grad()
+def get_masked_variant_probabilities(
+        stimuli, variants, tokenizer, model, device="cpu",
+        batch_size=DEFAULT_BATCH_SIZE, within_set=False, score_cache=None, run_checkpoint=None,
+        n_workers=1, threads_per_worker=None, packed_row_length=None, input_ids=None):
+    """Computes the probability of each variant at the single [MASK] in each stimulus.
+
+    stimuli is a list of sentences containing exactly one [MASK], and variants is a
+    list (parallel to stimuli) of the word pieces to look up at the mask.
+    Returns a list (in the same order as stimuli) of {variant: probability} dicts.
+
+    By default, these are probabilities over the full vocabulary. If within_set is
+    True, they are normalized over the variants of each stimulus instead (so they
+    sum to 1 for each stimulus), and the full-vocabulary softmax is skipped.
+
+    If score_cache (a cache.ScoreCache) is given, only stimuli missing from it are
+    scored. If run_checkpoint (a checkpoint.Checkpoint) is given, scores are
+    checkpointed as they are computed, and checkpointed stimuli are not rescored.
+
+    If n_workers > 1, batches are scored by n_workers processes (see bert_scoring/workers.py),
+    each using threads_per_worker threads. If packed_row_length is given, the stimuli
+    of each batch are packed into rows of packed_row_length tokens. If input_ids (a
+    list of the stimuli's input id lists, e.g. from bert_scoring/templates.py) is
+    given, the stimuli aren't tokenized.
+    """
+    tokenized_stimuli = input_ids
+    if tokenized_stimuli is None:
+        tokenized_stimuli = tokenize_stimuli(stimuli, tokenizer)
+    variant_ids = [
+        [tokenizer.vocab[variant] for variant in curr_variants]
+        for curr_variants in variants]
+    kind = "within_set" if within_set else "vocabulary"
+
+    result = [None] * len(stimuli)
+    if score_cache is not None:
+        model_key = cache.get_model_key(model, tokenizer)
+        keys = [
+            cache.make_key(
+                model_key, kind, input_ids,
+                [j for j, token_id in enumerate(input_ids) if token_id == tokenizer.mask_token_id],
+                curr_variant_ids)
+            for input_ids, curr_variant_ids in zip(tokenized_stimuli, variant_ids)]
+        cached_scores = score_cache.get_many(keys)
+        for i, key in enumerate(keys):
+            if key in cached_scores:
+                result[i] = dict(zip(variants[i], cached_scores[key]))
+    cache_miss_indices = [i for i, probabilities in enumerate(result) if probabilities is None]
+
+    if run_checkpoint is not None:
+        fingerprint = checkpoint.get_fingerprint(
+            cache.get_model_key(model, tokenizer), kind, tokenized_stimuli, variant_ids)
+        for i, scores in run_checkpoint.load(fingerprint).items():
+            result[i] = dict(zip(variants[i], scores))
+    missing_indices = [i for i, probabilities in enumerate(result) if probabilities is None]
+
+    @torch.no_grad()
+    def score_batch(batch_indices):
+        """Returns a list of the variant probabilities of each stimulus in batch_indices."""
+        input_ids_list = [tokenized_stimuli[i] for i in batch_indices]
+        if packed_row_length is None:
+            batch = pad_batch(input_ids_list, tokenizer.pad_token_id)
+        else:
+            # Many stimuli per row, each only attending to itself
+            batch, rows, starts = packing.pack_batch(
+                input_ids_list, packed_row_length, tokenizer.pad_token_id)
+        batch = {k: v.to(device) for k, v in batch.items()}
+
+        # Find the index for the masked word in every sentence of the batch
+        # (in stimulus order, since packed stimuli are in order within and across rows)
+        mask_rows, mask_columns = get_mask_positions(batch["input_ids"], tokenizer.mask_token_id)
+        if packed_row_length is None:
+            assert torch.equal(mask_rows.cpu(), torch.arange(len(batch_indices))), \
+                "There should be exactly one masked token per stimulus"
+        else:
+            assert torch.equal(mask_rows.cpu(), rows), \
+                "There should be exactly one masked token per stimulus"
+
+        if within_set:
+            # Probabilities over the variants only
+            candidate_ids = pad_candidate_ids([variant_ids[i] for i in batch_indices])
+            candidate_logits = get_candidate_logits(
+                model, batch, mask_rows, mask_columns, candidate_ids.to(device))
+            candidate_probabilities = torch.nn.functional.softmax(candidate_logits, dim=-1).cpu()
+            return [
+                candidate_probabilities[row, :len(variants[i])].tolist()
+                for row, i in enumerate(batch_indices)]
+        else:
+            # Probabilities over the full vocabulary
+            masked_probabilities = get_masked_log_probabilities(
+                model, batch, mask_rows, mask_columns).exp().cpu()
+            return [
+                masked_probabilities[row, variant_ids[i]].tolist()
+                for row, i in enumerate(batch_indices)]
+
+    batches = list(get_length_batches(tokenized_stimuli, batch_size, indices=missing_indices))
+    scored_batches = workers.imap(
+        score_batch, batches, n_workers=n_workers, threads_per_worker=threads_per_worker)
+    for batch_indices, batch_scores in tqdm.tqdm(scored_batches, total=len(batches)):
+        for i, scores in zip(batch_indices, batch_scores):
+            result[i] = dict(zip(variants[i], scores))
+        if run_checkpoint is not None:
+            run_checkpoint.add_many(zip(batch_indices, batch_scores))
+    if run_checkpoint is not None:
+        run_checkpoint.write()
+
+    if score_cache is not None:
+        score_cache.put_many(
+            (keys[i], [result[i][variant] for variant in variants[i]]) for i in cache_miss_indices)
+    return result
@@ -0,0 +1,233 @@
+# Counting whole-word occurrences of many terms in one pass.
+#
+# Counting terms with a case-insensitive regex alternation
+# (\bterm_1\b|\bterm_2\b|..., with re.IGNORECASE) tries every alternative, with
+# case folding, at every position of the text. Instead, TermMatcher lowercases
+# each text once, splits it into words (maximal runs of \w characters) with one
+# linear scan, and looks each word up in a hash set of the single-word terms, all
+# in native code. Multi-word terms (e.g., "flight attendant") are found with a
+# case-sensitive regex over the lowercased text.
+#
+# The counts are the same as those of the regex, with the matches lowercased:
+#   * \bterm\b matches exactly the words equal to term
+#   * lowercasing doesn't change which characters are word characters, or the
+#     length of the text, except for a few characters that the regex treats as
+#     equal to ASCII letters (CASE_FOLDING_CHARACTERS, e.g. the dotted capital I).
+#     Texts with those are counted with the regex.
+# Terms must be lowercase words separated by single spaces, and no word of a
+# multi-word term may also be a single-word term (so matches never overlap).
+#
+# ArrowTermMatcher counts the same terms over Arrow string arrays (e.g. record
+# batches of a memory-mapped corpus file, see bert_scoring/corpus.py) with
+# pyarrow.compute kernels, so documents are never converted to Python strings.
+# Each batch is lowercased; in the texts that contain a term at all, one regex
+# replace wraps each word containing a term in markers, and the marked words that
+# equal a term are counted with value_counts. RE2 has no lookarounds, so a
+# phrase's count is its occurrences preceded by a non-word character, less those
+# also followed by a word character. RE2's Unicode classes follow an older version
+# of Unicode than Python's, so word characters are matched with a class built
+# from Python's definition (get_word_class). Texts with CASE_FOLDING_CHARACTERS
+# (including the only character utf8_lower lowercases differently from str.lower)
+# are counted with the regex.
+#
+# To compare the three on a synthetic corpus, run (from the repository root)
+#   python -m bert_scoring.matching term_1 term_2 ...
+
+import argparse
+import collections
+import functools
+import random
+import re
+import sys
+import time
+
+
+WORD_PATTERN = re.compile(r"\w+")
+
+# Non-ASCII characters that re.IGNORECASE matches to ASCII letters, or whose
+# lowercase changes the length of the text (found by checking every code point)
+CASE_FOLDING_CHARACTERS = ["İ", "ı", "ſ", "K"]
+
+
+@functools.lru_cache(maxsize=None)
+def get_word_class():
+    """Returns an RE2 character class of exactly the characters Python's \\w matches."""
+    ranges = []
+    for code_point in range(sys.maxunicode + 1):
+        if chr(code_point).isalnum() or chr(code_point) == "_":
+            if ranges and ranges[-1][1] == code_point - 1:
+                ranges[-1][1] = code_point
+            else:
+                ranges.append([code_point, code_point])
+    return "[" + "".join(
+        f"\\x{{{start:x}}}" if start == end else f"\\x{{{start:x}}}-\\x{{{end:x}}}"
+        for start, end in ranges) + "]"
+
+
+def get_query(terms):
+    """Returns the regex alternation matching each of terms as a whole word."""
+    return "|".join([r"\b" + re.escape(term) + r"\b" for term in terms])
+
+
+def count_with_regex(texts, query):
+    """Counts the lowercased matches of query in texts, with re.IGNORECASE."""
+    counter = collections.Counter()
+    for text in texts:
+        occurrences = re.findall(query, text, flags=re.IGNORECASE)
+        counter.update([item.lower() for item in occurrences])
+    return counter
+
+
+class TermMatcher:
+    """Counts whole-word occurrences of terms, ignoring case, in one pass over each text."""
+
+    def __init__(self, terms):
+        self.terms = list(terms)
+        self.single_terms = {term for term in self.terms if " " not in term}
+        phrases = [term for term in self.terms if " " in term]
+        for term in self.terms:
+            if term != term.lower() or term.split(" ") != WORD_PATTERN.findall(term):
+                raise ValueError(f"{term!r} isn't lowercase words separated by single spaces")
+        for phrase in phrases:
+            if self.single_terms.intersection(phrase.split(" ")):
+                raise ValueError(f"A word of {phrase!r} is also a term")
+        self.phrase_pattern = re.compile(get_query(phrases)) if phrases else None
+        self.query = get_query(self.terms)
+
+    def update(self, counter, text):
+        """Adds the occurrences of the terms in text to counter."""
+        if not text.isascii() and any(character in text for character in CASE_FOLDING_CHARACTERS):
+            counter.update(count_with_regex([text], self.query))
+            return
+        lowered = text.lower()
+        counter.update(filter(self.single_terms.__contains__, WORD_PATTERN.findall(lowered)))
+        if self.phrase_pattern is not None:
+            counter.update(self.phrase_pattern.findall(lowered))
+
+    def count(self, texts):
+        """Returns a Counter of the terms in texts."""
+        counter = collections.Counter()
+        for text in texts:
+            self.update(counter, text)
+        return counter
+
+
+class ArrowTermMatcher:
+    """Counts whole-word occurrences of terms, ignoring case, in Arrow string arrays."""
+
+    def __init__(self, terms):
+        import pyarrow as pa
+
+        # Phrases like "x x" can overlap themselves, which the counts below don't handle
+        for term in terms:
+            if len(set(term.split(" "))) < len(term.split(" ")):
+                raise ValueError(f"{term!r} repeats a word")
+        self.matcher = TermMatcher(terms)
+        word_class = get_word_class()
+        non_word_class = "[^" + word_class[1:]
+        single_terms = sorted(self.matcher.single_terms)
+        phrases = [term for term in self.matcher.terms if " " in term]
+        self.fallback_pattern = "[" + "".join(CASE_FOLDING_CHARACTERS) + r"\x00]"
+        self.single_terms = pa.array(single_terms, type=pa.string())
+        self.single_term_pattern = "|".join(single_terms)
+        # Each word containing a term (the words are then matched exactly)
+        self.candidate_pattern = "{0}*(?:{1}){0}*".format(word_class, self.single_term_pattern)
+        self.phrase_pattern = "|".join(phrases)
+        self.phrase_patterns = [
+            (term, non_word_class + term, non_word_class + term + word_class) for term in phrases]
+
+    def update(self, counter, column):
+        """Adds the occurrences of the terms in column (an Arrow string array) to counter."""
+        import pyarrow.compute as pc
+
+        # Texts that the kernels would count differently (or that contain the marker)
+        needs_regex = pc.match_substring_regex(column, self.fallback_pattern)
+        if pc.any(needs_regex).as_py():
+            for text in column.filter(needs_regex).to_pylist():
+                self.matcher.update(counter, text)
+            column = column.filter(pc.invert(needs_regex))
+        lowered = pc.utf8_lower(column)
+
+        if self.single_term_pattern:
+            texts = lowered.filter(pc.match_substring_regex(lowered, self.single_term_pattern))
+            # Wrap the candidate words in NUL markers, so they're every other piece when split
+            marked = pc.replace_substring_regex(texts, self.candidate_pattern, "\x00\\0\x00")
+            words = pc.list_flatten(pc.list_slice(pc.split_pattern(marked, "\x00"), 1, None, 2))
+            words = words.filter(pc.is_in(words, value_set=self.single_terms))
+            for item in pc.value_counts(words).to_pylist():
+                counter[item["values"]] += item["counts"]
+
+        if self.phrase_pattern:
+            texts = lowered.filter(pc.match_substring_regex(lowered, self.phrase_pattern))
+            # The kernels count by searching the rest of the text after each match, where ^
+            # would match again, so the texts start with a space instead
+            texts = pc.utf8_replace_slice(texts, 0, 0, " ")
+            for phrase, pattern, followed_pattern in self.phrase_patterns:
+                count = (pc.sum(pc.count_substring_regex(texts, pattern)).as_py() or 0) - \
+                    (pc.sum(pc.count_substring_regex(texts, followed_pattern)).as_py() or 0)
+                if count > 0:
+                    counter[phrase] += count
+
+    def count(self, columns):
+        """Returns a Counter of the terms in columns (Arrow string arrays)."""
+        counter = collections.Counter()
+        for column in columns:
+            self.update(counter, column)
+        return counter
+
+
+def make_synthetic_corpus(terms, n_documents, seed=0):
+    """Returns a list of n_documents random texts, with terms in varied case, affixes and punctuation."""
+    rng = random.Random(seed)
+    filler = "the of and a in to was is for on that by with as at from his her it an were".split()
+    prefixes = ["", "", "", "(", "\"", "super", "anti-", "_", "é"]
+    suffixes = ["", "", "", "s", ".", ",", "'s", "ship", ")", "_", "2", "  ", "\n"]
+    casings = [str.lower, str.lower, str.title, str.upper]
+
+    def get_word():
+        if rng.random() < 0.05:
+            return rng.choice(prefixes) + rng.choice(casings)(rng.choice(terms)) + rng.choice(suffixes)
+        return rng.choice(filler)
+
+    texts = [" ".join(get_word() for _ in range(rng.randint(5, 300))) for _ in range(n_documents)]
+    # Characters that only match with case folding
+    texts.append(" ".join(
+        term.upper().replace("I", "İ") + " " + term.replace("i", "ı").replace("s", "ſ")
+        for term in terms))
+    return texts
+
+
+def benchmark(terms, n_documents=20000):
+    """Counts a synthetic corpus with the regex, TermMatcher and ArrowTermMatcher, and checks that the counts agree."""
+    texts = make_synthetic_corpus(terms, n_documents)
+    start_time = time.time()
+    regex_counts = count_with_regex(texts, get_query(terms))
+    regex_seconds = time.time() - start_time
+    start_time = time.time()
+    matcher_counts = TermMatcher(terms).count(texts)
+    matcher_seconds = time.time() - start_time
+    if matcher_counts != regex_counts:
+        raise ValueError("TermMatcher's counts differ from the regex's")
+    print(f"{len(texts)} documents, {sum(regex_counts.values())} matches: "
+          f"regex {regex_seconds:.2f}s, TermMatcher {matcher_seconds:.2f}s "
+          f"(speedup {regex_seconds / matcher_seconds:.1f}x), identical counts")
+
+    import pyarrow as pa
+
+    columns = [pa.array(texts[start:start + 8192], type=pa.string()) for start in range(0, len(texts), 8192)]
+    start_time = time.time()
+    arrow_counts = ArrowTermMatcher(terms).count(columns)
+    arrow_seconds = time.time() - start_time
+    if arrow_counts != regex_counts:
+        raise ValueError("ArrowTermMatcher's counts differ from the regex's")
+    print(f"ArrowTermMatcher {arrow_seconds:.2f}s "
+          f"(speedup {regex_seconds / arrow_seconds:.1f}x), identical counts")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="compare TermMatcher and ArrowTermMatcher with a case-insensitive regex on a synthetic corpus")
+    parser.add_argument("terms", nargs="+")
+    parser.add_argument("--documents", type=int, default=20000)
+    args = parser.parse_args()
+    benchmark(args.terms, args.documents)
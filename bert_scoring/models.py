@@ -0,0 +1,120 @@
+# A process-wide registry of BERT models and tokenizers.
+#
+# Nothing is loaded when this module is imported (transformers itself is only
+# imported on first use), so scripts that only analyze scores start quickly.
+# The first call to get_tokenizer or get_model for a model downloads a local
+# snapshot of its files (only the safetensors weights, not the other formats),
+# unless it is already cached. Later calls return the same object.
+#
+# Weights are loaded from model.safetensors, which is memory-mapped rather than
+# read into a separate buffer.
+#
+# Models can be run at reduced precision (see PRECISIONS). Since this changes the
+# scores slightly, the scoring scripts check how much on a reference subset first
+# (see bert_scoring/fidelity.py). The encoder can also be run with a compiled
+# backend (see bert_scoring/backends.py).
+
+import os
+
+
+MODEL_NAME = "bert-base-uncased"
+
+# The files needed to load the tokenizer and the PyTorch model
+SNAPSHOT_FILES = [
+    "config.json", "vocab.txt", "tokenizer_config.json", "special_tokens_map.json",
+    "model.safetensors"]
+
+# Inference precisions:
+#   * fp32 - full precision
+#   * bf16 - forward passes run under bfloat16 autocast
+#   * int8 - the encoder's linear layers are dynamically quantized to int8 (CPU only)
+PRECISIONS = ["fp32", "bf16", "int8"]
+
+SNAPSHOT_PATHS = {}
+TOKENIZERS = {}
+MODELS = {}
+
+
+def get_snapshot_path(model_name=MODEL_NAME):
+    """Returns the local directory with the model's files, downloading them if needed."""
+    if model_name not in SNAPSHOT_PATHS:
+        from huggingface_hub import snapshot_download
+        from huggingface_hub.utils import LocalEntryNotFoundError
+
+        try:
+            SNAPSHOT_PATHS[model_name] = snapshot_download(
+                model_name, allow_patterns=SNAPSHOT_FILES, local_files_only=True)
+        except LocalEntryNotFoundError:
+            SNAPSHOT_PATHS[model_name] = snapshot_download(model_name, allow_patterns=SNAPSHOT_FILES)
+    return SNAPSHOT_PATHS[model_name]
+
+
+def get_revision(model_name=MODEL_NAME):
+    """Returns the revision (commit hash) of the local snapshot of the model."""
+    return os.path.basename(os.path.normpath(get_snapshot_path(model_name)))
+
+
+def get_device():
+    import torch
+
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def get_tokenizer(model_name=MODEL_NAME):
+    """Returns the model's tokenizer, loading it on the first call.
+
+    The tokenizer splits sentences into word pieces (sometimes words are split
+    into multiple pieces), and maps word pieces to ids.
+    """
+    if model_name not in TOKENIZERS:
+        from transformers import BertTokenizer
+
+        get_snapshot_path(model_name)
+        TOKENIZERS[model_name] = BertTokenizer.from_pretrained(
+            model_name, do_lower_case=True, local_files_only=True)
+    return TOKENIZERS[model_name]
+
+
+def get_model(model_name=MODEL_NAME, precision="fp32", backend="eager"):
+    """Returns the BertForMaskedLM, in evaluation mode on get_device(), loading it on the first call.
+
+    The model takes in the ids and generates vector representations for each word piece.
+    precision is one of PRECISIONS, and backend is one of backends.BACKENDS; each
+    combination is a separate model object.
+    """
+    if (model_name, precision, backend) not in MODELS:
+        import torch
+        from transformers import BertForMaskedLM
+        from bert_scoring import backends
+
+        get_snapshot_path(model_name)
+        model = BertForMaskedLM.from_pretrained(
+            model_name, use_safetensors=True, local_files_only=True)
+        model.eval()  # This tells the model to behave in evaluation mode (not training mode)
+        if precision == "int8":
+            # Only the encoder is quantized, since the prediction head's decoder
+            # weights are also used directly (see masked_lm.get_candidate_logits)
+            model.bert = torch.ao.quantization.quantize_dynamic(
+                model.bert, {torch.nn.Linear}, dtype=torch.qint8)
+        else:
+            model = model.to(get_device())
+        model.scoring_precision = precision
+        model.scoring_backend = backends.get_backend(backend, model)
+        MODELS[(model_name, precision, backend)] = model
+    return MODELS[(model_name, precision, backend)]
+
+
+def get_precision(model):
+    return getattr(model, "scoring_precision", "fp32")
+
+
+def get_model_device(model):
+    return next(model.parameters()).device.type
+
+
+def autocast(model):
+    """Returns a context manager for running the model's forward passes at its precision."""
+    import torch
+
+    return torch.autocast(
+        get_model_device(model), dtype=torch.bfloat16, enabled=get_precision(model) == "bf16")
@@ -0,0 +1,82 @@
+# Sequence packing for short stimuli.
+#
+# The stimuli are only ~10 word pieces long, so even a batch without padding is
+# a stack of tiny sequences. In packed mode, the sequences of a batch are instead
+# concatenated (in order) into rows of row_length tokens, where:
+#   * position ids restart at 0 for each sequence
+#   * token type ids are 0 for each sequence (each is a single-segment input)
+#   * the attention mask is block-diagonal, so each sequence only attends to itself
+# The attention mask has shape [n_rows, row_length, row_length], which BERT
+# broadcasts over the attention heads as a 4D [n_rows, 1, row_length, row_length]
+# mask. The hidden states of a sequence's positions are the same as if it had been
+# run alone (up to floating-point error), so scores are unpacked by looking them
+# up at (row, start + position).
+
+import itertools
+
+import torch
+
+
+DEFAULT_ROW_LENGTH = 256
+
+
+def get_row_starts(lengths, row_length=DEFAULT_ROW_LENGTH):
+    """Assigns sequences of the given lengths, in order, to rows of at most row_length tokens.
+
+    Returns (rows, starts), the row of each sequence and its first column in that row.
+    A sequence longer than row_length gets a (longer) row of its own.
+    """
+    rows = []
+    starts = []
+    row = -1
+    end = row_length
+    for length in lengths:
+        if end + length > row_length:
+            row += 1
+            end = 0
+        rows.append(row)
+        starts.append(end)
+        end += length
+    return rows, starts
+
+
+def pack_batch(input_ids_list, row_length=DEFAULT_ROW_LENGTH, pad_token_id=0):
+    """Packs a list of input id lists into rows, for BertForMaskedLM.
+
+    Returns (batch, rows, starts), where batch is a dict of tensors (with position ids
+    and a block-diagonal attention mask), and sequence i is at columns
+    starts[i], ..., starts[i] + len(input_ids_list[i]) - 1 of row rows[i].
+    """
+    lengths = torch.tensor([len(input_ids) for input_ids in input_ids_list], dtype=torch.long)
+    rows, starts = get_row_starts(lengths.tolist(), row_length)
+    rows = torch.tensor(rows, dtype=torch.long)
+    starts = torch.tensor(starts, dtype=torch.long)
+    n_rows = int(rows[-1]) + 1
+    n_columns = max(row_length, int(lengths.max()))
+
+    # The row, column and segment (sequence index) of every token of every sequence
+    segments = torch.repeat_interleave(torch.arange(len(input_ids_list)), lengths)
+    positions = torch.arange(len(segments)) - torch.repeat_interleave(
+        torch.cumsum(lengths, 0) - lengths, lengths)
+    token_rows = rows[segments]
+    token_columns = starts[segments] + positions
+
+    input_ids = torch.full((n_rows, n_columns), pad_token_id, dtype=torch.long)
+    input_ids[token_rows, token_columns] = torch.tensor(
+        list(itertools.chain.from_iterable(input_ids_list)), dtype=torch.long)
+    position_ids = torch.zeros((n_rows, n_columns), dtype=torch.long)
+    position_ids[token_rows, token_columns] = positions
+    segment_ids = torch.full((n_rows, n_columns), -1, dtype=torch.long)
+    segment_ids[token_rows, token_columns] = segments
+
+    # Each token attends to the (non-padding) tokens of its own sequence
+    attention_mask = (
+        (segment_ids[:, :, None] == segment_ids[:, None, :]) & (segment_ids[:, None, :] >= 0))
+
+    batch = {
+        "input_ids": input_ids,
+        "token_type_ids": torch.zeros_like(input_ids),
+        "position_ids": position_ids,
+        "attention_mask": attention_mask.long(),
+    }
+    return batch, rows, starts
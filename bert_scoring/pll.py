@@ -0,0 +1,250 @@
+# Batched pseudo-log-likelihood (PLL) scoring, following Salazar et al. (2020).
+#
+# Each non-special token of a sentence is masked in turn, and the model predicts
+# the masked token. Rather than building the masked copies of one sentence at a
+# time, sentences of the same tokenized length are stacked into a block, and the
+# masked copies of the whole block are made with one indexed assignment. The
+# masked copies are then packed into batches of batch_size rows (across sentences),
+# and the log probability of each masked token is scattered back to its sentence.
+#
+# If a ScoreCache (see bert_scoring/cache.py) is given, sentences that were already
+# scored are looked up, so only new sentences are expanded and run through BERT.
+# If a Checkpoint (see bert_scoring/checkpoint.py) is given, the scores of completed
+# sentences are periodically checkpointed, so an interrupted run can be resumed.
+# With n_workers > 1, batches are scored by a pool of forked worker processes
+# (see bert_scoring/workers.py). With packed_row_length, the masked copies of each
+# batch are packed into rows of that many tokens (see bert_scoring/packing.py).
+# With excluded_spans, the tokens in a span of each sentence (e.g., the role noun,
+# whose scores part 2b would discard) are never masked, so their masked copies are
+# neither built nor run.
+#
+# get_sentence_scores sums the token log probabilities of each sentence into its
+# PLL (with and without e.g. the role noun's tokens), so scripts can write one row
+# per sentence rather than one row per masked token.
+
+import torch
+import tqdm
+
+from bert_scoring import cache
+from bert_scoring import checkpoint
+from bert_scoring import masked_lm
+from bert_scoring import packing
+from bert_scoring import workers
+
+
+DEFAULT_BATCH_SIZE = 256
+
+# Maximum number of sentences expanded into masked copies at once
+DEFAULT_BLOCK_SIZE = 1024
+
+
+def get_special_token_ids(tokenizer):
+    """Token ids that are never masked ([MASK], [CLS] and [SEP])."""
+    return [tokenizer.mask_token_id, tokenizer.cls_token_id, tokenizer.sep_token_id]
+
+
+def expand_masked_copies(input_ids, mask_token_id, special_token_ids, is_excluded=None):
+    """Builds the masked copies of a block of same-length sentences.
+
+    input_ids has shape [n_sentences, sentence_length]. Returns a tuple of
+    (masked_input_ids, sentence_indices, positions, target_ids), where row i of
+    masked_input_ids is sentence sentence_indices[i] with the token at
+    positions[i] (originally target_ids[i]) replaced by [MASK].
+    Special tokens, and tokens where is_excluded (a boolean tensor shaped like
+    input_ids) is True, are never masked.
+    """
+    is_scored = ~torch.isin(input_ids, torch.tensor(special_token_ids))
+    if is_excluded is not None:
+        is_scored &= ~is_excluded
+    sentence_indices, positions = torch.nonzero(is_scored, as_tuple=True)
+
+    # Only the copies that are scored are built: [n_scored, sentence_length]
+    masked_input_ids = input_ids[sentence_indices]
+    masked_input_ids[torch.arange(len(positions)), positions] = mask_token_id
+    return masked_input_ids, sentence_indices, positions, input_ids[sentence_indices, positions]
+
+
+def get_scored_positions(input_ids, special_token_ids, excluded_span=None):
+    """Returns the positions of input_ids that are masked and scored.
+
+    These are all non-special tokens, except those at positions start, ..., end - 1
+    if excluded_span is (start, end).
+    """
+    start, end = excluded_span if excluded_span is not None else (0, 0)
+    return [
+        j for j, token_id in enumerate(input_ids)
+        if token_id not in special_token_ids and not start <= j < end]
+
+
+def get_excluded_mask(spans, sentence_length):
+    """Returns a [len(spans), sentence_length] boolean tensor, True within each (start, end) span."""
+    spans = torch.tensor(spans, dtype=torch.long).reshape(-1, 2)
+    positions = torch.arange(sentence_length)
+    return (positions >= spans[:, :1]) & (positions < spans[:, 1:])
+
+
+def get_pll_batches(tokenized_stimuli, mask_token_id, special_token_ids,
+                    batch_size=DEFAULT_BATCH_SIZE, block_size=DEFAULT_BLOCK_SIZE, indices=None,
+                    excluded_spans=None):
+    """Yields (masked_input_ids, stimulus_indices, positions, target_ids) batches.
+
+    Each batch has at most batch_size rows. All rows of a batch have the same length,
+    so batches never need padding. Within a sentence, rows are in increasing position order.
+    If indices is given, only those stimuli are scored. If excluded_spans is given,
+    the tokens in each stimulus' (start, end) span aren't masked.
+    """
+    for block_indices in masked_lm.get_length_batches(tokenized_stimuli, block_size, indices=indices):
+        input_ids = torch.tensor([tokenized_stimuli[i] for i in block_indices], dtype=torch.long)
+        is_excluded = None
+        if excluded_spans is not None:
+            is_excluded = get_excluded_mask(
+                [excluded_spans[i] for i in block_indices], input_ids.shape[1])
+        masked_input_ids, sentence_indices, positions, target_ids = expand_masked_copies(
+            input_ids, mask_token_id, special_token_ids, is_excluded)
+        stimulus_indices = torch.tensor(block_indices, dtype=torch.long)[sentence_indices]
+
+        for start in range(0, masked_input_ids.shape[0], batch_size):
+            end = start + batch_size
+            yield (masked_input_ids[start:end], stimulus_indices[start:end],
+                   positions[start:end], target_ids[start:end])
+
+
+@torch.no_grad()
+def get_masked_token_log_probabilities(
+        stimuli, tokenizer, model, device="cpu",
+        batch_size=DEFAULT_BATCH_SIZE, block_size=DEFAULT_BLOCK_SIZE, score_cache=None,
+        run_checkpoint=None, n_workers=1, threads_per_worker=None, packed_row_length=None,
+        input_ids=None, excluded_spans=None):
+    """Computes the log probability of each non-special token when it is masked.
+
+    Returns a list (in the same order as stimuli) of dicts with keys:
+      * input_ids - the tokenized stimulus (including [CLS] and [SEP])
+      * masked_token_positions - the positions that were masked, in increasing order
+      * log_probabilities - the log probability of the original token at each of
+        those positions
+
+    If score_cache (a cache.ScoreCache) is given, only stimuli missing from it are
+    scored. If run_checkpoint (a checkpoint.Checkpoint) is given, the scores of
+    completed stimuli are checkpointed, and checkpointed stimuli are not rescored.
+
+    If n_workers > 1, batches are scored by n_workers processes (see bert_scoring/workers.py),
+    each using threads_per_worker threads. If packed_row_length is given, the masked
+    copies of each batch are packed into rows of packed_row_length tokens. If input_ids
+    (a list of the stimuli's input id lists, e.g. from bert_scoring/templates.py) is
+    given, the stimuli aren't tokenized.
+
+    If excluded_spans (a list parallel to stimuli of (start, end) position spans,
+    e.g. of the role noun) is given, the tokens in each stimulus' span aren't masked
+    or scored, and are left out of masked_token_positions and log_probabilities.
+    """
+    tokenized_stimuli = input_ids
+    if tokenized_stimuli is None:
+        tokenized_stimuli = masked_lm.tokenize_stimuli(stimuli, tokenizer)
+    special_token_ids = get_special_token_ids(tokenizer)
+    scored_positions = [
+        get_scored_positions(
+            input_ids, special_token_ids, None if excluded_spans is None else excluded_spans[i])
+        for i, input_ids in enumerate(tokenized_stimuli)]
+
+    result = [
+        {"input_ids": input_ids, "masked_token_positions": [], "log_probabilities": []}
+        for input_ids in tokenized_stimuli]
+    is_scored = [False] * len(stimuli)
+    if score_cache is not None:
+        model_key = cache.get_model_key(model, tokenizer)
+        keys = [
+            cache.make_key(model_key, "pll", input_ids, positions)
+            for input_ids, positions in zip(tokenized_stimuli, scored_positions)]
+        cached_scores = score_cache.get_many(keys)
+        for i, key in enumerate(keys):
+            if key in cached_scores:
+                result[i]["masked_token_positions"] = scored_positions[i]
+                result[i]["log_probabilities"] = cached_scores[key]
+                is_scored[i] = True
+    cache_miss_indices = [i for i in range(len(stimuli)) if not is_scored[i]]
+
+    if run_checkpoint is not None:
+        fingerprint = checkpoint.get_fingerprint(
+            cache.get_model_key(model, tokenizer), "pll", tokenized_stimuli,
+            *([] if excluded_spans is None else [excluded_spans]))
+        for i, log_probabilities in run_checkpoint.load(fingerprint).items():
+            result[i]["masked_token_positions"] = scored_positions[i]
+            result[i]["log_probabilities"] = log_probabilities
+            is_scored[i] = True
+    missing_indices = [i for i in range(len(stimuli)) if not is_scored[i]]
+
+    @torch.no_grad()
+    def score_batch(pll_batch):
+        """Returns the log probability of the target token of each row of a get_pll_batches batch."""
+        masked_input_ids, stimulus_indices, positions, target_ids = pll_batch
+        if packed_row_length is None:
+            rows = torch.arange(masked_input_ids.shape[0])
+            columns = positions
+            batch = {
+                "input_ids": masked_input_ids,
+                "token_type_ids": torch.zeros_like(masked_input_ids),
+                "attention_mask": torch.ones_like(masked_input_ids),
+            }
+        else:
+            # Many masked copies per row, each only attending to itself
+            batch, rows, starts = packing.pack_batch(
+                masked_input_ids.tolist(), packed_row_length, tokenizer.pad_token_id)
+            columns = starts + positions
+        batch = {k: v.to(device) for k, v in batch.items()}
+        log_probabilities = masked_lm.get_masked_log_probabilities(
+            model, batch, rows.to(device), columns.to(device)).cpu()
+        return log_probabilities[torch.arange(len(target_ids)), target_ids].tolist()
+
+    progress = tqdm.tqdm(total=sum(len(scored_positions[i]) for i in missing_indices))
+    batches = get_pll_batches(
+        tokenized_stimuli, tokenizer.mask_token_id, special_token_ids,
+        batch_size=batch_size, block_size=block_size, indices=missing_indices,
+        excluded_spans=excluded_spans)
+    scored_batches = workers.imap(
+        score_batch, batches, n_workers=n_workers, threads_per_worker=threads_per_worker,
+        get_size=lambda pll_batch: pll_batch[0].shape[0], unit="masked tokens")
+    for pll_batch, target_log_probabilities in scored_batches:
+        masked_input_ids, stimulus_indices, positions, target_ids = pll_batch
+
+        # Scatter the results back to their sentences
+        for i, position, log_probability in zip(
+                stimulus_indices.tolist(), positions.tolist(), target_log_probabilities):
+            result[i]["masked_token_positions"].append(position)
+            result[i]["log_probabilities"].append(log_probability)
+        progress.update(masked_input_ids.shape[0])
+
+        # A sentence's masked copies can span batches; only checkpoint complete sentences
+        if run_checkpoint is not None:
+            run_checkpoint.add_many(
+                (i, result[i]["log_probabilities"]) for i in set(stimulus_indices.tolist())
+                if len(result[i]["log_probabilities"]) == len(scored_positions[i]))
+    progress.close()
+    if run_checkpoint is not None:
+        run_checkpoint.write()
+
+    if score_cache is not None:
+        score_cache.put_many((keys[i], result[i]["log_probabilities"]) for i in cache_miss_indices)
+    return result
+
+
+def get_sentence_scores(sentence_results, excluded_spans=None):
+    """Reduces the results of get_masked_token_log_probabilities to one dict per sentence.
+
+    Each dict has keys:
+      * pseudo_log_likelihood - the sum of the log probabilities of the masked tokens
+      * pseudo_log_likelihood_exclude_modified - the same sum, without the tokens at
+        positions start, ..., end - 1, where (start, end) is the sentence's span in
+        excluded_spans (e.g., the role noun's span; only if excluded_spans is given)
+    """
+    scores = []
+    for i, sentence_result in enumerate(sentence_results):
+        positions = sentence_result["masked_token_positions"]
+        log_probabilities = sentence_result["log_probabilities"]
+        sentence_scores = {"pseudo_log_likelihood": sum(log_probabilities)}
+        if excluded_spans is not None:
+            start, end = excluded_spans[i]
+            sentence_scores["pseudo_log_likelihood_exclude_modified"] = sum(
+                log_probability for position, log_probability in zip(positions, log_probabilities)
+                if not start <= position < end)
+        scores.append(sentence_scores)
+    return scores
@@ -0,0 +1,135 @@
+# Splitting a scoring run across machines.
+#
+# With --shard i/N, a scoring script only scores the i-th of N contiguous ranges
+# of its stimuli (i counts from 0), and writes them to its own result store,
+# e.g. bert_predictions.shard_2_of_4/. Stimulus ids are the stimuli's indices in
+# the full stimuli file, so shards can be merged back without renumbering. Each
+# shard store records the model and a fingerprint of the full stimuli file, so
+# shards from different runs are never mixed.
+#
+# Once all N shards have been written (e.g., by different hosts on a shared
+# filesystem), running the script with --merge validates and merges them into
+# the usual result store. Like the parts of a run (see bert_scoring/streaming.py),
+# the shards are merged one table of one shard at a time, so merging takes no
+# more memory than the largest shard's largest table.
+
+import glob
+import hashlib
+import json
+import os
+import re
+
+import numpy as np
+
+from bert_scoring import cache
+from bert_scoring import checkpoint
+from bert_scoring import store
+
+
+METADATA_FILE = "metadata.json"
+
+
+def parse_shard(shard):
+    """Parses a shard argument "i/N" into a (shard_index, n_shards) tuple."""
+    match = re.fullmatch(r"(\d+)/(\d+)", shard)
+    if match is None or not int(match.group(1)) < int(match.group(2)):
+        raise ValueError(f"Expected a shard of the form i/N with 0 <= i < N, got {shard}")
+    return int(match.group(1)), int(match.group(2))
+
+
+def get_shard_indices(n_stimuli, shard=None):
+    """Returns the indices of the stimuli in shard (a (shard_index, n_shards) tuple, or None for all)."""
+    if shard is None:
+        return range(n_stimuli)
+    shard_index, n_shards = shard
+    return range(n_stimuli * shard_index // n_shards, n_stimuli * (shard_index + 1) // n_shards)
+
+
+def get_shard_store_path(store_path, shard):
+    shard_index, n_shards = shard
+    return f"{store_path}.shard_{shard_index}_of_{n_shards}"
+
+
+def get_stimuli_fingerprint(stimuli):
+    """Returns (n_stimuli, fingerprint) for an iterable of stimulus strings, without storing them."""
+    digest = hashlib.sha256()
+    n_stimuli = 0
+    for stimulus in stimuli:
+        digest.update(json.dumps(stimulus).encode("utf-8") + b"\n")
+        n_stimuli += 1
+    return n_stimuli, digest.hexdigest()
+
+
+def write_metadata(shard_store_path, shard, stimuli, model, tokenizer, options=None):
+    """Records which shard of which stimuli (an iterable of all stimulus strings) a shard store holds."""
+    shard_index, n_shards = shard
+    n_stimuli, stimuli_fingerprint = get_stimuli_fingerprint(stimuli)
+    metadata = {
+        "shard_index": shard_index,
+        "n_shards": n_shards,
+        "n_stimuli": n_stimuli,
+        "stimuli_fingerprint": stimuli_fingerprint,
+        "model": cache.get_model_key(model, tokenizer),
+        "options": options or {},
+    }
+    with open(os.path.join(shard_store_path, METADATA_FILE), "w") as f:
+        json.dump(metadata, f, indent=2)
+
+
+def read_metadata(shard_store_path):
+    with open(os.path.join(shard_store_path, METADATA_FILE)) as f:
+        return json.load(f)
+
+
+def merge_shards(store_path):
+    """Validates the shards of the store at store_path, and merges them into that store.
+
+    Raises a ValueError if shards are missing, come from different runs (models,
+    options or stimuli), or don't cover every stimulus exactly once.
+    """
+    shard_paths = [
+        path for path in sorted(glob.glob(f"{glob.escape(store_path)}.shard_*_of_*"))
+        if re.search(r"\.shard_\d+_of_\d+$", path)]
+    if not shard_paths:
+        raise ValueError(f"No shards of {store_path} found")
+    shard_metadata = [read_metadata(path) for path in shard_paths]
+
+    # Every shard should come from the same run
+    run_metadata = [
+        {k: v for k, v in metadata.items() if k != "shard_index"} for metadata in shard_metadata]
+    for path, metadata in zip(shard_paths, run_metadata):
+        if metadata != run_metadata[0]:
+            raise ValueError(
+                f"{path} was scored with a different model, options or stimuli than {shard_paths[0]}")
+    n_shards = run_metadata[0]["n_shards"]
+    missing_shards = set(range(n_shards)) - {metadata["shard_index"] for metadata in shard_metadata}
+    if missing_shards:
+        raise ValueError(f"Missing shards {sorted(missing_shards)} of {n_shards} for {store_path}")
+
+    # Every stimulus should be in exactly one shard (only the stimulus ids are read)
+    n_stimuli = run_metadata[0]["n_stimuli"]
+    id_counts = np.zeros(n_stimuli, dtype=np.int64)
+    for path in shard_paths:
+        stimulus_ids = store.read_table(
+            path, store.SENTENCES_TABLE, columns=["stimulus_id"])["stimulus_id"].to_numpy()
+        if len(stimulus_ids) and not 0 <= stimulus_ids.min() <= stimulus_ids.max() < n_stimuli:
+            raise ValueError(f"{path} has stimulus ids outside of 0-{n_stimuli - 1}")
+        np.add.at(id_counts, stimulus_ids, 1)
+    duplicated_ids = np.flatnonzero(id_counts > 1).tolist()
+    missing_ids = np.flatnonzero(id_counts == 0).tolist()
+    if duplicated_ids or missing_ids:
+        raise ValueError(
+            f"The shards of {store_path} are missing stimuli {missing_ids[:10]} "
+            f"({len(missing_ids)} total) and duplicate stimuli {duplicated_ids[:10]} "
+            f"({len(duplicated_ids)} total)")
+
+    # Shards are contiguous ranges of stimulus ids, written in order, so writing them
+    # one after the other (one table of one shard in memory at a time) keeps the
+    # rows in stimulus id order
+    shard_paths = [path for _, path in sorted(
+        zip([metadata["shard_index"] for metadata in shard_metadata], shard_paths))]
+    with checkpoint.atomic_path(store_path) as tmp_store_path:
+        store.concatenate(shard_paths, tmp_store_path)
+        with open(os.path.join(tmp_store_path, METADATA_FILE), "w") as f:
+            json.dump({k: v for k, v in run_metadata[0].items() if k != "n_shards"}, f, indent=2)
+    print(f"Merged {n_shards} shards into {store_path}")
@@ -0,0 +1,134 @@
+# Columnar storage for BERT scores.
+#
+# A result store is a directory with one Parquet file per table. The scoring
+# scripts write a "sentences" table (one row per stimulus, keyed by stimulus_id)
+# and a table of scores keyed by stimulus_id (e.g., one row per masked token), so
+# sentence metadata is stored once rather than repeated on every score row.
+#
+# String columns are stored as categoricals, and log probabilities as float32.
+# Readers can load only the columns they need, e.g.
+#   store.read_table("bert_predictions", "tokens", columns=["stimulus_id", "log_probability"])
+
+import glob
+import math
+import os
+
+import pandas as pd
+
+
+SENTENCES_TABLE = "sentences"
+
+LOG_PROBABILITY_DTYPE = "float32"
+
+
+def get_table_path(store_path, table):
+    return os.path.join(store_path, f"{table}.parquet")
+
+
+def compact_columns(data):
+    """Returns a copy of data with string columns as categoricals, and log probabilities as float32."""
+    data = data.copy()
+    for column in data.columns:
+        if column.endswith("log_probability"):
+            data[column] = data[column].astype(LOG_PROBABILITY_DTYPE)
+        elif data[column].dtype == object and all(isinstance(item, str) for item in data[column]):
+            data[column] = data[column].astype("category")
+    return data
+
+
+def write_table(store_path, table, data):
+    """Writes data (a DataFrame) to the given table of the store at store_path."""
+    os.makedirs(store_path, exist_ok=True)
+    compact_columns(data).to_parquet(get_table_path(store_path, table), index=False)
+
+
+def get_tables(store_path):
+    """Returns the names of the tables in the store at store_path."""
+    return sorted(
+        os.path.basename(path)[:-len(".parquet")]
+        for path in glob.glob(os.path.join(store_path, "*.parquet")))
+
+
+def concatenate(store_paths, output_path):
+    """Writes the tables of several stores (e.g., chunks of one run) one after the other to output_path.
+
+    Only one table of one store is in memory at a time.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    os.makedirs(output_path, exist_ok=True)
+    for table in get_tables(store_paths[0]):
+        writer = None
+        for store_path in store_paths:
+            data = pq.read_table(get_table_path(store_path, table))
+            if writer is None:
+                # Each store has its own categories, so use indices wide enough for all of them
+                schema = pa.schema(
+                    [pa.field(field.name, pa.dictionary(pa.int32(), field.type.value_type))
+                     if pa.types.is_dictionary(field.type) else field
+                     for field in data.schema],
+                    metadata=data.schema.metadata)
+                writer = pq.ParquetWriter(get_table_path(output_path, table), schema)
+            writer.write_table(data.cast(schema))
+        writer.close()
+
+
+def get_columns(store_path, table):
+    """Returns the column names of a table of the store at store_path, without reading it."""
+    import pyarrow.parquet as pq
+
+    return pq.read_schema(get_table_path(store_path, table)).names
+
+
+def read_table(store_path, table, columns=None):
+    """Reads a table of the store at store_path; if columns is given, only those columns are read."""
+    return pd.read_parquet(get_table_path(store_path, table), columns=columns)
+
+
+def read_scores(store_path, table, sentence_columns, score_columns=None):
+    """Reads a table of scores, joined with the given columns of the sentences table."""
+    scores = read_table(
+        store_path, table,
+        columns=None if score_columns is None else ["stimulus_id"] + score_columns)
+    sentences = read_table(
+        store_path, SENTENCES_TABLE, columns=["stimulus_id"] + sentence_columns)
+    return scores.join(sentences.set_index("stimulus_id"), on="stimulus_id")
+
+
+def write_sentences(store_path, rows, stimulus_ids=None):
+    """Writes the sentences table from a list of row dicts.
+
+    The rows are numbered with stimulus_id, which is stimulus_ids if given
+    (e.g., for a shard of the stimuli), or 0, 1, ... otherwise.
+    """
+    sentences = pd.DataFrame(rows)
+    sentences.insert(0, "stimulus_id", range(len(rows)) if stimulus_ids is None else stimulus_ids)
+    write_table(store_path, SENTENCES_TABLE, sentences)
+
+
+def write_probabilities(store_path, table, key_column, probability_dicts, stimulus_ids=None):
+    """Writes a table of log probabilities from a list (parallel to the sentences table) of dicts.
+
+    Each dict maps a key (e.g., a variant) to its probability, and becomes one row
+    (stimulus_id, key_column, log_probability) per key.
+    """
+    if stimulus_ids is None:
+        stimulus_ids = range(len(probability_dicts))
+    rows = [
+        {"stimulus_id": stimulus_id, key_column: key,
+         "log_probability": math.log(probability) if probability > 0 else float("-inf")}
+        for stimulus_id, probabilities in zip(stimulus_ids, probability_dicts)
+        for key, probability in probabilities.items()]
+    write_table(store_path, table, pd.DataFrame(rows))
+
+
+def read_probabilities(store_path, table, key_column):
+    """Reads a table written by write_probabilities, as a list of {key: probability} dicts."""
+    data = read_table(store_path, table)
+    n_sentences = len(read_table(store_path, SENTENCES_TABLE, columns=["stimulus_id"]))
+    result = [{} for _ in range(n_sentences)]
+    for stimulus_id, key, log_probability in zip(
+            data["stimulus_id"], data[key_column], data["log_probability"]):
+        result[stimulus_id][key] = math.exp(log_probability)
+    return result
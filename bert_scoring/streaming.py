@@ -0,0 +1,115 @@
+# Scoring generated stimuli in chunks, with bounded memory.
+#
+# The papineau stimuli are the cross product of names, states and role nouns, so
+# their number grows quickly with the lists. Rather than materializing every
+# stimulus (and all of their scores), the scoring scripts take the stimuli from
+# a generator, and score them in chunks of chunk_size stimuli. The results of
+# each chunk are written to a part store in <store_path>.parts/, and once every
+# chunk is scored, the parts are concatenated, one table of one part at a time,
+# into the result store. So memory use depends on the chunk size, not on the
+# number of stimuli.
+#
+# Part stores are written atomically, and the checkpoint of the scores of the
+# chunk being scored (see bert_scoring/checkpoint.py) is only removed once its
+# part is in place. With --resume, complete parts (that hold the same stimuli,
+# scored with the same model and options) are kept, and only the remaining
+# chunks are scored.
+
+import itertools
+import json
+import os
+import shutil
+
+from bert_scoring import checkpoint
+from bert_scoring import store
+
+
+DEFAULT_CHUNK_SIZE = 16384
+
+MANIFEST_FILE = "manifest.json"
+
+# The CSV output of each part, if any
+CSV_FILE = "part.csv"
+
+# The index of the chunk being scored (so a checkpoint left by a run that stopped
+# between writing a part and removing its checkpoint can be recognized)
+SCORING_FILE = "scoring.json"
+
+
+def iter_chunks(items, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yields lists of up to chunk_size consecutive items of an iterable."""
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def get_part_path(parts_path, index):
+    return os.path.join(parts_path, f"part_{index:05d}")
+
+
+def score_chunks(rows, parts_path, score_and_write, fingerprint, first_stimulus_id=0,
+                 chunk_size=DEFAULT_CHUNK_SIZE, resume=False, text_column="stimulus",
+                 run_checkpoint=None):
+    """Scores an iterable of stimulus row dicts in chunks, writing each chunk to a part store.
+
+    score_and_write(part_path, chunk, stimulus_ids) scores a chunk (a list of rows)
+    and writes its results to the store at part_path. Stimulus ids count up from
+    first_stimulus_id. fingerprint identifies the model and options of the run.
+    run_checkpoint (a checkpoint.Checkpoint of the scores of the chunk being
+    scored, if any) is removed once each part is in place.
+    Returns the paths of the part stores, in order.
+    """
+    manifest_path = os.path.join(parts_path, MANIFEST_FILE)
+    manifest = {
+        "fingerprint": fingerprint, "first_stimulus_id": first_stimulus_id, "chunk_size": chunk_size}
+    if not (resume and os.path.exists(manifest_path)):
+        shutil.rmtree(parts_path, ignore_errors=True)
+        os.makedirs(parts_path)
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f)
+    with open(manifest_path) as f:
+        if json.load(f) != manifest:
+            raise ValueError(
+                f"The parts in {parts_path} are for a different model, options, shard or chunk size; "
+                "rerun without --resume to start over")
+
+    scoring_path = os.path.join(parts_path, SCORING_FILE)
+    part_paths = []
+    stimulus_id = first_stimulus_id
+    for i, chunk in enumerate(iter_chunks(rows, chunk_size)):
+        part_path = get_part_path(parts_path, i)
+        texts = [row[text_column] for row in chunk]
+        if os.path.exists(part_path) and store.read_table(
+                part_path, store.SENTENCES_TABLE, columns=[text_column])[text_column].tolist() != texts:
+            raise ValueError(
+                f"{part_path} holds different stimuli; rerun without --resume to start over")
+        if not os.path.exists(part_path):
+            with open(scoring_path, "w") as f:
+                json.dump(i, f)
+            with checkpoint.atomic_path(part_path) as tmp_part_path:
+                score_and_write(
+                    tmp_part_path, chunk, range(stimulus_id, stimulus_id + len(chunk)))
+            # Only once the part is renamed into place, so a crash loses neither
+            if run_checkpoint is not None:
+                run_checkpoint.remove()
+        elif run_checkpoint is not None and os.path.exists(scoring_path):
+            # The checkpoint of a part that was written before the run stopped
+            with open(scoring_path) as f:
+                if json.load(f) == i:
+                    run_checkpoint.remove()
+        part_paths.append(part_path)
+        stimulus_id += len(chunk)
+    return part_paths
+
+
+def concatenate_csvs(part_paths, output_path):
+    """Concatenates the CSV outputs of the parts (keeping the first part's header) into output_path."""
+    with open(output_path, "w") as output_file:
+        for i, part_path in enumerate(part_paths):
+            with open(os.path.join(part_path, CSV_FILE)) as f:
+                if i > 0:
+                    next(f)
+                shutil.copyfileobj(f, output_file)
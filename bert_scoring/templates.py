@@ -0,0 +1,96 @@
+# Template-compiled stimuli.
+#
+# Every papineau stimulus fills the same template, e.g.
+# "{name} is {a/an} {role} from {state}". BERT's tokenizer splits text on
+# whitespace before splitting each word into word pieces, so the word pieces of a
+# stimulus are the word pieces of its fragments, concatenated. Rather than
+# tokenizing every stimulus, each distinct fragment (name, determiner, role noun,
+# state, and the template's own words) is tokenized once, and the input ids of a
+# stimulus are assembled from its fragments' ids.
+#
+# The token span of each slot is recorded as well, so downstream steps know
+# exactly which positions hold e.g. the role noun, rather than matching word
+# pieces by string.
+
+import re
+
+
+SLOT_PATTERN = re.compile(r"\{([^{}]+)\}")
+
+
+def parse_template(template):
+    """Splits a template into a list of (slot, text) fragments; slot is None for literal text.
+
+    Slots must be separated from each other and from literal text by whitespace.
+    """
+    fragments = []
+    end = 0
+    for match in SLOT_PATTERN.finditer(template):
+        if match.start() > end:
+            fragments.append((None, template[end:match.start()]))
+        fragments.append((match.group(1), None))
+        end = match.end()
+    if end < len(template):
+        fragments.append((None, template[end:]))
+
+    for (slot, text), (next_slot, next_text) in zip(fragments, fragments[1:]):
+        if (slot is not None and next_slot is not None) or \
+                (text is not None and not text[-1].isspace()) or \
+                (next_text is not None and not next_text[0].isspace()):
+            raise ValueError(f"The slots of {template!r} must be separated by whitespace")
+    return fragments
+
+
+class Template:
+    """Assembles the input ids of stimuli filling a template, from pre-tokenized fragments."""
+
+    def __init__(self, template, tokenizer):
+        self.template = template
+        self.fragments = parse_template(template)
+        self.slots = [slot for slot, text in self.fragments if slot is not None]
+        self.tokenizer = tokenizer
+        self.fragment_ids = {}
+
+    def get_fragment_ids(self, text):
+        if text not in self.fragment_ids:
+            self.fragment_ids[text] = self.tokenizer.encode(text, add_special_tokens=False)
+        return self.fragment_ids[text]
+
+    def format(self, row):
+        return "".join(text if slot is None else row[slot] for slot, text in self.fragments)
+
+    def compile(self, row):
+        """Returns (input_ids, spans) for a row dict with a value for each slot.
+
+        input_ids include [CLS] and [SEP], and spans maps each slot to the
+        (start, end) positions of its word pieces in input_ids. If the row has a
+        "stimulus", it must be the filled-in template.
+        """
+        if "stimulus" in row and row["stimulus"] != self.format(row):
+            raise ValueError(f"{row['stimulus']!r} doesn't fill the template {self.template!r}")
+
+        input_ids = [self.tokenizer.cls_token_id]
+        spans = {}
+        for slot, text in self.fragments:
+            fragment_ids = self.get_fragment_ids(text if slot is None else row[slot])
+            if slot is not None:
+                spans[slot] = (len(input_ids), len(input_ids) + len(fragment_ids))
+            input_ids.extend(fragment_ids)
+        input_ids.append(self.tokenizer.sep_token_id)
+        return input_ids, spans
+
+    def compile_many(self, rows):
+        """Returns (input_ids_list, spans_list) for a list of row dicts."""
+        compiled = [self.compile(row) for row in rows]
+        return [input_ids for input_ids, spans in compiled], [spans for input_ids, spans in compiled]
+
+
+def get_span_fields(spans, slots):
+    """Returns a {<slot>_start: start, <slot>_end: end} dict of the spans of slots.
+
+    For example, these are the span columns of a sentences table row.
+    """
+    fields = {}
+    for slot in slots:
+        fields[f"{slot}_start"], fields[f"{slot}_end"] = spans[slot]
+    return fields
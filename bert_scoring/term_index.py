@@ -0,0 +1,198 @@
+# A persistent term-frequency index of a corpus.
+#
+# Counting a few terms in a corpus means scanning all of it (hours, for
+# Wikipedia). Instead, build_index scans a corpus (see bert_scoring/corpus.py)
+# once, and counts every unigram and bigram in it:
+#   * a unigram is a maximal run of word characters (\w+) of the lowercased text,
+#     so the count of a word is the number of case-insensitive \bword\b matches
+#   * a bigram is two such words separated by a single space
+#     (e.g., "flight attendant")
+# These are the counts of bert_scoring/matching.py, except for words containing
+# the few characters the regex case-folds to ASCII letters
+# (matching.CASE_FOLDING_CHARACTERS, e.g. "ſalesman"), which are counted as written.
+#
+# The index is a directory with a sorted array of 64-bit term hashes, and an
+# array of counts, for each of unigrams and bigrams. TermIndex memory-maps them
+# and looks up terms by binary search, so queries take milliseconds and don't
+# load the index into memory. Distinct terms with the same hash would have their
+# counts merged; with 64-bit hashes, this is unlikely even for billions of terms.
+#
+# Files are counted by a pool of worker processes (see bert_scoring/workers.py).
+# Each worker writes its counts to sorted part arrays in <index>.parts/ whenever it
+# holds max_part_terms distinct terms (so memory stays bounded), and marks each
+# file as done once it is counted, so an interrupted build can be resumed. The
+# parts are then merged one hash range at a time.
+
+import collections
+import glob
+import hashlib
+import json
+import os
+import re
+
+import numpy as np
+
+from bert_scoring import checkpoint
+from bert_scoring import corpus
+from bert_scoring import workers
+
+
+TABLES = {1: "unigrams", 2: "bigrams"}
+
+WORD_PATTERN = re.compile(r"\w+")
+
+# Each pair of words separated by a single space (overlapping pairs, via a lookahead)
+BIGRAM_PATTERN = re.compile(r"(?=\b(\w+ \w+)\b)")
+
+# Maximum number of distinct terms a worker counts in memory before writing a part
+DEFAULT_MAX_PART_TERMS = 4000000
+
+# Number of hash ranges the parts are merged in
+N_MERGE_BUCKETS = 256
+
+
+def hash_terms(terms):
+    """Returns the 64-bit hashes of terms, as a uint64 array."""
+    return np.array([
+        int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little")
+        for term in terms], dtype=np.uint64)
+
+
+def get_part_paths(parts_path, file_index, part_index, table):
+    prefix = os.path.join(parts_path, f"file_{file_index:05d}_part_{part_index:05d}.{table}")
+    return prefix + ".hashes.npy", prefix + ".counts.npy"
+
+
+def write_part(parts_path, file_index, part_index, counters):
+    """Writes each table's counts (a Counter) as arrays sorted by term hash."""
+    for n, table in TABLES.items():
+        hashes = hash_terms(counters[n].keys())
+        counts = np.fromiter(counters[n].values(), dtype=np.int64, count=len(counters[n]))
+        order = np.argsort(hashes, kind="stable")
+        hashes_path, counts_path = get_part_paths(parts_path, file_index, part_index, table)
+        np.save(hashes_path, hashes[order])
+        np.save(counts_path, counts[order])
+        counters[n].clear()
+
+
+def count_file(parts_path, file_index, path, max_part_terms=DEFAULT_MAX_PART_TERMS):
+    """Counts the unigrams and bigrams of a corpus file into parts; returns its number of documents."""
+    counters = {n: collections.Counter() for n in TABLES}
+    part_index = 0
+    n_documents = 0
+    for text in corpus.iter_texts(path):
+        lowered = text.lower()
+        counters[1].update(WORD_PATTERN.findall(lowered))
+        counters[2].update(BIGRAM_PATTERN.findall(lowered))
+        n_documents += 1
+        if len(counters[1]) + len(counters[2]) >= max_part_terms:
+            write_part(parts_path, file_index, part_index, counters)
+            part_index += 1
+    write_part(parts_path, file_index, part_index, counters)
+    with open(os.path.join(parts_path, f"file_{file_index:05d}.done"), "w") as f:
+        json.dump({"n_documents": n_documents}, f)
+    return n_documents
+
+
+def merge_parts(parts_path, table, output_path):
+    """Merges the parts of a table into sorted hash and count files; returns the number of terms."""
+    parts = [
+        (np.load(hashes_path, mmap_mode="r"), np.load(hashes_path[:-len(".hashes.npy")] + ".counts.npy", mmap_mode="r"))
+        for hashes_path in sorted(glob.glob(os.path.join(parts_path, f"*.{table}.hashes.npy")))]
+    bucket_starts = [np.uint64(bucket << 56) for bucket in range(N_MERGE_BUCKETS)]
+    part_bounds = [
+        np.append(np.searchsorted(hashes, bucket_starts), len(hashes)) for hashes, _ in parts]
+
+    n_terms = 0
+    with open(output_path + ".hashes", "wb") as hashes_file, \
+            open(output_path + ".counts", "wb") as counts_file:
+        for bucket in range(N_MERGE_BUCKETS):
+            slices = [
+                (hashes[bounds[bucket]:bounds[bucket + 1]], counts[bounds[bucket]:bounds[bucket + 1]])
+                for (hashes, counts), bounds in zip(parts, part_bounds)]
+            hashes = np.concatenate([np.asarray(h) for h, _ in slices] + [np.zeros(0, np.uint64)])
+            counts = np.concatenate([np.asarray(c) for _, c in slices] + [np.zeros(0, np.int64)])
+            if len(hashes) == 0:
+                continue
+            order = np.argsort(hashes, kind="stable")
+            hashes = hashes[order]
+            counts = counts[order]
+            starts = np.flatnonzero(np.append(True, hashes[1:] != hashes[:-1]))
+            hashes_file.write(hashes[starts].tobytes())
+            counts_file.write(np.add.reduceat(counts, starts).tobytes())
+            n_terms += len(starts)
+    return n_terms
+
+
+def build_index(corpus_path, index_path, n_workers=1, resume=False,
+                max_part_terms=DEFAULT_MAX_PART_TERMS):
+    """Builds a term index of the corpus at corpus_path, at index_path."""
+    paths = corpus.get_corpus_files(corpus_path)
+    parts_path = index_path + ".parts"
+    corpus.open_checkpoint(parts_path, corpus.get_corpus_fingerprint(paths), resume=resume)
+
+    # Parts of files that weren't finished are discarded, and the files recounted
+    done_indices = {
+        int(os.path.basename(path)[len("file_"):-len(".done")])
+        for path in glob.glob(os.path.join(parts_path, "file_*.done"))}
+    for path in glob.glob(os.path.join(parts_path, "file_*_part_*.npy")):
+        if int(os.path.basename(path)[len("file_"):][:5]) not in done_indices:
+            os.remove(path)
+
+    tasks = [(i, path) for i, path in enumerate(paths) if i not in done_indices]
+    results = workers.imap(
+        lambda task: count_file(parts_path, task[0], task[1], max_part_terms), tasks,
+        n_workers=n_workers, threads_per_worker=1,
+        get_size=lambda task: os.path.getsize(task[1]) / 1e6, unit="MB")
+    for (i, path), n_documents in results:
+        print(f"Indexed {path} ({n_documents} documents)")
+
+    n_documents = 0
+    for path in glob.glob(os.path.join(parts_path, "file_*.done")):
+        with open(path) as f:
+            n_documents += json.load(f)["n_documents"]
+
+    with checkpoint.atomic_path(index_path) as tmp_index_path:
+        os.makedirs(tmp_index_path)
+        manifest = {"corpus_files": [os.path.abspath(path) for path in paths],
+                    "n_documents": n_documents, "n_terms": {}}
+        for table in TABLES.values():
+            manifest["n_terms"][table] = merge_parts(
+                parts_path, table, os.path.join(tmp_index_path, table))
+        with open(os.path.join(tmp_index_path, checkpoint.MANIFEST_FILE), "w") as f:
+            json.dump(manifest, f, indent=2)
+    checkpoint.remove_path(parts_path)
+
+
+class TermIndex:
+    """Counts of the unigrams and bigrams of a corpus, memory-mapped from an index built by build_index."""
+
+    def __init__(self, index_path):
+        with open(os.path.join(index_path, checkpoint.MANIFEST_FILE)) as f:
+            self.manifest = json.load(f)
+        self.tables = {}
+        for n, table in TABLES.items():
+            n_terms = self.manifest["n_terms"][table]
+            if n_terms == 0:
+                self.tables[n] = (np.zeros(0, np.uint64), np.zeros(0, np.int64))
+                continue
+            self.tables[n] = tuple(
+                np.memmap(os.path.join(index_path, f"{table}.{name}"), dtype=dtype, mode="r",
+                          shape=(n_terms,))
+                for name, dtype in [("hashes", np.uint64), ("counts", np.int64)])
+
+    def count(self, terms):
+        """Returns a dict mapping each of terms (a word, or two words separated by a space) to its count.
+
+        Terms are looked up in lowercase.
+        """
+        result = {}
+        for term in terms:
+            n = len(term.split(" "))
+            if n not in self.tables:
+                raise ValueError(f"{term!r} isn't a unigram or bigram")
+            hashes, counts = self.tables[n]
+            term_hash = hash_terms([term.lower()])[0]
+            i = np.searchsorted(hashes, term_hash)
+            result[term] = int(counts[i]) if i < len(hashes) and hashes[i] == term_hash else 0
+        return result
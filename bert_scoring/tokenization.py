@@ -0,0 +1,82 @@
+# Tokenization with an on-disk cache.
+#
+# Tokenizing tens of thousands of stimuli with BertTokenizer takes a while, and
+# the same stimuli are tokenized on every run (and by several scripts). Results
+# are stored in an SQLite file keyed by (model name, snapshot revision, kind of
+# tokenization, text), so each text is only tokenized once per tokenizer. Since
+# the key doesn't depend on the tokenizer object, scripts that only need cached
+# tokenizations never load the tokenizer (or import transformers).
+#
+# By default, the cache is stored at ~/.cache/bert_scoring/tokenizations.sqlite
+# (or at the path in the BERT_SCORING_TOKENIZATION_CACHE environment variable).
+
+import json
+import os
+import sqlite3
+
+from bert_scoring import models
+
+
+DEFAULT_CACHE_PATH = os.environ.get(
+    "BERT_SCORING_TOKENIZATION_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "bert_scoring", "tokenizations.sqlite"))
+
+# Maximum number of texts per SQL query (SQLite limits the number of parameters)
+QUERY_CHUNK_SIZE = 500
+
+
+def get_tokenizer_key(model_name):
+    # Tokenizers loaded from a local directory (rather than by model name) have no revision
+    revision = None if os.path.isdir(model_name) else models.get_revision(model_name)
+    return json.dumps([model_name, revision])
+
+
+def get_cached_tokenizations(texts, kind, model_name, tokenize_function, cache_path=DEFAULT_CACHE_PATH):
+    """Returns [tokenize_function(text) for text in texts], using the cache where possible.
+
+    kind names the tokenization (e.g., "encode" for ids, "tokenize" for word pieces);
+    tokenize_function is only called for texts that aren't cached yet.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+    tokenizer_key = get_tokenizer_key(model_name)
+    connection = sqlite3.connect(cache_path)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS tokenizations ("
+        "tokenizer TEXT, kind TEXT, text TEXT, tokens TEXT, PRIMARY KEY (tokenizer, kind, text))")
+
+    unique_texts = list(set(texts))
+    text_to_tokens = {}
+    for start in range(0, len(unique_texts), QUERY_CHUNK_SIZE):
+        chunk = unique_texts[start:start + QUERY_CHUNK_SIZE]
+        rows = connection.execute(
+            "SELECT text, tokens FROM tokenizations WHERE tokenizer = ? AND kind = ? "
+            f"AND text IN ({','.join('?' * len(chunk))})",
+            [tokenizer_key, kind] + chunk).fetchall()
+        text_to_tokens.update((text, json.loads(tokens)) for text, tokens in rows)
+
+    missing_texts = [text for text in unique_texts if text not in text_to_tokens]
+    for text in missing_texts:
+        text_to_tokens[text] = tokenize_function(text)
+    connection.executemany(
+        "INSERT OR REPLACE INTO tokenizations (tokenizer, kind, text, tokens) VALUES (?, ?, ?, ?)",
+        [(tokenizer_key, kind, text, json.dumps(text_to_tokens[text])) for text in missing_texts])
+    connection.commit()
+    connection.close()
+
+    return [text_to_tokens[text] for text in texts]
+
+
+def encode(texts, tokenizer):
+    """Returns a list of input id lists (including [CLS] and [SEP]), one per text."""
+    return get_cached_tokenizations(
+        texts, "encode", tokenizer.name_or_path,
+        lambda text: tokenizer.encode(text, add_special_tokens=True, truncation=True))
+
+
+def tokenize(texts, model_name=models.MODEL_NAME):
+    """Returns a list of word piece lists, one per text.
+
+    The tokenizer is only loaded if some of the texts aren't cached.
+    """
+    return get_cached_tokenizations(
+        texts, "tokenize", model_name, lambda text: models.get_tokenizer(model_name).tokenize(text))
@@ -0,0 +1,112 @@
+# Multi-process CPU scoring.
+#
+# On many-core CPUs, one process using intra-op threads scales poorly for short
+# sentences. Instead, batches can be scored by a pool of worker processes, each
+# with a few threads. The model is loaded once in the parent process, and the
+# workers are forked from it, so they share its weights copy-on-write (the
+# weights are never written to, so they are never copied). Each worker is sent
+# batches as it becomes free, and the results are returned to the parent in the
+# order of the batches, so the caller can put them back in input order. Batches
+# are taken from the caller's generator as results come back, with at most
+# TASKS_IN_FLIGHT_PER_WORKER batches per worker sent but not yet yielded, so
+# memory stays proportional to the batch size times the number of workers
+# (however many batches there are).
+#
+# Forking is not supported on Windows; there, and with n_workers=1, batches are
+# scored in the parent process. Nor can a process that has initialized CUDA (e.g.,
+# by moving the model to the GPU) be forked, so worker pools are refused then;
+# the pool is for CPU scoring.
+
+import collections
+import itertools
+import multiprocessing
+import os
+import sys
+import time
+
+import torch
+
+
+# Maximum number of tasks per worker that are sent to the pool but not yet yielded
+TASKS_IN_FLIGHT_PER_WORKER = 2
+
+# State inherited by forked workers: the function to apply to each batch
+WORKER_STATE = {}
+
+
+def init_worker(n_threads):
+    torch.set_num_threads(n_threads)
+
+
+def time_call(function, task):
+    """Returns (pid, seconds, function(task))."""
+    start_time = time.time()
+    result = function(task)
+    return os.getpid(), time.time() - start_time, result
+
+
+def run_worker_task(task):
+    """Applies the inherited function to task, in a worker."""
+    return time_call(WORKER_STATE["function"], task)
+
+
+def get_threads_per_worker(n_workers):
+    """Splits the available cores evenly between n_workers workers."""
+    return max(1, (os.cpu_count() or 1) // n_workers)
+
+
+def imap(function, tasks, n_workers=1, threads_per_worker=None, get_size=len, unit="stimuli"):
+    """Yields (task, function(task)) for each of tasks, computed by n_workers processes.
+
+    Results are yielded in the order of tasks. function may be a closure (it is inherited by the workers rather than pickled),
+    but tasks and results are sent between processes, so should be small.
+    tasks may be a generator; it is consumed lazily, at most
+    TASKS_IN_FLIGHT_PER_WORKER * n_workers tasks ahead of the results yielded.
+    Raises a ValueError for n_workers > 1 if CUDA is initialized (forked workers
+    can't use it). Once all tasks are done, prints the throughput of each
+    worker, in units of get_size(task) per second.
+    """
+    worker_sizes = collections.Counter()
+    worker_seconds = collections.Counter()
+
+    if n_workers <= 1 or sys.platform == "win32":
+        for task in tasks:
+            pid, seconds, result = time_call(function, task)
+            worker_sizes[pid] += get_size(task)
+            worker_seconds[pid] += seconds
+            yield task, result
+    else:
+        if torch.cuda.is_initialized():
+            raise ValueError(
+                f"Can't fork {n_workers} workers from a process that has initialized CUDA; "
+                "score on the GPU with 1 worker, or on the CPU (CUDA_VISIBLE_DEVICES='') with several")
+        if threads_per_worker is None:
+            threads_per_worker = get_threads_per_worker(n_workers)
+        WORKER_STATE["function"] = function
+        context = multiprocessing.get_context("fork")
+        with context.Pool(n_workers, initializer=init_worker, initargs=(threads_per_worker,)) as pool:
+            # Workers take the next task as soon as they are free, but results are
+            # yielded in order; the window of pending tasks is refilled as they are
+            in_flight = collections.deque()
+            tasks = iter(tasks)
+            for task in itertools.islice(tasks, TASKS_IN_FLIGHT_PER_WORKER * n_workers):
+                in_flight.append((task, pool.apply_async(run_worker_task, (task,))))
+            while in_flight:
+                task, pending_result = in_flight.popleft()
+                pid, seconds, result = pending_result.get()
+                for next_task in itertools.islice(tasks, 1):
+                    in_flight.append((next_task, pool.apply_async(run_worker_task, (next_task,))))
+                worker_sizes[pid] += get_size(task)
+                worker_seconds[pid] += seconds
+                yield task, result
+        WORKER_STATE.clear()
+
+    print_throughput(worker_sizes, worker_seconds, unit)
+
+
+def print_throughput(worker_sizes, worker_seconds, unit):
+    for i, pid in enumerate(sorted(worker_sizes)):
+        seconds = worker_seconds[pid]
+        rate = worker_sizes[pid] / seconds if seconds > 0 else float("inf")
+        print(f"Worker {i} (pid {pid}): {worker_sizes[pid]} {unit} in {seconds:.1f}s "
+              f"({rate:.1f} {unit}/s)")
@@ -1,93 +1,171 @@
 # Compute the probability of "they" in the Camilliere et al. (2021) stimuli, according to BERT.
 # 
 # Requires: BERT_stimuli.csv
-# Outputs: bert_predictions.csv
+# Outputs: the bert_predictions/ result store (see bert_scoring/store.py), with tables:
+#   * sentences - one row per stimulus
+#   * alternatives - the log probability of each alternative, keyed by stimulus_id
+# With --csv, this also outputs bert_predictions.csv.
+#
+# By default, this is the probability of "they" over BERT's full vocabulary. With
+# --within_set, it is instead normalized over the gendered and gender-neutral forms
+# of the pronoun in PRONOUN_ALTERNATIVES (e.g., p(they | {he, she, they})), and the
+# full-vocabulary softmax is skipped.
 # 
 # Adapted from:
 # https://gist.github.com/yuchenlin/a2f42d3c4378ed7b83de65c7a2222eb2
 # https://seaborn.pydata.org/generated/seaborn.kdeplot.html
 
-import torch
-from transformers import BertForMaskedLM, BertTokenizer
-import pandas as pd
+import argparse
+import os
 import sys
-import tqdm
 import csv
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from bert_scoring import backends
+from bert_scoring import cache
+from bert_scoring import checkpoint
+from bert_scoring import fidelity
+from bert_scoring import masked_lm
+from bert_scoring import models
+from bert_scoring import shards
+from bert_scoring import store
 
-MASK_INDEX = 103  # 103 corresponds to [MASK]
 
+# The alternatives to "they" (by form) used in --within_set mode
+PRONOUN_ALTERNATIVES = {
+    "they": ["he", "she", "they"],
+    "them": ["him", "her", "them"],
+    "their": ["his", "her", "their"],
+    "themselves": ["himself", "herself", "themselves"],
+}
 
 
-#### INITIALIZING THE MODEL ####
-
-# The tokenizer splits sentences into word pieces (sometimes words
-# are split into to multiple pieces), and maps word pieces to ids
-tokenizer = BertTokenizer.from_pretrained('bert-base-uncased', do_lower_case=True)
-
-# The model takes in the ids and generates vector representation for each
-# wordpiece.
-model = BertForMaskedLM.from_pretrained('bert-base-uncased')
-model.eval()  # This tells the model to behave in evaluation mode (not training mode)
-
-
-# NEW: ADDED GPU
-device = "cuda" if torch.cuda.is_available() else "cpu"
-model = model.to(device)
-
-
-def load_masked_sentences(data_path="BERT_stimuli.csv"):
+def load_masked_sentences(data_path="BERT_stimuli.csv", within_set=False):
     result = []
     with open(data_path, "r") as f:
         dict_reader = csv.DictReader(f)
         for row in dict_reader:
-            row["alternatives"] = [row["form"]]
+            if within_set:
+                row["alternatives"] = PRONOUN_ALTERNATIVES[row["form"]]
+            else:
+                row["alternatives"] = [row["form"]]
             row.pop("")
             result.append(row)
     return result
 
 
-def get_masked_variant_probabilities(stimulus, variants):
-    # Tokenize stimulus sentence
-    tokenized_sentences = tokenizer.batch_encode_plus(
-        [stimulus], return_tensors='pt', add_special_tokens=True,
-        padding=True, truncation=True)
-    tokenized_sentences.to(device)
-
-    # Find the index for the masked word
-    masked_word_index_list = torch.nonzero(
-        tokenized_sentences['input_ids'][0] == MASK_INDEX)
-    assert masked_word_index_list.nelement() == 1, "There should be a masked token"
-    masked_word_index = masked_word_index_list[0][0]
-
-    # Get model logits for all words
-    output = model(**tokenized_sentences)
-    logits = output["logits"]  # has shape [1, ~8, 30522] for [n_sentences, max_sentence_length, vocab_size]
-
-    # Extract the logits for the masked word, and convert to probabilities
-    masked_logits = logits[0, masked_word_index, :]
-    masked_probabilities = torch.nn.functional.softmax(masked_logits, dim=0)
-
-    # Return the probability of each of the variants
-    return {
-        variant: float(masked_probabilities[tokenizer.vocab[variant]])
-        for variant in variants}
-
-
-def main(output_path="bert_predictions.csv"):
-    input_sentences = load_masked_sentences()
+def write_csv(output_path, input_sentences, alternative_probabilities):
     with open(output_path, "w") as f:
         csv_writer = csv.DictWriter(
             f, fieldnames=['cond', 'itm', 'sentence', 'form', 'antecedent', 'masked_sentence',
                            "alternatives", "alternative_probabilities"])
         csv_writer.writeheader()
-        with torch.no_grad():  # This tells the model not to adjust its weights
-            for i in tqdm.trange(len(input_sentences)):
-                row = input_sentences[i]
-                row["alternative_probabilities"] = get_masked_variant_probabilities(
-                    row["masked_sentence"], row["alternatives"])
-                csv_writer.writerow(row)
+        for row, probabilities in zip(input_sentences, alternative_probabilities):
+            csv_writer.writerow(dict(row, alternative_probabilities=probabilities))
+
+
+def main(store_path="bert_predictions", csv_output_path=None,
+         batch_size=masked_lm.DEFAULT_BATCH_SIZE, within_set=False,
+         use_cache=True, resume=False,
+         n_workers=1, threads_per_worker=None, shard=None, merge=False,
+         precision="fp32", backend="eager", packed_row_length=None):
+    if merge:
+        # Merge the shards written by runs with --shard (see bert_scoring/shards.py)
+        shards.merge_shards(store_path)
+        return
+
+    all_sentences = load_masked_sentences(within_set=within_set)
+    # With a shard, only that shard's stimuli are scored, and written to the shard's store
+    stimulus_ids = shards.get_shard_indices(len(all_sentences), shard)
+    input_sentences = [all_sentences[i] for i in stimulus_ids]
+    if shard is not None:
+        store_path = shards.get_shard_store_path(store_path, shard)
+
+    # Load the model and tokenizer (once per process; see bert_scoring/models.py)
+    tokenizer = models.get_tokenizer()
+    model = models.get_model(precision=precision, backend=backend)
+    if precision != "fp32":
+        # Report how much the reduced precision changes the scores of a reference
+        # subset of the stimuli (see bert_scoring/fidelity.py)
+        fidelity.check_variant_probabilities(
+            [row["masked_sentence"] for row in input_sentences],
+            [row["alternatives"] for row in input_sentences],
+            tokenizer, model, models.get_model(), store_path + ".fidelity.json",
+            within_set=within_set)
+
+    # Stimuli scored by a previous run (of any pipeline) are looked up in the score cache
+    score_cache = cache.ScoreCache() if use_cache else None
+    # While scoring, completed scores are checkpointed to <store_path>.checkpoint/
+    run_checkpoint = checkpoint.Checkpoint(store_path + ".checkpoint", resume=resume)
+
+    # Score all stimuli in batches of similar-length sentences
+    alternative_probabilities = masked_lm.get_masked_variant_probabilities(
+        [row["masked_sentence"] for row in input_sentences],
+        [row["alternatives"] for row in input_sentences],
+        tokenizer, model, device=models.get_model_device(model), batch_size=batch_size,
+        within_set=within_set, score_cache=score_cache, run_checkpoint=run_checkpoint,
+        n_workers=n_workers, threads_per_worker=threads_per_worker,
+        packed_row_length=packed_row_length)
+
+    # Outputs only replace previous outputs once they are completely written
+    with checkpoint.atomic_path(store_path) as tmp_store_path:
+        store.write_sentences(tmp_store_path, [
+            {k: int(v) if k == "itm" else v for k, v in row.items() if k != "alternatives"}
+            for row in input_sentences], stimulus_ids=stimulus_ids)
+        store.write_probabilities(
+            tmp_store_path, "alternatives", "alternative", alternative_probabilities,
+            stimulus_ids=stimulus_ids)
+        if shard is not None:
+            shards.write_metadata(
+                tmp_store_path, shard, [row["masked_sentence"] for row in all_sentences],
+                model, tokenizer, options={"within_set": within_set})
+    if csv_output_path is not None:
+        with checkpoint.atomic_path(csv_output_path) as tmp_csv_path:
+            write_csv(tmp_csv_path, input_sentences, alternative_probabilities)
+    run_checkpoint.remove()
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--within_set", action="store_true",
+        help="normalize the probability of they over PRONOUN_ALTERNATIVES, rather than the full vocabulary")
+    parser.add_argument(
+        "--csv", action="store_true", help="also write the scores to bert_predictions.csv")
+    parser.add_argument(
+        "--resume", action="store_true",
+        help="resume an interrupted run from its checkpoint, rather than starting over")
+    parser.add_argument(
+        "--no_cache", action="store_true",
+        help="score every stimulus, rather than looking up previous scores in the score cache")
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="number of worker processes to score batches with (on CPU)")
+    parser.add_argument(
+        "--threads_per_worker", type=int, default=None,
+        help="number of threads per worker (by default, the cores are split evenly between workers)")
+    parser.add_argument(
+        "--shard", type=shards.parse_shard, default=None,
+        help="only score shard i/N of the stimuli (e.g., 0/4), for splitting a run across machines")
+    parser.add_argument(
+        "--merge", action="store_true", help="merge the shards written by runs with --shard")
+    parser.add_argument(
+        "--precision", choices=models.PRECISIONS, default="fp32",
+        help="inference precision (see bert_scoring/models.py); other than fp32, a fidelity "
+             "report is first written to bert_predictions.fidelity.json")
+    parser.add_argument(
+        "--backend", choices=backends.BACKENDS, default="eager",
+        help="backend to run the encoder with (see bert_scoring/backends.py)")
+    parser.add_argument(
+        "--packed_row_length", type=int, default=None,
+        help="pack the stimuli of each batch into rows of this many tokens, e.g. 256 "
+             "(see bert_scoring/packing.py)")
+    args = parser.parse_args()
+    if args.csv and (args.shard is not None or args.merge):
+        parser.error("--csv can't be combined with --shard or --merge")
+    main(csv_output_path="bert_predictions.csv" if args.csv else None,
+         within_set=args.within_set,
+         use_cache=not args.no_cache, resume=args.resume,
+         n_workers=args.workers, threads_per_worker=args.threads_per_worker,
+         shard=args.shard, merge=args.merge, precision=args.precision,
+         backend=args.backend, packed_row_length=args.packed_row_length)
@@ -1,15 +1,19 @@
 # Create bar plot of surprisal of they, by experimental condition for BERT predictions.
 # (The experimental conditions come from the Camilliere et al. (2021) stimuli).
 #
-# Relies on: bert_predictions.csv
+# Relies on: the bert_predictions/ result store
 # Outputs:
 # * visualizations/antecedent_type_surprisal.png
 # * bert_predictions_with_p_they.csv
 
 import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
+import os
 import seaborn as sns
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from bert_scoring import store
 
 
 condition_to_label = {
@@ -25,8 +29,11 @@ condition_to_label = {
 }
 
 
-data = pd.read_csv("bert_predictions.csv")
-data["p_they"] = [eval(row["alternative_probabilities"])[row["form"]] for _, row in data.iterrows()]
+data = store.read_table("bert_predictions", store.SENTENCES_TABLE)
+alternatives = store.read_scores("bert_predictions", "alternatives", ["form"])
+they = alternatives[alternatives["alternative"].astype(str) == alternatives["form"].astype(str)]
+data["p_they"] = np.exp(data["stimulus_id"].map(
+    they.set_index("stimulus_id")["log_probability"]).astype("float64"))
 data["surprisal"] = -np.log(data["p_they"])
 data["antecedent type"] = [condition_to_label[row["cond"]] for _, row in data.iterrows()]
 data.to_csv("bert_predictions_with_p_they.csv")
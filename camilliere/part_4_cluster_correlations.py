@@ -5,12 +5,30 @@
 # Relies on: 
 # * camilliere_data.txt (experimental data)
 # * bert_predictions_with_p_they.csv (BERT predictions data)
-
-
+#
+# The correlations are also saved to cluster_correlations.csv (e.g., for comparing
+# runs at different precisions with bert_scoring/fidelity.py).
+#
+# The uncertainty from sampling participants is estimated by bootstrapping: the
+# participants of each cluster are resampled N_BOOTSTRAP_REPLICATES times (see
+# bert_scoring/bootstrap.py). The 95% BCa intervals (and the bootstrap bias) are
+# added to cluster_correlations.csv, and the differences between the clusters'
+# correlations, with their intervals and permutation test p values (shuffling
+# participants between the two clusters), are saved to
+# cluster_correlation_differences.csv.
+
+
+import os
 import pandas as pd
+import sys
 from scipy.stats import pearsonr
 from scipy.stats import mannwhitneyu
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from bert_scoring import bootstrap
+
+N_BOOTSTRAP_REPLICATES = bootstrap.DEFAULT_N_REPLICATES
+
 # Load experimental data; filter out practice items
 experimental_data = pd.read_csv("camilliere_data.txt", sep=" ")
 experimental_data = experimental_data[experimental_data["exp"] != "practice"]
@@ -32,9 +50,12 @@ CLUSTER_ID_TO_LABEL = {
 }
 
 # Compute the correlation between BERT probabilities and the average rating per cluster
+cluster_correlations = []
+cluster_differences = []
 for include_control in [True, False]:
     print(f"include inanimate control = {include_control}")
 
+    group_ratings = {}
     for cluster, cluster_label in CLUSTER_ID_TO_LABEL.items():
         cluster_data = experimental_data[experimental_data["clust"] == cluster]
 
@@ -56,7 +77,26 @@ for include_control in [True, False]:
             cluster_averages["rating"],
             cluster_averages[bert_feature])
         print(f"BERT correlation with {cluster_label}: r={statistic:.4f}, p={p_value} ({n_participants} participants) ({n_observations} observations)")
+        cluster_correlations.append({
+            "include_control": include_control, "cluster": cluster_label, "r": statistic,
+            "p": p_value, "n_participants": n_participants, "n_observations": n_observations})
+        group_ratings[cluster_label] = bootstrap.get_rating_matrices(cluster_data)
+
+    # Bootstrap confidence intervals, resampling the participants of each cluster
+    intervals, comparisons = bootstrap.bootstrap_groups(
+        group_ratings, bert_data[bert_feature], n_replicates=N_BOOTSTRAP_REPLICATES)
+    for row in cluster_correlations[-len(CLUSTER_ID_TO_LABEL):]:
+        row.update({name: intervals[row["cluster"]][name] for name in ["bias", "ci_low", "ci_high"]})
+        print(f"bootstrap 95% BCa CI for {row['cluster']}: [{row['ci_low']:.4f}, {row['ci_high']:.4f}] (bias {row['bias']:.4f})")
+    for comparison in comparisons:
+        print(f"bootstrap r difference for {comparison['group_a']} - {comparison['group_b']}: "
+              f"{comparison['difference']:.4f} "
+              f"[{comparison['difference_ci_low']:.4f}, {comparison['difference_ci_high']:.4f}], "
+              f"permutation p={comparison['p']:.4f}")
+        cluster_differences.append({"include_control": include_control, **comparison})
     print("\n")
+pd.DataFrame(cluster_correlations).to_csv("cluster_correlations.csv", index=False)
+pd.DataFrame(cluster_differences).to_csv("cluster_correlation_differences.csv", index=False)
 
 # This outputs the following:
 
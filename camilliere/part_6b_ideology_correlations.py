@@ -5,11 +5,25 @@
 # Relies on: 
 # * camilliere_data_with_ideology_bins.csv (experimental data)
 # * bert_predictions_with_p_they.csv (BERT predictions data)
+#
+# The uncertainty from sampling participants is estimated by bootstrapping: the
+# participants of each group are resampled N_BOOTSTRAP_REPLICATES times (see
+# bert_scoring/bootstrap.py), and the 95% BCa interval (and bootstrap bias) of
+# each group's correlation, and the intervals and permutation test p values of
+# the differences between groups, are printed and saved to
+# ideology_correlations.csv and ideology_correlation_differences.csv.
 
 
+import os
 import pandas as pd
+import sys
 from scipy.stats import pearsonr
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from bert_scoring import bootstrap
+
+N_BOOTSTRAP_REPLICATES = bootstrap.DEFAULT_N_REPLICATES
+
 
 def get_n_participants(data_frame):
     return len(set(data_frame["ID"]))
@@ -24,12 +38,15 @@ bert_data = pd.read_csv("bert_predictions_with_p_they.csv")[["cond", "itm", bert
 bert_data = bert_data.set_index(["cond", "itm"])
 
 
+ideology_correlations = []
+ideology_differences = []
 for include_control in [True, False]:
     print(f"include inanimate control = {include_control}")
     bin_type = "nBAcc"
     method = "scale_chunks"
 
     print(f"\tBERT correlation for scale={bin_type}; bin_approach={method}:")
+    group_ratings = {}
     for ideology_group in [f'{bin_type}-low', f'{bin_type}-mid', f'{bin_type}-high']:
         group_data = experimental_data[experimental_data[f"{bin_type}_{method}_bin"] == ideology_group]
 
@@ -54,8 +71,27 @@ for include_control in [True, False]:
             group_averages["rating"],
             group_averages[bert_feature])
         print(f"\t\t{ideology_group} ({rating_str}): r={statistic:.4f}, p={p_value:.8f} ({n_participants} participants) ({n_observations} observations)")
+        ideology_correlations.append({
+            "include_control": include_control, "group": ideology_group, "r": statistic,
+            "p": p_value, "n_participants": n_participants, "n_observations": n_observations})
+        group_ratings[ideology_group] = bootstrap.get_rating_matrices(group_data)
+
+    # Bootstrap confidence intervals, resampling the participants of each group
+    intervals, comparisons = bootstrap.bootstrap_groups(
+        group_ratings, bert_data[bert_feature], n_replicates=N_BOOTSTRAP_REPLICATES)
+    for row in ideology_correlations[-len(group_ratings):]:
+        row.update({name: intervals[row["group"]][name] for name in ["bias", "ci_low", "ci_high"]})
+        print(f"\t\tbootstrap 95% BCa CI for {row['group']}: [{row['ci_low']:.4f}, {row['ci_high']:.4f}] (bias {row['bias']:.4f})")
+    for comparison in comparisons:
+        print(f"\t\tbootstrap r difference for {comparison['group_a']} - {comparison['group_b']}: "
+              f"{comparison['difference']:.4f} "
+              f"[{comparison['difference_ci_low']:.4f}, {comparison['difference_ci_high']:.4f}], "
+              f"permutation p={comparison['p']:.4f}")
+        ideology_differences.append({"include_control": include_control, **comparison})
 
     print("\n\n")
+pd.DataFrame(ideology_correlations).to_csv("ideology_correlations.csv", index=False)
+pd.DataFrame(ideology_differences).to_csv("ideology_correlation_differences.csv", index=False)
 
 
 # Results for surprisal (not raw p_they)
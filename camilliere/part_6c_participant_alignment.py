@@ -0,0 +1,81 @@
+# Relate each participant's alignment with BERT to their scores on the gender
+# ideology surveys, as continuous predictors (rather than bins, as in part 6b).
+#
+# A participant's alignment is the correlation between their ratings and BERT's
+# predictions for the items they rated. The alignments of all participants are
+# computed at once, and correlated with each survey (and regressed on all of
+# them jointly); see bert_scoring/alignment.py. To add a survey, add its column
+# to IDEOLOGY_SCALES.
+#
+# Relies on:
+# * camilliere_data.txt (experimental data)
+# * bert_predictions_with_p_they.csv (BERT predictions data)
+#
+# Outputs:
+# * participant_alignments.csv (each participant's alignment, cluster and survey scores)
+# * alignment_scale_correlations.csv
+# * alignment_scale_regression.csv
+
+
+import os
+import pandas as pd
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from bert_scoring import alignment
+from bert_scoring import bootstrap
+
+# nBAcc (non-binary acceptance), gId (gender identity and familiarity),
+# tPhob (transphobia), gEss (gender essentialism)
+IDEOLOGY_SCALES = ["nBAcc", "gId", "tPhob", "gEss"]
+
+# Load experimental data; filter out practice items
+experimental_data = pd.read_csv("camilliere_data.txt", sep=" ")
+experimental_data = experimental_data[experimental_data["exp"] != "practice"]
+
+# Load BERT predictions
+bert_feature = "surprisal"  # p_they or surprisal
+bert_data = pd.read_csv("bert_predictions_with_p_they.csv")[["cond", "itm", bert_feature]]
+bert_data = bert_data.set_index(["cond", "itm"])
+
+# Participants that didn't complete the post surveys have NaN scores, and are
+# left out of the analyses of those surveys only
+scales = alignment.get_participant_scales(experimental_data, IDEOLOGY_SCALES)
+clusters = experimental_data.groupby("ID")["clust"].first()
+
+participant_alignments = []
+scale_correlations = []
+scale_regressions = []
+for include_control in [True, False]:
+    print(f"include inanimate control = {include_control}")
+    data = experimental_data
+    if include_control is False:
+        data = data[data["cond"] != "inanimate"]
+
+    sums, counts = bootstrap.get_rating_matrices(data)
+    alignments = alignment.get_participant_alignments(sums, counts, bert_data[bert_feature])
+    print(f"\tBERT alignment per participant ({len(alignments)} participants): "
+          f"mean r={alignments['r'].mean():.4f}, sd={alignments['r'].std():.4f} "
+          f"({alignments['n_items'].min()}-{alignments['n_items'].max()} items each)")
+    participant_alignments.append(pd.concat([
+        alignments.assign(include_control=include_control), clusters, scales], axis=1))
+
+    correlations = alignment.correlate_with_scales(alignments["r"], scales)
+    for row in correlations.to_dict("records"):
+        print(f"\t\talignment vs {row['scale']}: pearson r={row['pearson_r']:.4f}, p={row['pearson_p']:.8f}; "
+              f"spearman rho={row['spearman_r']:.4f}, p={row['spearman_p']:.8f} "
+              f"({row['n_participants']} participants)")
+    scale_correlations.append(correlations.assign(include_control=include_control))
+
+    regression = alignment.regress_on_scales(alignments["r"], scales)
+    print(f"\tRegression of alignment on {' + '.join(IDEOLOGY_SCALES)} "
+          f"({regression['n_participants'].iloc[0]} participants):")
+    for row in regression.to_dict("records"):
+        print(f"\t\t{row['scale']}: beta={row['beta']:.4f}, se={row['se']:.4f}, "
+              f"t={row['t']:.4f}, p={row['p']:.8f}")
+    scale_regressions.append(regression.assign(include_control=include_control))
+    print("\n")
+
+pd.concat(participant_alignments).to_csv("participant_alignments.csv", index_label="ID")
+pd.concat(scale_correlations).to_csv("alignment_scale_correlations.csv", index=False)
+pd.concat(scale_regressions).to_csv("alignment_scale_regression.csv", index=False)
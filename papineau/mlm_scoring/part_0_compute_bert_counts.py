@@ -1,22 +1,58 @@
 # This script computes the frequencies of role nouns in the corpora BERT was trained on.
 # This is used as a prior to re-weight the probabilities from the Nangia et al. method.
 # adapted from: https://www.philschmid.de/pre-training-bert-habana#1-prepare-the-dataset
+#
+# The corpora are counted from local copies in corpora/ (see bert_scoring/corpus.py),
+# which are downloaded from the Hugging Face hub the first time, and saved as
+# --download_shards Arrow files. The files are counted in parallel (--workers), and
+# each file's counts are checkpointed to <output>.checkpoint/, so an interrupted run
+# can be resumed with --resume.
+#
+# By default, the role nouns are counted with a TermMatcher (see
+# bert_scoring/matching.py), which finds them all in one pass over each lowercased
+# document, with the same counts as the case-insensitive regex (--matcher regex).
+# With --matcher arrow, an ArrowTermMatcher counts record batches of each Arrow or
+# Parquet file with pyarrow.compute kernels, without converting the documents to
+# Python strings, again with the same counts. Run with --benchmark to compare the
+# three on a synthetic corpus.
+#
+# With --index, each corpus is instead scanned once into a term index of all its
+# words and two-word phrases (corpora/<corpus>.index, see bert_scoring/term_index.py),
+# and the counts are looked up in it. An existing index is reused, so counting new
+# role nouns takes milliseconds (delete the index to rebuild it). Part 2b reads the
+# counts from the indexes directly when they exist.
 
 
-import collections
+import argparse
 import csv
-from datasets import load_dataset
-import re
+import os
+import sys
 import tqdm
 
 from constants import STIMULI_SETS
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from bert_scoring import checkpoint
+from bert_scoring import corpus
+from bert_scoring import matching
+from bert_scoring import term_index
+
 
 ROLE_NOUNS = []
 for stimuli_set in STIMULI_SETS:
     ROLE_NOUNS.extend(list(stimuli_set))
 
-QUERY = "|".join([r"\b" + noun + r"\b" for noun in ROLE_NOUNS])
+QUERY = matching.get_query(ROLE_NOUNS)
+
+MATCHERS = ["terms", "regex", "arrow"]
+
+# name: (Hugging Face dataset name and config, output path)
+CORPORA = {
+    "wiki": (("wikipedia", "20200501.en"), "wiki_counts.csv"),
+    "bookcorpus": (("bookcorpus",), "bookcorpus_counts.csv"),
+}
+
+DEFAULT_DOWNLOAD_SHARDS = 64
 
 
 def save_counter(output_path, counter):
@@ -30,21 +66,108 @@ def save_counter(output_path, counter):
             })
 
 
-def compute_counts_for_dataset(output_path, dataset, query=QUERY):
-    counter = collections.Counter()
-    for item in tqdm.tqdm(dataset):
-        occurrences = re.findall(query, item['text'], flags=re.IGNORECASE)
-        counter.update([item.lower() for item in occurrences])
-    save_counter(output_path, counter)
+def count_texts(texts, matcher="terms"):
+    """Counts the role nouns in texts, with a TermMatcher ("terms") or the regex ("regex")."""
+    if matcher == "regex":
+        return matching.count_with_regex(texts, QUERY)
+    return matching.TermMatcher(ROLE_NOUNS).count(texts)
 
 
-if __name__ == "__main__":
-    wiki = load_dataset("wikipedia", "20200501.en", split="train")   # Takes 1-2 hrs to download (tried 2 times)
-    wiki = wiki.remove_columns([col for col in wiki.column_names if col != "text"])  # only keep the 'text' column
-    compute_counts_for_dataset("wiki_counts.csv", wiki)              # takes ~2 hrs to run -- ran once
-    del wiki
-    
-    bookcorpus = load_dataset("bookcorpus", split="train")           # Takes ~3 mins to download; 20 mins to load (tried 4 times)
-    compute_counts_for_dataset("bookcorpus_counts.csv", bookcorpus)  # Takes 1-1.5 hrs to run -- ran twice
-    del bookcorpus
+def count_file(path, matcher="terms"):
+    """Counts the role nouns in a corpus file (see bert_scoring/corpus.py)."""
+    if matcher == "arrow":
+        return matching.ArrowTermMatcher(ROLE_NOUNS).count(corpus.iter_text_batches(path))
+    return count_texts(corpus.iter_texts(path), matcher)
+
+
+def compute_counts_for_dataset(output_path, dataset, matcher="terms"):
+    """Counts the role nouns in a (loaded) Hugging Face dataset, in one process."""
+    if matcher == "arrow":
+        # The dataset's text column, as the Arrow arrays it is memory-mapped from
+        columns = dataset.data.column("text").chunks
+        save_counter(output_path, matching.ArrowTermMatcher(ROLE_NOUNS).count(tqdm.tqdm(columns)))
+        return
+    save_counter(output_path, count_texts((item['text'] for item in tqdm.tqdm(dataset)), matcher))
+
+
+def download_corpus(corpus_path, dataset_name, n_shards=DEFAULT_DOWNLOAD_SHARDS):
+    """Saves the text column of a Hugging Face dataset to corpus_path, as n_shards Arrow files."""
+    from datasets import load_dataset
 
+    dataset = load_dataset(*dataset_name, split="train")  # wikipedia takes 1-2 hrs to download
+    dataset = dataset.remove_columns([col for col in dataset.column_names if col != "text"])
+    dataset.save_to_disk(corpus_path, num_shards=n_shards)
+
+
+def compute_counts_for_corpus(output_path, corpus_path, n_workers=1, resume=False, matcher="terms"):
+    """Counts the role nouns in a local corpus (see bert_scoring/corpus.py), with n_workers processes."""
+    counter = corpus.count_corpus(
+        corpus_path, lambda path: count_file(path, matcher),
+        n_workers=n_workers, checkpoint_path=output_path + ".checkpoint", resume=resume,
+        options=ROLE_NOUNS)
+    with checkpoint.atomic_path(output_path) as tmp_output_path:
+        save_counter(tmp_output_path, counter)
+    checkpoint.remove_path(output_path + ".checkpoint")
+
+
+def compute_counts_from_index(output_path, corpus_path, index_path, n_workers=1, resume=False):
+    """Looks up the role nouns in a term index of a local corpus, building the index if it doesn't exist."""
+    if not os.path.exists(index_path):
+        term_index.build_index(corpus_path, index_path, n_workers=n_workers, resume=resume)
+    counts = term_index.TermIndex(index_path).count(ROLE_NOUNS)
+    with checkpoint.atomic_path(output_path) as tmp_output_path:
+        save_counter(tmp_output_path, {term: count for term, count in counts.items() if count > 0})
+
+
+def main(corpora_path="corpora", corpus_names=list(CORPORA), n_workers=1, resume=False,
+         download_shards=DEFAULT_DOWNLOAD_SHARDS, matcher="terms", use_index=False):
+    for name in corpus_names:
+        dataset_name, output_path = CORPORA[name]
+        corpus_path = os.path.join(corpora_path, name)
+        if use_index and os.path.exists(corpus_path + ".index"):
+            compute_counts_from_index(output_path, corpus_path, corpus_path + ".index")
+            continue
+        if not os.path.exists(corpus_path):
+            download_corpus(corpus_path, dataset_name, download_shards)
+        if use_index:
+            compute_counts_from_index(
+                output_path, corpus_path, corpus_path + ".index", n_workers=n_workers, resume=resume)
+        else:
+            compute_counts_for_corpus(
+                output_path, corpus_path, n_workers=n_workers, resume=resume, matcher=matcher)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--corpora", default="corpora",
+        help="directory with a local copy of each corpus (corpora/wiki/ and corpora/bookcorpus/), "
+             "as .arrow, .parquet, .jsonl or .txt files; missing corpora are downloaded there")
+    parser.add_argument(
+        "--corpus", choices=list(CORPORA), action="append", default=None,
+        help="only count this corpus (may be repeated)")
+    parser.add_argument(
+        "--workers", type=int, default=1, help="number of processes to count files with")
+    parser.add_argument(
+        "--resume", action="store_true",
+        help="resume an interrupted run from its checkpoint, rather than starting over")
+    parser.add_argument(
+        "--download_shards", type=int, default=DEFAULT_DOWNLOAD_SHARDS,
+        help="number of files to save a downloaded corpus as (at least --workers)")
+    parser.add_argument(
+        "--matcher", choices=MATCHERS, default="terms",
+        help="count the role nouns with a TermMatcher, a case-insensitive regex, or an "
+             "ArrowTermMatcher over Arrow record batches (see bert_scoring/matching.py)")
+    parser.add_argument(
+        "--index", action="store_true",
+        help="count the role nouns with a term index of each corpus (corpora/<corpus>.index), "
+             "building it if it doesn't exist (see bert_scoring/term_index.py)")
+    parser.add_argument(
+        "--benchmark", action="store_true",
+        help="only compare the matchers on a synthetic corpus")
+    args = parser.parse_args()
+    if args.benchmark:
+        matching.benchmark(ROLE_NOUNS)
+    else:
+        main(args.corpora, args.corpus or list(CORPORA), n_workers=args.workers, resume=args.resume,
+             download_shards=args.download_shards, matcher=args.matcher, use_index=args.index)
@@ -1,5 +1,8 @@
 # Create stimuli to feed into BERT, for all combinations of names, 
 # states, and role nouns.
+#
+# The stimuli are generated lazily by generate_stimuli(), which part_2a uses
+# directly. Running this script writes them to stimuli.csv, for inspection.
 
 import csv
 
@@ -12,12 +15,17 @@ an_roles = {
     'anchor', 'anchorman', 'anchorwoman',
     'actor', 'actress'}
 
+# Every stimulus fills this template (part_2a assembles their input ids from its
+# pre-tokenized fragments; see bert_scoring/templates.py)
+TEMPLATE = "{name} is {a/an} {role} from {state}"
 
-with open("stimuli.csv", "w") as f:
-    csv_writer = csv.DictWriter(
-        f, fieldnames=["stimulus", "name", "gender", "a/an", "role", "role_gender", "state", "variants"])
-    csv_writer.writeheader()
+FIELDNAMES = ["stimulus", "name", "gender", "a/an", "role", "role_gender", "state", "variants"]
+
+
+def generate_stimuli():
+    """Yields a row dict for each stimulus, in the order of stimuli.csv."""
     for name in NAMES:
+        gender = "man" if name in MALE_NAMES else "woman"
         for state in STATES:
             for variants in stimuli:
                 if len(variants) == 2:
@@ -30,13 +38,21 @@ with open("stimuli.csv", "w") as f:
 
                 for role, role_gender in zip(variants, variant_genders):
                     determiner = "an" if role in an_roles else "a"
-                    csv_writer.writerow({
-                        "stimulus": f"{name} is {determiner} {role} from {state}",
+                    yield {
+                        "stimulus": TEMPLATE.format(**{
+                            "name": name, "a/an": determiner, "role": role, "state": state}),
                         "name": name,
-                        "gender": "man" if name in MALE_NAMES else "woman",
+                        "gender": gender,
                         "a/an": determiner,
                         "role": role,
                         "role_gender": role_gender,
                         "state": state,
                         "variants": variants
-                    })
+                    }
+
+
+if __name__ == "__main__":
+    with open("stimuli.csv", "w") as f:
+        csv_writer = csv.DictWriter(f, fieldnames=FIELDNAMES)
+        csv_writer.writeheader()
+        csv_writer.writerows(generate_stimuli())
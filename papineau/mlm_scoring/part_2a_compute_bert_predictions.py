@@ -1,113 +1,125 @@
 # Compute the probability of masculine, feminine, and gender-neutral variants
 # of role nouns
+#
+# Outputs the bert_predictions/ result store (see bert_scoring/store.py), with tables:
+#   * sentences - one row per stimulus
+#   * tokens - the log probability of each masked token, keyed by stimulus_id
+# With --csv, this also outputs bert_predictions.csv, with one row per masked token.
+#
+# With --by_sentence, the log probabilities are instead summed per sentence as they
+# are scored (see pll.get_sentence_scores), and the store only has a sentences table,
+# with each sentence's pseudo-log-likelihood (pseudo_log_likelihood), and its
+# pseudo-log-likelihood without the role noun's tokens
+# (pseudo_log_likelihood_exclude_modified). With --keep_token_scores, each sentence
+# row also keeps its masked token positions and log probabilities, as compact arrays.
+# With --skip_modified (and --by_sentence), the role noun's tokens are never masked,
+# so only pseudo_log_likelihood_exclude_modified is written, with fewer masked copies
+# to score.
+#
+# The input ids of each stimulus are assembled from the pre-tokenized fragments of
+# part_1's TEMPLATE (see bert_scoring/templates.py), and the sentences table records
+# the token span of the name, role noun and state (e.g., role_start and role_end:
+# the role noun's word pieces are at positions role_start, ..., role_end - 1).
+#
+# The stimuli are generated by part_1_create_stimuli.py (or read from a CSV with
+# --stimuli), and scored in chunks (see bert_scoring/streaming.py), so they are
+# never all in memory at once.
+#
 # Adapted from:
 # https://gist.github.com/yuchenlin/a2f42d3c4378ed7b83de65c7a2222eb2
 # https://seaborn.pydata.org/generated/seaborn.kdeplot.html
 
-import torch
-import transformers
-from transformers import BertForMaskedLM, BertTokenizer
-import tqdm
+import argparse
 import csv
+import itertools
+import math
+import numpy as np
+import os
+import pandas as pd
+import sys
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from bert_scoring import backends
+from bert_scoring import cache
+from bert_scoring import checkpoint
+from bert_scoring import fidelity
+from bert_scoring import models
+from bert_scoring import pll
+from bert_scoring import shards
+from bert_scoring import store
+from bert_scoring import streaming
+from bert_scoring import templates
 
-MASK_INDEX = 103  # 103 corresponds to [MASK]
+from part_1_create_stimuli import TEMPLATE, generate_stimuli
 
-SPECIAL_TOKENS = [MASK_INDEX, 101, 102]
 
-#### INITIALIZING THE MODEL ####
-
-# The tokenizer splits sentences into word pieces (sometimes words
-# are split into to multiple pieces), and maps word pieces to ids
-tokenizer = BertTokenizer.from_pretrained('bert-base-uncased', do_lower_case=True)
-
-# The model takes in the ids and generates vector representation for each
-# wordpiece.
-model = BertForMaskedLM.from_pretrained('bert-base-uncased')
-model.eval()  # This tells the model to behave in evaluation mode (not training mode)
-
-
-# Use GPU if available
-device = "cuda" if torch.cuda.is_available() else "cpu"
-model = model.to(device)
+# The template slots whose token spans are recorded in the sentences table
+SPAN_SLOTS = ["name", "role", "state"]
 
 
 def load_masked_sentences(data_path="stimuli.csv"):
-    result = []
+    """Yields the rows of a stimuli CSV (e.g., one written by part_1_create_stimuli.py)."""
     with open(data_path, "r") as f:
         dict_reader = csv.DictReader(f)
         for row in dict_reader:
             row["variants"] = eval(row["variants"])
-            result.append(row)
-    return result
+            yield row
 
 
-def mask_each_token(tokenized_sentences):
-    # Mask each non-special token
-    tokens = list(tokenized_sentences['input_ids'][0].numpy())
-    input_ids = []
-    for token_position, token_id in enumerate(tokenized_sentences['input_ids'][0]):
-        if token_id not in SPECIAL_TOKENS:
-            input_ids.append(tokens[:token_position] + [MASK_INDEX] + tokens[token_position + 1:])
-    input_ids = torch.tensor(input_ids)
+def get_sentence_rows(input_sentences, sentence_results, spans_list):
+    tokenizer = models.get_tokenizer()
+    return [
+        dict(row, variants=str(row["variants"]),
+             stimulus_tokenized=tokenizer.convert_ids_to_tokens(sentence_result["input_ids"]),
+             **templates.get_span_fields(spans, SPAN_SLOTS))
+        for row, sentence_result, spans in zip(input_sentences, sentence_results, spans_list)]
 
-    return transformers.tokenization_utils_base.BatchEncoding({
-        "input_ids": input_ids,
-        "token_type_ids": tokenized_sentences['token_type_ids'].repeat(input_ids.shape[0], 1),
-        "attention_mask": tokenized_sentences['attention_mask'].repeat(input_ids.shape[0], 1),
-    })
 
+def write_sentence_store(store_path, input_sentences, sentence_results, stimulus_ids, spans_list,
+                         keep_token_scores=False, skip_modified=False):
+    """Writes a store with only a sentences table, with the PLL of each sentence.
 
-def get_masked_indices(tokenized_sentences_masked):
-    """Helper function for run_bert. Return a tensor sentence indices that contain mask, and a tensor of
-    wordpiece indices that correspond to where mask was found.
+    If the role noun's tokens were skipped while scoring, only the PLL excluding them is written.
     """
-    masked_word_indices = torch.nonzero(
-        tokenized_sentences_masked['input_ids'] == MASK_INDEX)
-
-    # tensor of [[sentence_index, wordpiece_index]]
-    return masked_word_indices[:, 0], masked_word_indices[:, 1]
-
+    rows = get_sentence_rows(input_sentences, sentence_results, spans_list)
+    sentence_scores = pll.get_sentence_scores(
+        sentence_results, excluded_spans=[spans["role"] for spans in spans_list])
+    for row, scores, sentence_result in zip(rows, sentence_scores, sentence_results):
+        if skip_modified:
+            del scores["pseudo_log_likelihood"]
+        row.update(scores)
+        if keep_token_scores:
+            row["masked_token_positions"] = np.asarray(
+                sentence_result["masked_token_positions"], dtype=np.int16)
+            row["masked_token_log_probabilities"] = np.asarray(
+                sentence_result["log_probabilities"], dtype=np.float32)
+    store.write_sentences(store_path, rows, stimulus_ids=stimulus_ids)
 
-def get_masked_probabilities(stimulus):
 
-    # Tokenize stimulus sentence
-    tokenized_sentences = tokenizer.batch_encode_plus(
-        [stimulus], return_tensors='pt', add_special_tokens=True,
-        padding=True, truncation=True)
+def write_store(store_path, input_sentences, sentence_results, stimulus_ids, spans_list):
+    tokenizer = models.get_tokenizer()
+    store.write_sentences(
+        store_path, get_sentence_rows(input_sentences, sentence_results, spans_list),
+        stimulus_ids=stimulus_ids)
 
-    # Generate masked senetences, where each non-special token is masked
-    tokenized_sentences_masked = mask_each_token(tokenized_sentences)
-    tokenized_sentences_masked.to(device)
+    tokens = []
+    for stimulus_id, sentence_result in zip(stimulus_ids, sentence_results):
+        input_ids = sentence_result["input_ids"]
+        for position, log_probability in zip(
+                sentence_result["masked_token_positions"],
+                sentence_result["log_probabilities"]):
+            tokens.append({
+                "stimulus_id": stimulus_id,
+                "masked_token_position": position,
+                "masked_token_id": input_ids[position],
+                "masked_token": tokenizer.convert_ids_to_tokens(input_ids[position]),
+                "log_probability": log_probability
+            })
+    store.write_table(store_path, "tokens", pd.DataFrame(tokens))
 
-    # Find the index for the masked word
-    masked_indices = get_masked_indices(tokenized_sentences_masked)
 
-    # Get model logits for all words
-    output = model(**tokenized_sentences_masked)
-    logits = output["logits"]  # has shape [~6, ~8, 30522] for [n_sentences, max_sentence_length, vocab_size]
-
-    # Extract the logits for the masked word, and convert to probabilities
-    masked_logits = logits[masked_indices[0], masked_indices[1], :]
-    masked_probabilities = torch.nn.functional.softmax(masked_logits, dim=1)
-
-    # Return the probability of each masked token
-    input_tokens = tokenizer.convert_ids_to_tokens(tokenized_sentences["input_ids"][0])
-    result = []
-    for i in range(masked_indices[0].shape[0]):
-        masked_token_id = int(tokenized_sentences["input_ids"][torch.tensor(0), masked_indices[1][i]].numpy())
-        result.append({
-            "masked_token_id": masked_token_id,
-            "masked_token_position": int(masked_indices[1][i].numpy()),
-            "masked_token": tokenizer.convert_ids_to_tokens(masked_token_id),
-            "stimulus_tokenized": input_tokens,
-            "raw_probability": float(masked_probabilities[i, masked_token_id])
-        })
-    return result
-
-
-def main(output_path="bert_predictions.csv"):
-    input_sentences = load_masked_sentences()
+def write_csv(output_path, input_sentences, sentence_results):
+    tokenizer = models.get_tokenizer()
     with open(output_path, "w") as f:
         csv_writer = csv.DictWriter(
             f, fieldnames=["stimulus", "name", "gender", "a/an", "role",
@@ -116,15 +128,176 @@ def main(output_path="bert_predictions.csv"):
                            'masked_token', 'stimulus_tokenized',
                            'raw_probability'])
         csv_writer.writeheader()
-        with torch.no_grad():  # This tells the model not to adjust its weights
-            for i in tqdm.trange(len(input_sentences)):
-                row = input_sentences[i]
-                masked_probabilities_per_word = get_masked_probabilities(
-                    row["stimulus"])
-                for masked_row in masked_probabilities_per_word:
-                    masked_row.update(row)
-                    csv_writer.writerow(masked_row)
+        for row, sentence_result in zip(input_sentences, sentence_results):
+            input_ids = sentence_result["input_ids"]
+            input_tokens = tokenizer.convert_ids_to_tokens(input_ids)
+            for position, log_probability in zip(
+                    sentence_result["masked_token_positions"],
+                    sentence_result["log_probabilities"]):
+                masked_row = {
+                    "masked_token_id": input_ids[position],
+                    "masked_token_position": position,
+                    "masked_token": input_tokens[position],
+                    "stimulus_tokenized": input_tokens,
+                    "raw_probability": math.exp(log_probability)
+                }
+                masked_row.update(row)
+                csv_writer.writerow(masked_row)
+
+
+def main(store_path="bert_predictions", csv_output_path=None, stimuli_path=None,
+         batch_size=pll.DEFAULT_BATCH_SIZE, use_cache=True, resume=False,
+         n_workers=1, threads_per_worker=None, shard=None, merge=False,
+         precision="fp32", backend="eager", packed_row_length=None,
+         chunk_size=streaming.DEFAULT_CHUNK_SIZE, by_sentence=False, keep_token_scores=False,
+         skip_modified=False):
+    if skip_modified and not by_sentence:
+        raise ValueError("skip_modified requires by_sentence")
+    if merge:
+        # Merge the shards written by runs with --shard (see bert_scoring/shards.py)
+        shards.merge_shards(store_path)
+        return
+
+    # The stimuli are generated lazily (or read from stimuli_path), rather than
+    # all loaded at once
+    def get_stimuli():
+        return generate_stimuli() if stimuli_path is None else load_masked_sentences(stimuli_path)
+
+    # With a shard, only that shard's stimuli are scored, and written to the shard's store
+    n_stimuli = sum(1 for _ in get_stimuli())
+    stimulus_ids = shards.get_shard_indices(n_stimuli, shard)
+    if shard is not None:
+        store_path = shards.get_shard_store_path(store_path, shard)
+
+    def get_input_sentences():
+        return itertools.islice(get_stimuli(), stimulus_ids.start, stimulus_ids.stop)
+
+    # Load the model and tokenizer (once per process; see bert_scoring/models.py)
+    tokenizer = models.get_tokenizer()
+    model = models.get_model(precision=precision, backend=backend)
+    template = templates.Template(TEMPLATE, tokenizer)
+    if precision != "fp32":
+        # Report how much the reduced precision changes the scores of a reference
+        # subset of the stimuli (see bert_scoring/fidelity.py)
+        reference_sentences = fidelity.get_reference_rows(get_input_sentences(), len(stimulus_ids))
+        fidelity.check_masked_token_log_probabilities(
+            [row["stimulus"] for row in reference_sentences],
+            tokenizer, model, models.get_model(), store_path + ".fidelity.json")
+
+    # Stimuli scored by a previous run (of any pipeline) are looked up in the score cache
+    score_cache = cache.ScoreCache() if use_cache else None
+    # While scoring a chunk, completed scores are checkpointed to <store_path>.checkpoint/
+    run_checkpoint = checkpoint.Checkpoint(store_path + ".checkpoint", resume=resume)
+
+    def score_and_write(part_path, chunk, chunk_stimulus_ids):
+        # Assemble the input ids from the template's pre-tokenized fragments
+        input_ids, spans_list = template.compile_many(chunk)
+
+        # Mask each non-special token of every stimulus (except the role noun's, with
+        # skip_modified), and score the masked copies in batches that span many sentences
+        sentence_results = pll.get_masked_token_log_probabilities(
+            [row["stimulus"] for row in chunk],
+            tokenizer, model, device=models.get_model_device(model), batch_size=batch_size,
+            score_cache=score_cache, run_checkpoint=run_checkpoint,
+            n_workers=n_workers, threads_per_worker=threads_per_worker,
+            packed_row_length=packed_row_length, input_ids=input_ids,
+            excluded_spans=[spans["role"] for spans in spans_list] if skip_modified else None)
+        if by_sentence:
+            write_sentence_store(
+                part_path, chunk, sentence_results, chunk_stimulus_ids, spans_list,
+                keep_token_scores=keep_token_scores, skip_modified=skip_modified)
+        else:
+            write_store(part_path, chunk, sentence_results, chunk_stimulus_ids, spans_list)
+        if csv_output_path is not None:
+            write_csv(os.path.join(part_path, streaming.CSV_FILE), chunk, sentence_results)
+
+    # Score the stimuli in chunks, written to <store_path>.parts/ (see bert_scoring/streaming.py)
+    part_paths = streaming.score_chunks(
+        get_input_sentences(), store_path + ".parts", score_and_write,
+        [cache.get_model_key(model, tokenizer), TEMPLATE, by_sentence, keep_token_scores,
+         skip_modified],
+        first_stimulus_id=stimulus_ids.start, chunk_size=chunk_size, resume=resume,
+        run_checkpoint=run_checkpoint)
+
+    # Outputs only replace previous outputs once they are completely written
+    with checkpoint.atomic_path(store_path) as tmp_store_path:
+        store.concatenate(part_paths, tmp_store_path)
+        if shard is not None:
+            shards.write_metadata(
+                tmp_store_path, shard, (row["stimulus"] for row in get_stimuli()),
+                model, tokenizer,
+                options={"by_sentence": by_sentence, "keep_token_scores": keep_token_scores,
+                         "skip_modified": skip_modified})
+    if csv_output_path is not None:
+        with checkpoint.atomic_path(csv_output_path) as tmp_csv_path:
+            streaming.concatenate_csvs(part_paths, tmp_csv_path)
+    checkpoint.remove_path(store_path + ".parts")
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--stimuli", default=None,
+        help="score the stimuli in this CSV (e.g., an edited stimuli.csv, whose stimuli still fill "
+             "the TEMPLATE of part_1), rather than generating them")
+    parser.add_argument(
+        "--csv", action="store_true",
+        help="also write the scores to bert_predictions.csv (one row per masked token)")
+    parser.add_argument(
+        "--by_sentence", action="store_true",
+        help="sum the log probabilities per sentence while scoring, and only write a sentences "
+             "table (with each sentence's pseudo-log-likelihood), rather than a tokens table")
+    parser.add_argument(
+        "--keep_token_scores", action="store_true",
+        help="with --by_sentence, also keep each sentence's token log probabilities, as an array")
+    parser.add_argument(
+        "--skip_modified", action="store_true",
+        help="with --by_sentence, never mask the role noun's tokens, and only write the "
+             "pseudo-log-likelihood without them (which is all that part 2b uses by default)")
+    parser.add_argument(
+        "--chunk_size", type=int, default=streaming.DEFAULT_CHUNK_SIZE,
+        help="number of stimuli to score (and hold in memory) at a time")
+    parser.add_argument(
+        "--resume", action="store_true",
+        help="resume an interrupted run from its checkpoint, rather than starting over")
+    parser.add_argument(
+        "--no_cache", action="store_true",
+        help="score every stimulus, rather than looking up previous scores in the score cache")
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="number of worker processes to score batches with (on CPU)")
+    parser.add_argument(
+        "--threads_per_worker", type=int, default=None,
+        help="number of threads per worker (by default, the cores are split evenly between workers)")
+    parser.add_argument(
+        "--shard", type=shards.parse_shard, default=None,
+        help="only score shard i/N of the stimuli (e.g., 0/4), for splitting a run across machines")
+    parser.add_argument(
+        "--merge", action="store_true", help="merge the shards written by runs with --shard")
+    parser.add_argument(
+        "--precision", choices=models.PRECISIONS, default="fp32",
+        help="inference precision (see bert_scoring/models.py); other than fp32, a fidelity "
+             "report is first written to bert_predictions.fidelity.json")
+    parser.add_argument(
+        "--backend", choices=backends.BACKENDS, default="eager",
+        help="backend to run the encoder with (see bert_scoring/backends.py)")
+    parser.add_argument(
+        "--packed_row_length", type=int, default=None,
+        help="pack the stimuli of each batch into rows of this many tokens, e.g. 256 "
+             "(see bert_scoring/packing.py)")
+    args = parser.parse_args()
+    if args.csv and (args.shard is not None or args.merge):
+        parser.error("--csv can't be combined with --shard or --merge")
+    if args.csv and args.by_sentence:
+        parser.error("--csv (one row per masked token) can't be combined with --by_sentence")
+    if args.keep_token_scores and not args.by_sentence:
+        parser.error("--keep_token_scores requires --by_sentence")
+    if args.skip_modified and not args.by_sentence:
+        parser.error("--skip_modified requires --by_sentence")
+    main(csv_output_path="bert_predictions.csv" if args.csv else None, stimuli_path=args.stimuli,
+         chunk_size=args.chunk_size, by_sentence=args.by_sentence,
+         keep_token_scores=args.keep_token_scores, skip_modified=args.skip_modified,
+         use_cache=not args.no_cache, resume=args.resume,
+         n_workers=args.workers, threads_per_worker=args.threads_per_worker,
+         shard=args.shard, merge=args.merge, precision=args.precision,
+         backend=args.backend, packed_row_length=args.packed_row_length)
@@ -2,24 +2,46 @@
 # * This includes applying the method from Nangia et al. to approximate p(word|context).
 # * It also includes averaging across predictions per state (which allows us to compare
 #   to the Papineau et al. (2022) production data, where state names are not included.
+#
+# This relies on the bert_predictions/ result store from part 2a.
 
-import csv
 import numpy as np
+import os
 import pandas as pd
-from transformers import BertForMaskedLM, BertTokenizer
-import tqdm
+import sys
 
 from constants import STIMULI_SETS
 
-tokenizer = BertTokenizer.from_pretrained('bert-base-uncased', do_lower_case=True)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from bert_scoring import store
+from bert_scoring import term_index
+from bert_scoring import tokenization
+
+
+# Term indexes of the corpora, built by part 0 with --index; role noun counts are
+# read from an index if it exists, and from the corpus' counts CSV otherwise
+TERM_INDEXES = {
+    "bookcorpus": "corpora/bookcorpus.index",
+    "wiki": "corpora/wiki.index",
+}
+
+
+def load_counts(corpus_name):
+    """Returns a DataFrame with the (nonzero) count of each role noun in a corpus."""
+    if not os.path.exists(TERM_INDEXES[corpus_name]):
+        return pd.read_csv(f"{corpus_name}_counts.csv")
+    role_nouns = [stimulus for stimuli_set in STIMULI_SETS for stimulus in stimuli_set]
+    counts = term_index.TermIndex(TERM_INDEXES[corpus_name]).count(role_nouns)
+    return pd.DataFrame(
+        [{"term": term, "count": count} for term, count in sorted(counts.items()) if count > 0])
 
 
 def load_frequency_data():
-    bookcorpus_data = pd.read_csv("bookcorpus_counts.csv")
+    bookcorpus_data = load_counts("bookcorpus")
     bookcorpus_data["bookcorpus_count"] = bookcorpus_data["count"]
     bookcorpus_data = bookcorpus_data[["term", "bookcorpus_count"]]
 
-    wiki_data = pd.read_csv("wiki_counts.csv")
+    wiki_data = load_counts("wiki")
     wiki_data["wiki_count"] = wiki_data["count"]
     wiki_data = wiki_data[["term", "wiki_count"]]
 
@@ -31,67 +53,133 @@ def load_frequency_data():
     return data
 
 
-FREQUENCY_DATA = load_frequency_data()
+def get_role_noun_to_tokens():
+    """Returns a dict mapping each role noun to its word pieces.
 
+    The word pieces are cached on disk (see bert_scoring/tokenization.py), so this
+    usually doesn't need to load the tokenizer.
+    """
+    role_nouns = [stimulus for stimuli_set in STIMULI_SETS for stimulus in stimuli_set]
+    return dict(zip(role_nouns, tokenization.tokenize(role_nouns)))
+
+
+def get_modified_token_mask(data):
+    """Returns a boolean array, True for rows whose masked token is part of the role noun.
+
+    The role noun's positions are given by its token span (role_start, role_end),
+    recorded by part 2a.
+    """
+    positions = data["masked_token_position"].to_numpy()
+    return (positions >= data["role_start"].to_numpy()) & (positions < data["role_end"].to_numpy())
 
-def get_role_noun_to_tokens():
-    result = {}
-    for stimuli_set in STIMULI_SETS:
-        for stimulus in stimuli_set:
-            result[stimulus] = tokenizer.tokenize(stimulus)
-    return result
 
+def match_modified_tokens(data):
+    """Returns a boolean array, True for rows where masked_token is one of the role noun's tokens.
 
-ROLE_NOUN_TO_TOKENS = get_role_noun_to_tokens()
+    This approximates get_modified_token_mask for result stores written before part 2a
+    recorded token spans. It also matches tokens outside the role noun that happen to
+    equal one of its word pieces.
+    """
+    role_noun_tokens = pd.DataFrame(
+        [(role, token) for role, tokens in get_role_noun_to_tokens().items() for token in set(tokens)],
+        columns=["role", "masked_token"])
+    role_noun_tokens["is_modified"] = True
+    is_modified = data[["role", "masked_token"]].merge(
+        role_noun_tokens, on=["role", "masked_token"], how="left")["is_modified"]
+    return is_modified.fillna(False).to_numpy(dtype=bool)
 
 
 def get_sentence_probabilities(
-        output_path,      # "bert_predictions_by_sentence_{}.csv",
-        input_data_path,  # "bert_predictions.csv",
+        output_path,        # "bert_predictions_by_sentence_{}.csv",
+        input_store_path,   # "bert_predictions",
         exclude_modified=True):
-    data = pd.read_csv(input_data_path)
-    sentences = set(data["stimulus"])  # 50 states x 24 names x 54 role noun variants = 64800 sentences
     fieldnames = [
         'stimulus', 'name', 'gender', 'a/an', 'role', 'role_gender', 'state',
         'variants', 'raw_log_probability']
-    with open(output_path, "w") as out_f:
-        csv_writer = csv.DictWriter(out_f, fieldnames=fieldnames)
-        csv_writer.writeheader()
-
-        for sentence in tqdm.tqdm(sentences):
-            # Focus on this sentence
-            curr_sentence_data = data[data["stimulus"] == sentence]
-
-            # Get relevant features for sentence (same across all rows in curr_sentence_data)
-            row = {
-                k: v for k, v in dict(
-                    curr_sentence_data.loc[curr_sentence_data.index[0]]).items()
-                    if k in fieldnames}
-
-            # Exclude the modified token
-            if exclude_modified:
-                curr_sentence_data = curr_sentence_data[
-                    [item not in ROLE_NOUN_TO_TOKENS[row["role"]]
-                     for item in curr_sentence_data["masked_token"]]]
-
-            # Compute log probability
-            row["raw_log_probability"] = np.sum(
-                np.log(curr_sentence_data["raw_probability"]))
-
-            # Write to file
-            csv_writer.writerow(row)
 
+    # A store written with part 2a's --by_sentence already has the per-sentence sums
+    sentence_columns = store.get_columns(input_store_path, store.SENTENCES_TABLE)
+    if "pseudo_log_likelihood_exclude_modified" in sentence_columns:
+        pll_column = "pseudo_log_likelihood" + ("_exclude_modified" if exclude_modified else "")
+        if pll_column not in sentence_columns:
+            raise ValueError(
+                f"{input_store_path} has no {pll_column} column; rerun part 2a without --skip_modified")
+        sentences = store.read_table(
+            input_store_path, store.SENTENCES_TABLE, columns=fieldnames[:-1] + [pll_column])
+        sentences["raw_log_probability"] = sentences[pll_column]
+        sentences[fieldnames].to_csv(output_path, index=False)
+        return
+
+    # Only load the columns needed from the result store
+    has_spans = "role_start" in sentence_columns
+    span_columns = ["role_start", "role_end"] if has_spans else []
+    tokens = store.read_table(
+        input_store_path, "tokens",
+        columns=["stimulus_id", "masked_token_position", "masked_token", "log_probability"])
+    sentences = store.read_table(
+        input_store_path, store.SENTENCES_TABLE,
+        columns=["stimulus_id"] + fieldnames[:-1] + span_columns).set_index("stimulus_id")
+
+    # Log probability of each masked token, with the modified tokens contributing 0
+    log_probabilities = tokens["log_probability"].to_numpy(dtype="float64")
+    if exclude_modified:
+        if has_spans:
+            tokens = tokens.join(sentences[span_columns], on="stimulus_id")
+            is_modified = get_modified_token_mask(tokens)
+        else:
+            tokens = tokens.join(sentences["role"], on="stimulus_id")
+            is_modified = match_modified_tokens(tokens)
+        log_probabilities = np.where(is_modified, 0.0, log_probabilities)
+
+    # Sum per sentence (50 states x 24 names x 54 role noun variants = 64800 sentences)
+    sentence_log_probabilities = pd.Series(log_probabilities).groupby(
+        tokens["stimulus_id"].to_numpy()).sum()
+    sentences["raw_log_probability"] = sentence_log_probabilities.reindex(
+        sentences.index, fill_value=0.0)
+    sentences[fieldnames].to_csv(output_path, index=False)
+
+
+LEXEME_GROUP = ["name", "state", "variants"]
+
+METHODS = ["bert_likelihood", "corpus_prior", "frequency_weighted_posterior"]
+ROLE_GENDERS = ["gender_neutral", "feminine", "masculine"]
+
+
+def group_logsumexp(data, log_column, group_columns=LEXEME_GROUP):
+    """Returns logsumexp of log_column within each group, broadcast back to the rows of data."""
+    groups = [data[column] for column in group_columns]
+    group_max = data[log_column].groupby(groups).transform("max")
+    shifted_sum = np.exp(data[log_column] - group_max).groupby(groups).transform("sum")
+    return group_max + np.log(shifted_sum)
+
+
+def normalize_per_lexeme(data, log_column, label):
+    """Normalizes exp(log_column) over the variants of each lexeme (per name and state).
+
+    This is done in log space, so very small sentence probabilities cannot underflow.
+    """
+    log_normalization_constant = group_logsumexp(data, log_column)
+    data[f"normalization_constant_{label}"] = np.exp(log_normalization_constant)
+    data[f"log_normalized_probability_{label}"] = data[log_column] - log_normalization_constant
+    data[f"normalized_probability_{label}"] = np.exp(data[f"log_normalized_probability_{label}"])
+    return data
 
-def normalize_per_lexeme(data, column_to_normalize, label):
-    data_summed = data[["name", "state", "variants", column_to_normalize]].groupby([
-        "name", "state", "variants"]).sum()
-    data_summed[f"normalization_constant_{label}"] = data_summed[column_to_normalize]
-    data_summed = data_summed.drop(columns=[column_to_normalize])
 
-    data = data.join(data_summed, on=("name", "state", "variants"))
+def get_corpus_priors(data):
+    """Returns a df indexed by (variants, role) with the corpus prior of each role noun.
 
-    data[f"normalized_probability_{label}"] = data[column_to_normalize] / data[f"normalization_constant_{label}"]
-    return data
+    The prior only depends on the lexeme, so it is computed once per role noun, rather
+    than once per sentence.
+    """
+    roles = data[["variants", "role"]].drop_duplicates().reset_index(drop=True)
+    roles["corpus_frequency"] = roles["role"].map(load_frequency_data()["frequency"])
+    missing_roles = sorted(set(roles.loc[roles["corpus_frequency"].isna(), "role"]))
+    if missing_roles:
+        raise KeyError(f"No corpus frequency for role nouns: {', '.join(missing_roles)}")
+    roles["normalization_constant_corpus_prior"] = roles.groupby("variants")["corpus_frequency"].transform("sum")
+    roles["normalized_probability_corpus_prior"] = roles["corpus_frequency"] / roles["normalization_constant_corpus_prior"]
+    roles["log_normalized_probability_corpus_prior"] = np.log(roles["normalized_probability_corpus_prior"])
+    return roles.set_index(["variants", "role"])
 
 
 def normalize_sentence_probabilities(
@@ -100,16 +188,26 @@ def normalize_sentence_probabilities(
     ):
     data = pd.read_csv(input_data_path)
     data["raw_probability"] = np.exp(data["raw_log_probability"])
-    data = normalize_per_lexeme(data, "raw_probability", "bert_likelihood")
+    data = normalize_per_lexeme(data, "raw_log_probability", "bert_likelihood")
 
-    data["corpus_frequency"] = [
-        FREQUENCY_DATA.loc[role]["frequency"] for role in data["role"]]
-    data = normalize_per_lexeme(data, "corpus_frequency", "corpus_prior")
+    # Broadcast the per-lexeme priors to every name x state
+    priors = get_corpus_priors(data)
+    data = data.join(priors, on=["variants", "role"])
 
-    data["frequency_weighted_posterior"] = data["normalized_probability_bert_likelihood"] * data["normalized_probability_corpus_prior"]
-    data = normalize_per_lexeme(data, "frequency_weighted_posterior", "frequency_weighted_posterior")
+    data["log_frequency_weighted_posterior"] = (
+        data["log_normalized_probability_bert_likelihood"] + data["log_normalized_probability_corpus_prior"])
+    data["frequency_weighted_posterior"] = np.exp(data["log_frequency_weighted_posterior"])
+    data = normalize_per_lexeme(data, "log_frequency_weighted_posterior", "frequency_weighted_posterior")
 
-    data.to_csv(output_path)
+    output_columns = list(pd.read_csv(input_data_path, nrows=0).columns) + [
+        "raw_probability",
+        "normalization_constant_bert_likelihood", "normalized_probability_bert_likelihood",
+        "corpus_frequency",
+        "normalization_constant_corpus_prior", "normalized_probability_corpus_prior",
+        "frequency_weighted_posterior",
+        "normalization_constant_frequency_weighted_posterior",
+        "normalized_probability_frequency_weighted_posterior"]
+    data[output_columns].to_csv(output_path)
 
 
 def average_sentence_probabilities(
@@ -119,64 +217,52 @@ def average_sentence_probabilities(
     # bert_predictions_averaged_exclude_modified_adoption_frequency_reweighted.csv
     # bert_predictions_averaged_exclude_modified_compound_frequency_reweighted.csv
     data = pd.read_csv(input_data_path)
-    fieldnames = ["name", "gender", "lexeme", "p_gender_neutral",
-                  "p_feminine", "p_masculine"]
-
-    METHODS = ["bert_likelihood", "corpus_prior", "frequency_weighted_posterior"]
-    ROLE_GENDERS = ["gender_neutral", "feminine", "masculine"]
-
-    rows = []
-    for _, curr_df in data.groupby(["name","gender","state","variants"]):
-        row = {
-            k: v for k, v in dict(
-                curr_df.loc[curr_df.index[0]]).items()
-                if k in fieldnames + ["state", "variants"]}
-        variants = eval(row["variants"])
-        row["lexeme"] = variants[0]
-        row["morph_type"] = "compound" if len(variants) == 3 else "adoption"
-        for role_gender in ROLE_GENDERS:
-            for method in METHODS:
-                if role_gender in set(curr_df["role_gender"]):
-                    row[f"p_{role_gender}_{method}"] = float(curr_df[curr_df["role_gender"] == role_gender][f"normalized_probability_{method}"])
-                else:
-                    row[f"p_{role_gender}_{method}"] = None
-
-        rows.append(row)
-
-    melted_dict = pd.DataFrame(rows)
-    for method in METHODS:
-        for role_gender in ROLE_GENDERS:
-            melted_dict[f'p_{role_gender}_{method}'] = melted_dict[f'p_{role_gender}_{method}'].fillna(0)
-
-    melted_dict_compound = melted_dict[melted_dict["morph_type"] == "compound"]
-    averaged_dict_compound = melted_dict_compound.groupby(["name", "gender", "lexeme"]).mean()
-    averaged_dict_compound.to_csv(output_format_str.format("compound"))
-
-    melted_dict_adoption = melted_dict[melted_dict["morph_type"] == "adoption"]
-    averaged_dict_adoption = melted_dict_adoption.groupby(["name", "gender", "lexeme"]).mean()
-    averaged_dict_adoption.to_csv(output_format_str.format("adoption"))
+
+    # One row per name x state x lexeme, with a column per role gender and method
+    # (role genders that a lexeme doesn't have, i.e. masculine for adoption, are 0)
+    method_columns = [f"normalized_probability_{method}" for method in METHODS]
+    wide_data = data.set_index(
+        ["name", "gender", "state", "variants", "role_gender"])[method_columns].unstack("role_gender")
+    wide_data.columns = [
+        f"p_{role_gender}_{method_column.replace('normalized_probability_', '')}"
+        for method_column, role_gender in wide_data.columns]
+    wide_data = wide_data.reindex(
+        columns=[f"p_{role_gender}_{method}" for role_gender in ROLE_GENDERS for method in METHODS],
+        fill_value=0).fillna(0).reset_index()
+
+    # Each lexeme's variants are stored as the string of a tuple; only parse the unique ones
+    variants_to_tuple = {variants: eval(variants) for variants in wide_data["variants"].unique()}
+    wide_data["lexeme"] = wide_data["variants"].map(
+        {variants: parsed[0] for variants, parsed in variants_to_tuple.items()})
+    wide_data["morph_type"] = wide_data["variants"].map(
+        {variants: "compound" if len(parsed) == 3 else "adoption"
+         for variants, parsed in variants_to_tuple.items()})
+
+    p_columns = [column for column in wide_data.columns if column.startswith("p_")]
+    for morph_type in ["compound", "adoption"]:
+        morph_type_data = wide_data[wide_data["morph_type"] == morph_type]
+        averaged_data = morph_type_data.groupby(["name", "gender", "lexeme"])[p_columns].mean()
+        averaged_data.to_csv(output_format_str.format(morph_type))
 
 
 def run_analyses(
-        path_stem="bert_predictions.csv",
+        store_path="bert_predictions",
         label="frequency_reweighted"):
     if label != "" and label[0] != "_":
         label = "_" + label
 
-    bert_predictions_by_sentence_path = path_stem.replace(
-        ".csv", f"_by_sentence_exclude_modified.csv")
+    bert_predictions_by_sentence_path = store_path + "_by_sentence_exclude_modified.csv"
     get_sentence_probabilities(
         output_path=bert_predictions_by_sentence_path,
-        input_data_path=path_stem)
+        input_store_path=store_path)
 
-    bert_predictions_normalized_path = path_stem.replace(
-        ".csv", f"_by_sentence_normalized_exclude_modified" + label + ".csv")
+    bert_predictions_normalized_path = (
+        store_path + "_by_sentence_normalized_exclude_modified" + label + ".csv")
     normalize_sentence_probabilities(
         output_path=bert_predictions_normalized_path,
         input_data_path=bert_predictions_by_sentence_path)
 
-    bert_format_str = path_stem.replace(
-        ".csv", "_averaged_exclude_modified_{}" + label + ".csv")
+    bert_format_str = store_path + "_averaged_exclude_modified_{}" + label + ".csv"
     average_sentence_probabilities(
         output_format_str=bert_format_str,
         input_data_path=bert_predictions_normalized_path)
@@ -1,12 +1,15 @@
 # The goal of this is to understand how BERT tokenizes these words.
 
 import csv
-from transformers import BertTokenizer
+import os
+import sys
 
 from constants import STIMULI_SETS as stimuli
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from bert_scoring import tokenization
+
 
-tokenizer = BertTokenizer.from_pretrained('bert-base-uncased', do_lower_case=True)
 an_roles = {
     'heir', 'heiress',
     'anchor', 'anchorman', 'anchorwoman',
@@ -37,12 +40,12 @@ with open("role_noun_tokenization.csv", "w") as f:
     csv_writer.writeheader()
 
     for stimuli_set in stimuli:
-        tokenization = [
-            tokenizer.tokenize(role_noun) for role_noun in stimuli_set]
-        masked_version, mask_variants = get_masked_version(tokenization)
+        # Word pieces are cached on disk (see bert_scoring/tokenization.py)
+        stimuli_set_tokenization = tokenization.tokenize(stimuli_set)
+        masked_version, mask_variants = get_masked_version(stimuli_set_tokenization)
         csv_writer.writerow({
             "stimuli_set": stimuli_set,
-            "tokenization": tokenization,
+            "tokenization": stimuli_set_tokenization,
             "masked_version": masked_version,
             "a/an": "an" if stimuli_set[0] in an_roles else "a",
             "mask_variants": mask_variants
@@ -1,6 +1,8 @@
 # Generate stimlui to feed into BERT
 # Requires role_noun_tokenization.csv created in part_1a_bert_tokenization_role_nouns.py
-# Outputs stimuli.csv.
+#
+# The stimuli are generated lazily by generate_stimuli(), which part_2a uses
+# directly. Running this script writes them to stimuli.csv, for inspection.
 
 import csv
 import pandas as pd
@@ -9,6 +11,13 @@ import collections
 from constants import MALE_NAMES, NAMES, STATES
 
 
+# Every stimulus fills this template (part_2a assembles their input ids from its
+# pre-tokenized fragments; see bert_scoring/templates.py)
+TEMPLATE = "{name} is {a/an} {masked_role} from {state}"
+
+FIELDNAMES = ["stimulus", "name", "gender", "a/an", "masked_role", "state", "variants"]
+
+
 def load_masked_roles(stimuli_path="role_noun_tokenization.csv"):
     """Loads a dictionary mapping (determiner, masked_role_noun) -> mask variants
     
@@ -24,22 +33,27 @@ def load_masked_roles(stimuli_path="role_noun_tokenization.csv"):
     return result
 
 
-MASKED_ROLES = load_masked_roles()
-
-
-with open("stimuli.csv", "w") as f:
-    csv_writer = csv.DictWriter(
-        f, fieldnames=["stimulus", "name", "gender", "a/an", "masked_role", "state", "variants"])
-    csv_writer.writeheader()
+def generate_stimuli(masked_roles_path="role_noun_tokenization.csv"):
+    """Yields a row dict for each stimulus, in the order of stimuli.csv."""
+    masked_roles = load_masked_roles(masked_roles_path)
     for name in NAMES:
+        gender = "man" if name in MALE_NAMES else "woman"
         for state in STATES:
-            for (determiner, role), variants in MASKED_ROLES.items():
-                csv_writer.writerow({
-                    "stimulus": f"{name} is {determiner} {role} from {state}",
+            for (determiner, role), variants in masked_roles.items():
+                yield {
+                    "stimulus": TEMPLATE.format(**{
+                        "name": name, "a/an": determiner, "masked_role": role, "state": state}),
                     "name": name,
-                    "gender": "man" if name in MALE_NAMES else "woman",
+                    "gender": gender,
                     "a/an": determiner,
                     "masked_role": role,
                     "state": state,
                     "variants": variants
-                })
+                }
+
+
+if __name__ == "__main__":
+    with open("stimuli.csv", "w") as f:
+        csv_writer = csv.DictWriter(f, fieldnames=FIELDNAMES)
+        csv_writer.writeheader()
+        csv_writer.writerows(generate_stimuli())
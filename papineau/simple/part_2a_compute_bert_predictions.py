@@ -1,90 +1,206 @@
 # Compute the probability of masculine, feminine, and gender-neutral variants
 # of role nouns
+#
+# By default, these are probabilities over BERT's full vocabulary. With --within_set,
+# they are instead normalized over the variants for each stimulus (which is all that
+# part_2b uses, since it re-normalizes within each stimuli set), and the
+# full-vocabulary softmax is skipped.
+#
+# Outputs the bert_predictions/ result store (see bert_scoring/store.py), with tables:
+#   * sentences - one row per stimulus
+#   * variants - the log probability of each variant, keyed by stimulus_id
+# With --csv, this also outputs bert_predictions.csv.
+#
+# The input ids of each stimulus are assembled from the pre-tokenized fragments of
+# part_1b's TEMPLATE (see bert_scoring/templates.py), and the sentences table records
+# the token span of the name, masked role noun and state (e.g., masked_role_start and
+# masked_role_end).
+#
+# The stimuli are generated by part_1b_create_stimuli.py (or read from a CSV with
+# --stimuli), and scored in chunks (see bert_scoring/streaming.py), so they are
+# never all in memory at once.
+#
 # Adapted from:
 # https://gist.github.com/yuchenlin/a2f42d3c4378ed7b83de65c7a2222eb2
 # https://seaborn.pydata.org/generated/seaborn.kdeplot.html
 
-import torch
-from transformers import BertForMaskedLM, BertTokenizer
-import pandas as pd
+import argparse
+import itertools
+import os
 import sys
-import tqdm
 import csv
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from bert_scoring import backends
+from bert_scoring import cache
+from bert_scoring import checkpoint
+from bert_scoring import fidelity
+from bert_scoring import masked_lm
+from bert_scoring import models
+from bert_scoring import shards
+from bert_scoring import store
+from bert_scoring import streaming
+from bert_scoring import templates
 
-MASK_INDEX = 103  # 103 corresponds to [MASK]
+from part_1b_create_stimuli import TEMPLATE, generate_stimuli
 
 
-
-#### INITIALIZING THE MODEL ####
-
-# The tokenizer splits sentences into word pieces (sometimes words
-# are split into to multiple pieces), and maps word pieces to ids
-tokenizer = BertTokenizer.from_pretrained('bert-base-uncased', do_lower_case=True)
-
-# The model takes in the ids and generates vector representation for each
-# wordpiece.
-model = BertForMaskedLM.from_pretrained('bert-base-uncased')
-model.eval()  # This tells the model to behave in evaluation mode (not training mode)
-
-
-# Use GPU if available
-device = "cuda" if torch.cuda.is_available() else "cpu"
-model = model.to(device)
+# The template slots whose token spans are recorded in the sentences table
+SPAN_SLOTS = ["name", "masked_role", "state"]
 
 
 def load_masked_sentences(data_path="stimuli.csv"):
-    result = []
+    """Yields the rows of a stimuli CSV (e.g., one written by part_1b_create_stimuli.py)."""
     with open(data_path, "r") as f:
         dict_reader = csv.DictReader(f)
         for row in dict_reader:
             row["variants"] = eval(row["variants"])
-            result.append(row)
-    return result
-
-
-def get_masked_variant_probabilities(stimulus, variants):
-    # Tokenize stimulus sentence
-    tokenized_sentences = tokenizer.batch_encode_plus(
-        [stimulus], return_tensors='pt', add_special_tokens=True,
-        padding=True, truncation=True)
-    tokenized_sentences.to(device)
-
-    # Find the index for the masked word
-    masked_word_index_list = torch.nonzero(
-        tokenized_sentences['input_ids'][0] == MASK_INDEX)
-    assert masked_word_index_list.nelement() == 1, "There should be a masked token"
-    masked_word_index = masked_word_index_list[0][0]
-
-    # Get model logits for all words
-    output = model(**tokenized_sentences)
-    logits = output["logits"]  # has shape [1, ~8, 30522] for [n_sentences, max_sentence_length, vocab_size]
-
-    # Extract the logits for the masked word, and convert to probabilities
-    masked_logits = logits[0, masked_word_index, :]
-    masked_probabilities = torch.nn.functional.softmax(masked_logits, dim=0)
-
-    # Return the probability of each of the variants
-    return {
-        variant: float(masked_probabilities[tokenizer.vocab[variant]])
-        for variant in variants}
+            yield row
 
 
-def main(output_path="bert_predictions.csv"):
-    input_sentences = load_masked_sentences()
+def write_csv(output_path, input_sentences, variant_probabilities):
     with open(output_path, "w") as f:
         csv_writer = csv.DictWriter(
             f, fieldnames=["stimulus", "name", "gender", "a/an", "masked_role",
                            "state", "variants", "variant_probabilities"])
         csv_writer.writeheader()
-        with torch.no_grad():  # This tells the model not to adjust its weights
-            for i in tqdm.trange(len(input_sentences)):
-                row = input_sentences[i]
-                probabilities = get_masked_variant_probabilities(
-                    row["stimulus"], row["variants"])
-                row["variant_probabilities"] = probabilities
-                csv_writer.writerow(row)
+        for row, probabilities in zip(input_sentences, variant_probabilities):
+            csv_writer.writerow(dict(row, variant_probabilities=probabilities))
+
+
+def main(store_path="bert_predictions", csv_output_path=None, stimuli_path=None,
+         batch_size=masked_lm.DEFAULT_BATCH_SIZE, within_set=False,
+         use_cache=True, resume=False,
+         n_workers=1, threads_per_worker=None, shard=None, merge=False,
+         precision="fp32", backend="eager", packed_row_length=None,
+         chunk_size=streaming.DEFAULT_CHUNK_SIZE):
+    if merge:
+        # Merge the shards written by runs with --shard (see bert_scoring/shards.py)
+        shards.merge_shards(store_path)
+        return
+
+    # The stimuli are generated lazily (or read from stimuli_path), rather than
+    # all loaded at once
+    def get_stimuli():
+        return generate_stimuli() if stimuli_path is None else load_masked_sentences(stimuli_path)
+
+    # With a shard, only that shard's stimuli are scored, and written to the shard's store
+    n_stimuli = sum(1 for _ in get_stimuli())
+    stimulus_ids = shards.get_shard_indices(n_stimuli, shard)
+    if shard is not None:
+        store_path = shards.get_shard_store_path(store_path, shard)
+
+    def get_input_sentences():
+        return itertools.islice(get_stimuli(), stimulus_ids.start, stimulus_ids.stop)
+
+    # Load the model and tokenizer (once per process; see bert_scoring/models.py)
+    tokenizer = models.get_tokenizer()
+    model = models.get_model(precision=precision, backend=backend)
+    template = templates.Template(TEMPLATE, tokenizer)
+    if precision != "fp32":
+        # Report how much the reduced precision changes the scores of a reference
+        # subset of the stimuli (see bert_scoring/fidelity.py)
+        reference_sentences = fidelity.get_reference_rows(get_input_sentences(), len(stimulus_ids))
+        fidelity.check_variant_probabilities(
+            [row["stimulus"] for row in reference_sentences],
+            [row["variants"] for row in reference_sentences],
+            tokenizer, model, models.get_model(), store_path + ".fidelity.json",
+            within_set=within_set)
+
+    # Stimuli scored by a previous run (of any pipeline) are looked up in the score cache
+    score_cache = cache.ScoreCache() if use_cache else None
+    # While scoring a chunk, completed scores are checkpointed to <store_path>.checkpoint/
+    run_checkpoint = checkpoint.Checkpoint(store_path + ".checkpoint", resume=resume)
+
+    def score_and_write(part_path, chunk, chunk_stimulus_ids):
+        # Assemble the input ids from the template's pre-tokenized fragments
+        input_ids, spans_list = template.compile_many(chunk)
+
+        # Score the chunk's stimuli in batches of similar-length sentences
+        variant_probabilities = masked_lm.get_masked_variant_probabilities(
+            [row["stimulus"] for row in chunk],
+            [row["variants"] for row in chunk],
+            tokenizer, model, device=models.get_model_device(model), batch_size=batch_size,
+            within_set=within_set, score_cache=score_cache, run_checkpoint=run_checkpoint,
+            n_workers=n_workers, threads_per_worker=threads_per_worker,
+            packed_row_length=packed_row_length, input_ids=input_ids)
+        store.write_sentences(part_path, [
+            dict(row, variants=str(row["variants"]), **templates.get_span_fields(spans, SPAN_SLOTS))
+            for row, spans in zip(chunk, spans_list)],
+            stimulus_ids=chunk_stimulus_ids)
+        store.write_probabilities(
+            part_path, "variants", "variant", variant_probabilities, stimulus_ids=chunk_stimulus_ids)
+        if csv_output_path is not None:
+            write_csv(os.path.join(part_path, streaming.CSV_FILE), chunk, variant_probabilities)
+
+    # Score the stimuli in chunks, written to <store_path>.parts/ (see bert_scoring/streaming.py)
+    part_paths = streaming.score_chunks(
+        get_input_sentences(), store_path + ".parts", score_and_write,
+        [cache.get_model_key(model, tokenizer), within_set, TEMPLATE], first_stimulus_id=stimulus_ids.start,
+        chunk_size=chunk_size, resume=resume, run_checkpoint=run_checkpoint)
+
+    # Outputs only replace previous outputs once they are completely written
+    with checkpoint.atomic_path(store_path) as tmp_store_path:
+        store.concatenate(part_paths, tmp_store_path)
+        if shard is not None:
+            shards.write_metadata(
+                tmp_store_path, shard, (row["stimulus"] for row in get_stimuli()),
+                model, tokenizer, options={"within_set": within_set})
+    if csv_output_path is not None:
+        with checkpoint.atomic_path(csv_output_path) as tmp_csv_path:
+            streaming.concatenate_csvs(part_paths, tmp_csv_path)
+    checkpoint.remove_path(store_path + ".parts")
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--within_set", action="store_true",
+        help="normalize probabilities over each stimulus' variants, rather than the full vocabulary")
+    parser.add_argument(
+        "--stimuli", default=None,
+        help="score the stimuli in this CSV (e.g., an edited stimuli.csv, whose stimuli still fill "
+             "the TEMPLATE of part_1b), rather than generating them")
+    parser.add_argument(
+        "--csv", action="store_true", help="also write the scores to bert_predictions.csv")
+    parser.add_argument(
+        "--chunk_size", type=int, default=streaming.DEFAULT_CHUNK_SIZE,
+        help="number of stimuli to score (and hold in memory) at a time")
+    parser.add_argument(
+        "--resume", action="store_true",
+        help="resume an interrupted run from its checkpoint, rather than starting over")
+    parser.add_argument(
+        "--no_cache", action="store_true",
+        help="score every stimulus, rather than looking up previous scores in the score cache")
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="number of worker processes to score batches with (on CPU)")
+    parser.add_argument(
+        "--threads_per_worker", type=int, default=None,
+        help="number of threads per worker (by default, the cores are split evenly between workers)")
+    parser.add_argument(
+        "--shard", type=shards.parse_shard, default=None,
+        help="only score shard i/N of the stimuli (e.g., 0/4), for splitting a run across machines")
+    parser.add_argument(
+        "--merge", action="store_true", help="merge the shards written by runs with --shard")
+    parser.add_argument(
+        "--precision", choices=models.PRECISIONS, default="fp32",
+        help="inference precision (see bert_scoring/models.py); other than fp32, a fidelity "
+             "report is first written to bert_predictions.fidelity.json")
+    parser.add_argument(
+        "--backend", choices=backends.BACKENDS, default="eager",
+        help="backend to run the encoder with (see bert_scoring/backends.py)")
+    parser.add_argument(
+        "--packed_row_length", type=int, default=None,
+        help="pack the stimuli of each batch into rows of this many tokens, e.g. 256 "
+             "(see bert_scoring/packing.py)")
+    args = parser.parse_args()
+    if args.csv and (args.shard is not None or args.merge):
+        parser.error("--csv can't be combined with --shard or --merge")
+    main(csv_output_path="bert_predictions.csv" if args.csv else None, stimuli_path=args.stimuli,
+         chunk_size=args.chunk_size,
+         within_set=args.within_set,
+         use_cache=not args.no_cache, resume=args.resume,
+         n_workers=args.workers, threads_per_worker=args.threads_per_worker,
+         shard=args.shard, merge=args.merge, precision=args.precision,
+         backend=args.backend, packed_row_length=args.packed_row_length)
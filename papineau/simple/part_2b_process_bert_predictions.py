@@ -1,13 +1,18 @@
 # Unpack the stored BERT predictions so they are useful for regressions and visualizations.
-# This relies on bert_predictions.csv from the previous step.
+# This relies on the bert_predictions/ result store from the previous step.
 # This outputs:
 #   bert_predictions_expanded.csv
 #   bert_predictions_averaged_compound.csv
 #   bert_predictions_averaged_adoption.csv
 
 import csv
+import os
 import pandas as pd
 import collections
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from bert_scoring import store
 
 
 def load_stimuli_sets(data_path="role_noun_tokenization.csv"):
@@ -28,67 +33,70 @@ def load_stimuli_sets(data_path="role_noun_tokenization.csv"):
 
 
 def expand_bert_predictions(
-        data_path="bert_predictions.csv",
+        store_path="bert_predictions",
         output_full="bert_predictions_expanded.csv"):
-    """Expands bert predictions in data_path
+    """Expands bert predictions in the result store at store_path
 
     Outputs a file where each row is a prediction for an experimental
     stimulus from Papineau et al. (2022).
     """
     masked_input_to_stimuli_sets, stimuli_set_to_variants = load_stimuli_sets()
 
-    with open(data_path, "r") as f_in:
-        csv_reader = csv.DictReader(f_in)
-        with open(output_full, "w") as f_out:
-            csv_writer = csv.DictWriter(
-                f_out, fieldnames=[
-                    "name", "gender", "lexeme", "state",
-                    "raw_p_gender_neutral", "raw_p_masculine", "raw_p_feminine",
-                    "p_gender_neutral", "p_masculine", "p_feminine",
-                    "compound"])
-            csv_writer.writeheader()
-            for line in csv_reader:
-                # Select relevant stimuli sets
-                stimuli_sets = masked_input_to_stimuli_sets[
-                    (line["a/an"], line["masked_role"])]
-                variant_probabilities = eval(line["variant_probabilities"])
-
-                for stimuli_set in stimuli_sets:
-                    if len(stimuli_set) == 2:
-                        gender_neutral, feminine = stimuli_set_to_variants[stimuli_set]
-                        masculine = None
-                    else:
-                        assert len(stimuli_set) == 3
-                        gender_neutral, masculine, feminine = stimuli_set_to_variants[stimuli_set]
-
-                    # BERT probabilities (unnormalized for this stimuli set)
-                    raw_p_feminine = variant_probabilities[feminine]
-                    raw_p_masculine = variant_probabilities.get(masculine, None)
-                    raw_p_gender_neutral = variant_probabilities[gender_neutral]
-
-                    # probabilities normalized for this stimuli set
-                    total_p = sum([variant_probabilities[item] for item in stimuli_set_to_variants[stimuli_set]])
-                    p_gender_neutral = raw_p_gender_neutral / total_p
-                    p_feminine = raw_p_feminine / total_p
-                    if masculine is None:
-                        p_masculine = None
-                    else:
-                        p_masculine = raw_p_masculine / total_p
-
-                    output_row = {
-                        "name": line["name"],
-                        "gender": line["gender"],
-                        "lexeme": stimuli_set[0],
-                        "state": line["state"],
-                        "raw_p_gender_neutral": raw_p_gender_neutral,
-                        "raw_p_feminine": raw_p_feminine,
-                        "raw_p_masculine": raw_p_masculine,
-                        "p_gender_neutral": p_gender_neutral,
-                        "p_feminine": p_feminine,
-                        "p_masculine": p_masculine,
-                        "compound": len(stimuli_set) == 3
-                    }
-                    csv_writer.writerow(output_row)
+    sentences = store.read_table(
+        store_path, store.SENTENCES_TABLE,
+        columns=["name", "gender", "a/an", "masked_role", "state"])
+    all_variant_probabilities = store.read_probabilities(store_path, "variants", "variant")
+
+    with open(output_full, "w") as f_out:
+        csv_writer = csv.DictWriter(
+            f_out, fieldnames=[
+                "name", "gender", "lexeme", "state",
+                "raw_p_gender_neutral", "raw_p_masculine", "raw_p_feminine",
+                "p_gender_neutral", "p_masculine", "p_feminine",
+                "compound"])
+        csv_writer.writeheader()
+        for line, variant_probabilities in zip(
+                sentences.to_dict("records"), all_variant_probabilities):
+            # Select relevant stimuli sets
+            stimuli_sets = masked_input_to_stimuli_sets[
+                (line["a/an"], line["masked_role"])]
+
+            for stimuli_set in stimuli_sets:
+                if len(stimuli_set) == 2:
+                    gender_neutral, feminine = stimuli_set_to_variants[stimuli_set]
+                    masculine = None
+                else:
+                    assert len(stimuli_set) == 3
+                    gender_neutral, masculine, feminine = stimuli_set_to_variants[stimuli_set]
+
+                # BERT probabilities (unnormalized for this stimuli set)
+                raw_p_feminine = variant_probabilities[feminine]
+                raw_p_masculine = variant_probabilities.get(masculine, None)
+                raw_p_gender_neutral = variant_probabilities[gender_neutral]
+
+                # probabilities normalized for this stimuli set
+                total_p = sum([variant_probabilities[item] for item in stimuli_set_to_variants[stimuli_set]])
+                p_gender_neutral = raw_p_gender_neutral / total_p
+                p_feminine = raw_p_feminine / total_p
+                if masculine is None:
+                    p_masculine = None
+                else:
+                    p_masculine = raw_p_masculine / total_p
+
+                output_row = {
+                    "name": line["name"],
+                    "gender": line["gender"],
+                    "lexeme": stimuli_set[0],
+                    "state": line["state"],
+                    "raw_p_gender_neutral": raw_p_gender_neutral,
+                    "raw_p_feminine": raw_p_feminine,
+                    "raw_p_masculine": raw_p_masculine,
+                    "p_gender_neutral": p_gender_neutral,
+                    "p_feminine": p_feminine,
+                    "p_masculine": p_masculine,
+                    "compound": len(stimuli_set) == 3
+                }
+                csv_writer.writerow(output_row)
 
 
 def average_bert_predictions(